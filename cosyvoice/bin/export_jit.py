@@ -46,26 +46,34 @@ def main():
     torch._C._jit_set_profiling_mode(False)
     torch._C._jit_set_profiling_executor(False)
 
-    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=False)
+    # load in fp32, the fp32 llm for cpu is exported before half() converts it in place
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=False, fp16=False)
 
-    # 1. export llm text_encoder
-    llm_text_encoder = cosyvoice.model.llm.text_encoder.half()
-    script = torch.jit.script(llm_text_encoder)
-    script = torch.jit.freeze(script)
-    script = torch.jit.optimize_for_inference(script)
-    script.save('{}/llm.text_encoder.fp16.zip'.format(args.model_dir))
+    for dtype in ['fp32', 'fp16']:
+        # 1. export llm text_encoder
+        llm_text_encoder = cosyvoice.model.llm.text_encoder
+        if dtype == 'fp16':
+            llm_text_encoder = llm_text_encoder.half()
+        script = torch.jit.script(llm_text_encoder)
+        script = torch.jit.freeze(script)
+        script = torch.jit.optimize_for_inference(script)
+        script.save('{}/llm.text_encoder.{}.zip'.format(args.model_dir, dtype))
 
-    # 2. export llm llm
-    llm_llm = cosyvoice.model.llm.llm.half()
-    script = torch.jit.script(llm_llm)
-    script = torch.jit.freeze(script, preserved_attrs=['forward_chunk'])
-    script = torch.jit.optimize_for_inference(script)
-    script.save('{}/llm.llm.fp16.zip'.format(args.model_dir))
+        # 2. export llm llm
+        llm_llm = cosyvoice.model.llm.llm
+        if dtype == 'fp16':
+            llm_llm = llm_llm.half()
+        script = torch.jit.script(llm_llm)
+        # forward_chunk decodes one step with the kv cache
+        script = torch.jit.freeze(script, preserved_attrs=['forward_chunk'])
+        script = torch.jit.optimize_for_inference(script)
+        script.save('{}/llm.llm.{}.zip'.format(args.model_dir, dtype))
 
     # 3. export flow encoder
     flow_encoder = cosyvoice.model.flow.encoder
     script = torch.jit.script(flow_encoder)
-    script = torch.jit.freeze(script)
+    # forward_chunk is used by streaming token2wav to reuse the prompt encoding
+    script = torch.jit.freeze(script, preserved_attrs=['forward_chunk'])
     script = torch.jit.optimize_for_inference(script)
     script.save('{}/flow.encoder.fp32.zip'.format(args.model_dir))
 
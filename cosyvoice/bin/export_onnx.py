@@ -21,6 +21,7 @@ logging.getLogger('matplotlib').setLevel(logging.WARNING)
 import os
 import sys
 import onnxruntime
+from onnxruntime.quantization import quantize_dynamic, QuantType
 import random
 import torch
 from tqdm import tqdm
@@ -40,6 +41,22 @@ def get_dummy_input(batch_size, seq_len, out_channels, device):
     return x, mask, mu, t, spks, cond
 
 
+def get_dummy_hift_input(batch_size, seq_len, device):
+    x = torch.rand((batch_size, 80, seq_len), dtype=torch.float32, device=device)
+    s = torch.rand((batch_size, 1, seq_len * 256), dtype=torch.float32, device=device) * 0.2 - 0.1
+    return x, s
+
+
+class HiFTDecode(torch.nn.Module):
+    # decode is a method of HiFTGenerator, wrap it so that torch.onnx.export sees a forward
+    def __init__(self, hift):
+        super().__init__()
+        self.hift = hift
+
+    def forward(self, x, s):
+        return self.hift.decode(x=x, s=s)
+
+
 def get_args():
     parser = argparse.ArgumentParser(description='export your model for deployment')
     parser.add_argument('--model_dir',
@@ -107,6 +124,40 @@ def main():
         output_onnx = estimator_onnx.run(None, ort_inputs)[0]
         torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
 
+    # 3. export hift decode, including istft, so the vocoder also runs in onnxruntime
+    hift = cosyvoice.model.hift
+    hift_decode = HiFTDecode(hift)
+    x, s = get_dummy_hift_input(1, 64, device)
+    torch.onnx.export(
+        hift_decode,
+        (x, s),
+        '{}/hift.decode.fp32.onnx'.format(args.model_dir),
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['x', 's'],
+        output_names=['speech'],
+        dynamic_axes={
+            'x': {0: 'batch_size', 2: 'seq_len'},
+            's': {0: 'batch_size', 2: 'source_len'},
+            'speech': {0: 'batch_size', 1: 'speech_len'},
+        }
+    )
+
+    # 4. test computation consistency
+    hift_decode_onnx = onnxruntime.InferenceSession('{}/hift.decode.fp32.onnx'.format(args.model_dir),
+                                                    sess_options=option, providers=providers)
+    for _ in tqdm(range(10)):
+        x, s = get_dummy_hift_input(random.randint(1, 6), random.randint(16, 512), device)
+        output_pytorch = hift_decode(x, s)
+        output_onnx = hift_decode_onnx.run(None, {'x': x.cpu().numpy(), 's': s.cpu().numpy()})[0]
+        torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
+
+    # 5. int8 dynamic quantization for cpu, used by CosyVoice(backend='onnx-cpu-int8')
+    for name in ['flow.decoder.estimator', 'hift.decode']:
+        quantize_dynamic('{}/{}.fp32.onnx'.format(args.model_dir, name), '{}/{}.int8.onnx'.format(args.model_dir, name),
+                         weight_type=QuantType.QInt8)
+
 
 if __name__ == "__main__":
     main()
@@ -45,6 +45,14 @@ def get_args():
                         choices=['sft', 'zero_shot'],
                         help='inference mode')
     parser.add_argument('--result_dir', required=True, help='asr result file')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=1,
+                        help='utterances synthesized together, 1 keeps the streaming tts path')
+    parser.add_argument('--sort_buffer',
+                        type=int,
+                        default=256,
+                        help='utterances sorted by text length before batching')
     args = parser.parse_args()
     print(args)
     return args
@@ -62,7 +70,7 @@ def main():
     with open(args.config, 'r') as f:
         configs = load_hyperpyyaml(f)
 
-    model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'])
+    model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], False)
     model.load(args.llm_model, args.flow_model, args.hifigan_model)
 
     test_dataset = Dataset(args.prompt_data, data_pipeline=configs['data_pipeline'], mode='inference', shuffle=False, partition=False,
@@ -73,10 +81,27 @@ def main():
     os.makedirs(args.result_dir, exist_ok=True)
     fn = os.path.join(args.result_dir, 'wav.scp')
     f = open(fn, 'w')
+    # buffer of (tts_key, model_input), sorted by text length and synthesized batch_size at a time
+    buffer = []
+
+    def flush(buffer):
+        buffer.sort(key=lambda x: x[1]['text'].shape[1])
+        for i in range(0, len(buffer), args.batch_size):
+            bucket = buffer[i: i + args.batch_size]
+            if args.batch_size == 1:
+                tts_speeches = [torch.concat([o['tts_speech'] for o in model.tts(**bucket[0][1])], dim=1)]
+            else:
+                tts_speeches = model.tts_batch([x[1] for x in bucket])
+            for (tts_key, _), tts_speech in zip(bucket, tts_speeches):
+                tts_fn = os.path.join(args.result_dir, '{}.wav'.format(tts_key))
+                torchaudio.save(tts_fn, tts_speech, sample_rate=22050)
+                f.write('{} {}\n'.format(tts_key, tts_fn))
+            f.flush()
+
     with torch.no_grad():
         for _, batch in tqdm(enumerate(test_data_loader)):
             utts = batch["utts"]
-            assert len(utts) == 1, "inference mode only support batchsize 1"
+            assert len(utts) == 1, "dataset yields one utterance per batch in inference mode, use --batch_size to batch synthesis"
             text_token = batch["text_token"].to(device)
             text_token_len = batch["text_token_len"].to(device)
             tts_index = batch["tts_index"]
@@ -98,15 +123,11 @@ def main():
                                'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
                                'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
                                'llm_embedding': utt_embedding, 'flow_embedding': utt_embedding}
-            tts_speeches = []
-            for model_output in model.tts(**model_input):
-                tts_speeches.append(model_output['tts_speech'])
-            tts_speeches = torch.concat(tts_speeches, dim=1)
-            tts_key = '{}_{}'.format(utts[0], tts_index[0])
-            tts_fn = os.path.join(args.result_dir, '{}.wav'.format(tts_key))
-            torchaudio.save(tts_fn, tts_speeches, sample_rate=22050)
-            f.write('{} {}\n'.format(tts_key, tts_fn))
-            f.flush()
+            buffer.append(('{}_{}'.format(utts[0], tts_index[0]), model_input))
+            if len(buffer) >= args.sort_buffer:
+                flush(buffer)
+                buffer = []
+        flush(buffer)
     f.close()
     logging.info('Result wav.scp saved in {}'.format(fn))
 
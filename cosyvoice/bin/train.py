@@ -68,6 +68,15 @@ def get_args():
                         action='store_true',
                         default=False,
                         help='Use pinned memory buffers used for reading')
+    parser.add_argument('--feat_cache',
+                        action='store_true',
+                        default=False,
+                        help='Read features precomputed by tools/make_feat_cache.py')
+    parser.add_argument('--bucket',
+                        action='store_true',
+                        default=False,
+                        help='Batch with the length bucketed sampler, needs {shard}.len.json from tools/make_parquet_list.py '
+                             'and --feat_cache')
     parser.add_argument('--use_amp',
                         action='store_true',
                         default=False,
@@ -13,17 +13,41 @@
 # limitations under the License.
 import os
 import time
+import torch
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
 from modelscope import snapshot_download
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel
 from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.metrics import LatencyStats, track_stream_latency
+
+
+# torch: the load_jit/load_onnx/fp16/int8 flags decide, onnx-cpu: fp32 jit llm and onnxruntime on cpu,
+# onnx-cpu-int8: dynamic int8 eager llm and flow encoder and int8 onnxruntime on cpu
+COSYVOICE_BACKENDS = ('torch', 'onnx-cpu', 'onnx-cpu-int8')
 
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=True, load_onnx=False, fp16=True):
+    def __init__(self, model_dir, load_jit=True, load_onnx=False, fp16=True, llm_batch_size=1,
+                 flow_n_timesteps=10, flow_solver=None, prompt_cache_mb=64, prompt_cache_dir=None,
+                 spk_registry_dir=None, backend='torch', intra_op_threads=None, inter_op_threads=None, int8=False,
+                 normalize_workers=2):
+        assert backend in COSYVOICE_BACKENDS, 'unknown backend {}, choose from {}'.format(backend, COSYVOICE_BACKENDS)
+        # onnx-cpu loads the jit llm and flow encoder, while int8 quantizes the eager ones
+        assert not (int8 is True and backend == 'onnx-cpu'), 'int8 does not work with the onnx-cpu backend, use backend=onnx-cpu-int8'
+        if backend != 'torch':
+            # cpu profile, flow estimator and hift decode in onnxruntime. the jit llm only exports the concat cache
+            # forward_chunk, so int8 quantizes the eager llm instead and keeps the preallocated kv cache decode
+            # torch modules run on cpu too, even on a gpu host. continuous batching needs the eager llm, so
+            # onnx-cpu only loads the fp32 jit modules without the llm scheduler
+            load_onnx, fp16, device = True, False, torch.device('cpu')
+            load_jit, int8 = (False, True) if backend == 'onnx-cpu-int8' else (llm_batch_size == 1, False)
+        else:
+            device = None
+        if intra_op_threads is not None:
+            torch.set_num_threads(intra_op_threads)
         instruct = True if '-Instruct' in model_dir else False
         self.model_dir = model_dir
         if not os.path.exists(model_dir):
@@ -36,77 +60,144 @@ class CosyVoice:
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
                                           instruct,
-                                          configs['allowed_special'])
-        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
+                                          configs['allowed_special'],
+                                          prompt_cache_mb,
+                                          prompt_cache_dir,
+                                          spk_registry_dir,
+                                          normalize_workers,
+                                          device)
+        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16, device)
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
+        if int8 is True:
+            # quantize the eager modules, jit modules would replace them
+            assert load_jit is False and fp16 is False, 'int8 quantizes the eager fp32 llm and flow encoder, set load_jit=False and fp16=False'
+            self.model.load_int8()
         if load_jit:
-            self.model.load_jit('{}/llm.text_encoder.fp16.zip'.format(model_dir),
-                                '{}/llm.llm.fp16.zip'.format(model_dir),
+            # export with cosyvoice/bin/export_jit.py, fp16 for gpu and fp32 for cpu
+            jit_dtype = 'fp16' if fp16 is True else 'fp32'
+            self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, jit_dtype),
+                                '{}/llm.llm.{}.zip'.format(model_dir, jit_dtype),
                                 '{}/flow.encoder.fp32.zip'.format(model_dir))
         if load_onnx:
-            self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir))
+            onnx_dtype = 'int8' if backend == 'onnx-cpu-int8' else 'fp32'
+            # hift decode onnx is optional, older model dirs only have the estimator
+            hift_decode_model = '{}/hift.decode.{}.onnx'.format(model_dir, onnx_dtype)
+            self.model.load_onnx('{}/flow.decoder.estimator.{}.onnx'.format(model_dir, onnx_dtype),
+                                 hift_decode_model if os.path.exists(hift_decode_model) else None,
+                                 intra_op_num_threads=1 if intra_op_threads is None else intra_op_threads,
+                                 inter_op_num_threads=0 if inter_op_threads is None else inter_op_threads,
+                                 providers=['CPUExecutionProvider'] if backend != 'torch' else None)
+        if llm_batch_size > 1:
+            self.model.load_llm_scheduler(llm_batch_size)
+        self.model.flow_n_timesteps = flow_n_timesteps
+        self.model.flow_solver = flow_solver
+        # streaming latency per request, time to first chunk and gap between chunks
+        self.first_chunk_latency = LatencyStats()
+        self.chunk_gap_latency = LatencyStats()
         del configs
 
     def list_avaliable_spks(self):
-        spks = list(self.frontend.spk2info.keys())
+        spks = self.frontend.list_spks()
         return spks
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
+    def add_zero_shot_spk(self, prompt_text, prompt_speech_16k, zero_shot_spk_id):
+        """Extract prompt once and persist it, then zero_shot_spk_id works in inference_zero_shot and inference_sft."""
+        assert zero_shot_spk_id != '', 'do not use empty zero_shot_spk_id'
+        prompt_text = self.frontend.text_normalize(prompt_text, split=False)
+        self.frontend.register_spk(zero_shot_spk_id, prompt_text, prompt_speech_16k)
+        return True
+
+    @track_stream_latency
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, flow_n_timesteps=None, flow_solver=None):
+        for i in tqdm(self.frontend.text_normalize_stream(tts_text)):
             model_input = self.frontend.frontend_sft(i, spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, flow_n_timesteps=flow_n_timesteps, flow_solver=flow_solver):
                 speech_len = model_output['tts_speech'].shape[1] / 22050
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, stream=False, speed=1.0):
+    @track_stream_latency
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, stream=False, speed=1.0, flow_n_timesteps=None, flow_solver=None,
+                            zero_shot_spk_id=''):
         prompt_text = self.frontend.text_normalize(prompt_text, split=False)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
-            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k)
+        for i in tqdm(self.frontend.text_normalize_stream(tts_text)):
+            model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, zero_shot_spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, flow_n_timesteps=flow_n_timesteps, flow_solver=flow_solver):
                 speech_len = model_output['tts_speech'].shape[1] / 22050
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_cross_lingual(self, tts_text, prompt_speech_16k, stream=False, speed=1.0):
+    def inference_sft_batch(self, tts_texts, spk_id, batch_size=8, speed=1.0, flow_n_timesteps=None, flow_solver=None):
+        """Offline synthesis of many texts with one speaker, returns one tts_speech per text in input order."""
+        model_inputs = [[self.frontend.frontend_sft(i, spk_id) for i in self.frontend.text_normalize(text, split=True)] for text in tts_texts]
+        return self.batch_synthesis(model_inputs, batch_size, speed, flow_n_timesteps, flow_solver)
+
+    def inference_zero_shot_batch(self, tts_texts, prompt_text, prompt_speech_16k, batch_size=8, speed=1.0, flow_n_timesteps=None,
+                                  flow_solver=None, zero_shot_spk_id=''):
+        """Offline synthesis of many texts with one prompt, returns one tts_speech per text in input order."""
+        prompt_text = self.frontend.text_normalize(prompt_text, split=False)
+        model_inputs = [[self.frontend.frontend_zero_shot(i, prompt_text, prompt_speech_16k, zero_shot_spk_id)
+                         for i in self.frontend.text_normalize(text, split=True)] for text in tts_texts]
+        return self.batch_synthesis(model_inputs, batch_size, speed, flow_n_timesteps, flow_solver)
+
+    def batch_synthesis(self, model_inputs, batch_size, speed=1.0, flow_n_timesteps=None, flow_solver=None):
+        # flatten the pieces of all texts, sort by text length so every batch holds similar lengths
+        pieces = [(i, j) for i in range(len(model_inputs)) for j in range(len(model_inputs[i]))]
+        pieces.sort(key=lambda x: model_inputs[x[0]][x[1]]['text'].shape[1])
+        tts_speeches = [[None] * len(i) for i in model_inputs]
+        for k in tqdm(range(0, len(pieces), batch_size)):
+            bucket = pieces[k: k + batch_size]
+            start_time = time.time()
+            outputs = self.model.tts_batch([model_inputs[i][j] for i, j in bucket], speed=speed,
+                                           flow_n_timesteps=flow_n_timesteps, flow_solver=flow_solver)
+            speech_len = sum(i.shape[1] for i in outputs) / 22050
+            logging.info('batch {} speech len {}, rtf {}'.format(len(bucket), speech_len, (time.time() - start_time) / speech_len))
+            for (i, j), tts_speech in zip(bucket, outputs):
+                tts_speeches[i][j] = tts_speech
+        return [torch.concat(i, dim=1) if len(i) != 0 else torch.zeros(1, 0) for i in tts_speeches]
+
+    @track_stream_latency
+    def inference_cross_lingual(self, tts_text, prompt_speech_16k, stream=False, speed=1.0, flow_n_timesteps=None, flow_solver=None):
         if self.frontend.instruct is True:
             raise ValueError('{} do not support cross_lingual inference'.format(self.model_dir))
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
+        for i in tqdm(self.frontend.text_normalize_stream(tts_text)):
             model_input = self.frontend.frontend_cross_lingual(i, prompt_speech_16k)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, flow_n_timesteps=flow_n_timesteps, flow_solver=flow_solver):
                 speech_len = model_output['tts_speech'].shape[1] / 22050
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0):
+    @track_stream_latency
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, flow_n_timesteps=None, flow_solver=None):
         if self.frontend.instruct is False:
             raise ValueError('{} do not support instruct inference'.format(self.model_dir))
         instruct_text = self.frontend.text_normalize(instruct_text, split=False)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True)):
+        for i in tqdm(self.frontend.text_normalize_stream(tts_text)):
             model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, flow_n_timesteps=flow_n_timesteps, flow_solver=flow_solver):
                 speech_len = model_output['tts_speech'].shape[1] / 22050
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0):
+    @track_stream_latency
+    def inference_vc(self, source_speech_16k, prompt_speech_16k, stream=False, speed=1.0, flow_n_timesteps=None, flow_solver=None):
         model_input = self.frontend.frontend_vc(source_speech_16k, prompt_speech_16k)
         start_time = time.time()
-        for model_output in self.model.vc(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.vc(**model_input, stream=stream, speed=speed, flow_n_timesteps=flow_n_timesteps, flow_solver=flow_solver):
             speech_len = model_output['tts_speech'].shape[1] / 22050
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import onnxruntime
 import torch
 import numpy as np
@@ -20,6 +21,7 @@ from typing import Callable
 import torchaudio.compliance.kaldi as kaldi
 import torchaudio
 import os
+import threading
 import re
 import inflect
 try:
@@ -30,6 +32,8 @@ except ImportError:
     from tn.chinese.normalizer import Normalizer as ZhNormalizer
     from tn.english.normalizer import Normalizer as EnNormalizer
     use_ttsfrd = False
+from cosyvoice.cli.prompt_cache import PromptCache
+from cosyvoice.cli.speaker_registry import SpeakerRegistry
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph
 
 
@@ -42,22 +46,32 @@ class CosyVoiceFrontEnd:
                  speech_tokenizer_model: str,
                  spk2info: str = '',
                  instruct: bool = False,
-                 allowed_special: str = 'all'):
+                 allowed_special: str = 'all',
+                 prompt_cache_mb: int = 64,
+                 prompt_cache_dir: str = None,
+                 spk_registry_dir: str = None,
+                 normalize_workers: int = 2,
+                 device: torch.device = None):
         self.tokenizer = get_tokenizer()
         self.feat_extractor = feat_extractor
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # None picks cuda when available
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else torch.device(device)
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
         option.intra_op_num_threads = 1
         self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
         self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
-                                                                     providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
+                                                                     providers=["CUDAExecutionProvider" if self.device.type == 'cuda' else
                                                                                 "CPUExecutionProvider"])
         if os.path.exists(spk2info):
             self.spk2info = torch.load(spk2info, map_location=self.device)
         else:
             self.spk2info = {}
         self.instruct = instruct
+        # same prompt wav is reused by every split segment and by repeat requests, extract it only once
+        self.prompt_cache = PromptCache(prompt_cache_mb * 1024 * 1024, prompt_cache_dir, self.device) if prompt_cache_mb > 0 else None
+        # speakers registered from a prompt wav, usable by id besides the built-in spk2info speakers
+        self.spk_registry = SpeakerRegistry(spk_registry_dir, self.device) if spk_registry_dir is not None else None
         self.allowed_special = allowed_special
         self.inflect_parser = inflect.engine()
         self.use_ttsfrd = use_ttsfrd
@@ -72,6 +86,10 @@ class CosyVoiceFrontEnd:
         else:
             self.zh_tn_model = ZhNormalizer(remove_erhua=False, full_to_half=False)
             self.en_tn_model = EnNormalizer()
+        # threads per text_normalize_stream call, normalizing pieces ahead of synthesis
+        self.normalize_workers = normalize_workers
+        # ttsfrd engine is not safe to call from several threads at once
+        self.frd_lock = threading.Lock()
 
     def _extract_text_token(self, text):
         text_token = self.tokenizer.encode(text, allowed_special=self.allowed_special)
@@ -108,13 +126,62 @@ class CosyVoiceFrontEnd:
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
-    def text_normalize(self, text, split=True):
+    def _extract_prompt(self, prompt_speech_16k):
+        key = PromptCache.key(prompt_speech_16k) if self.prompt_cache is not None else None
+        if key is not None:
+            prompt = self.prompt_cache.get(key)
+            if prompt is not None:
+                return prompt
+        prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
+        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
+        speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
+        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt = {'speech_feat': speech_feat, 'speech_feat_len': speech_feat_len,
+                  'speech_token': speech_token, 'speech_token_len': speech_token_len,
+                  'embedding': embedding}
+        if key is not None:
+            self.prompt_cache.put(key, prompt)
+        return prompt
+
+    def _get_registered_spk(self, spk_id):
+        spk = self.spk_registry.get(spk_id) if self.spk_registry is not None else None
+        if spk is None:
+            raise ValueError('speaker {} is neither in spk2info nor registered'.format(spk_id))
+        return spk
+
+    def list_spks(self):
+        spks = list(self.spk2info.keys())
+        if self.spk_registry is not None:
+            spks += [i for i in self.spk_registry.list_spks() if i not in self.spk2info]
+        return spks
+
+    def register_spk(self, spk_id, prompt_text, prompt_speech_16k):
+        assert self.spk_registry is not None, 'speaker registry is disabled, set spk_registry_dir to register speakers'
+        prompt = self._extract_prompt(prompt_speech_16k)
+        self.spk_registry.register(spk_id, prompt_text, prompt['embedding'], prompt['speech_token'], prompt['speech_feat'])
+
+    def text_normalize(self, text, split=True, lang=None):
+        """Normalize text, split it into segments unless split is False.
+
+        lang is 'zh' or 'en', None detects it from text.
+        """
         text = text.strip()
-        if contains_chinese(text):
-            if self.use_ttsfrd:
+        if lang is None:
+            lang = 'zh' if contains_chinese(text) else 'en'
+        text = self._normalize(text, lang)
+        if split is False:
+            return text
+        return self._split(text, lang)
+
+    def _normalize(self, text, lang):
+        if self.use_ttsfrd:
+            with self.frd_lock:
                 text = self.frd.get_frd_extra_info(text, 'input')
-            else:
-                text = self.zh_tn_model.normalize(text)
+        elif lang == 'zh':
+            text = self.zh_tn_model.normalize(text)
+        else:
+            text = self.en_tn_model.normalize(text)
+        if lang == 'zh':
             text = text.replace("\n", "")
             text = replace_blank(text)
             text = replace_corner_mark(text)
@@ -122,33 +189,81 @@ class CosyVoiceFrontEnd:
             text = text.replace(" - ", "，")
             text = remove_bracket(text)
             text = re.sub(r'[，,、]+$', '。', text)
-            texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "zh", token_max_n=80,
-                                         token_min_n=60, merge_len=20, comma_split=False))
         else:
-            if self.use_ttsfrd:
-                text = self.frd.get_frd_extra_info(text, 'input')
-            else:
-                text = self.en_tn_model.normalize(text)
             text = spell_out_number(text, self.inflect_parser)
-            texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "en", token_max_n=80,
-                                         token_min_n=60, merge_len=20, comma_split=False))
-        if split is False:
-            return text
-        return texts
+        return text
+
+    def _split(self, text, lang):
+        return list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), lang, token_max_n=80,
+                                    token_min_n=60, merge_len=20, comma_split=False))
+
+    @staticmethod
+    def _split_text_pieces(text, max_len=200):
+        # only cut after sentence ends, so every piece normalizes the same as inside the whole text
+        pieces, cur = [], ''
+        for sentence in re.split(r'(?<=[。！？；])|(?<=[.!?;]\s)', text):
+            if len(cur) + len(sentence) > max_len and cur.strip() != '':
+                pieces.append(cur)
+                cur = ''
+            cur += sentence
+        if cur.strip() != '':
+            pieces.append(cur)
+        return pieces
+
+    def text_normalize_stream(self, text):
+        """Lazy text_normalize(text, split=True), yields the first segment as soon as its piece is normalized.
+
+        Language is detected once on the whole text. Text is cut into pieces of about 200 characters at sentence ends,
+        pieces are normalized by a pool of this call only, so a long text does not hold up other requests.
+        Segments are split from the normalized text as it grows, giving the same segments as the whole text.
+        """
+        text = text.strip()
+        lang = 'zh' if contains_chinese(text) else 'en'
+        executor = ThreadPoolExecutor(max_workers=self.normalize_workers)
+        futures = [executor.submit(self._normalize, piece.strip(), lang) for piece in self._split_text_pieces(text)]
+        try:
+            pending = ''
+            for future in futures:
+                # pieces were stripped, english sentences need their space back
+                pending += (' ' if lang == 'en' and pending != '' else '') + future.result()
+                if pending == '':
+                    continue
+                texts = self._split(pending, lang)
+                # split_paragraph is greedy and restarts at every segment boundary, so all but the last two segments are final,
+                # the last one may still grow and a short tail may still be merged into the one before it
+                for i in texts[:-2]:
+                    yield i
+                pending = ''.join(texts[-2:])
+            if pending != '':
+                yield from self._split(pending, lang)
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
-        embedding = self.spk2info[spk_id]['embedding']
+        embedding = self.spk2info[spk_id]['embedding'] if spk_id in self.spk2info else self._get_registered_spk(spk_id)['embedding']
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding}
         return model_input
 
-    def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k):
+    def frontend_zero_shot(self, tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id=''):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
+        if zero_shot_spk_id != '':
+            # registered speaker brings its own prompt text, nothing is extracted from wav
+            spk = self._get_registered_spk(zero_shot_spk_id)
+            prompt = {'speech_feat': spk['speech_feat'],
+                      'speech_feat_len': torch.tensor([spk['speech_feat'].shape[1]], dtype=torch.int32).to(self.device),
+                      'speech_token': spk['speech_token'],
+                      'speech_token_len': torch.tensor([spk['speech_token'].shape[1]], dtype=torch.int32).to(self.device),
+                      'embedding': spk['embedding']}
+            prompt_text = spk['prompt_text']
+        else:
+            prompt = self._extract_prompt(prompt_speech_16k)
         prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-        prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
-        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
-        speech_token, speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        speech_feat, speech_feat_len = prompt['speech_feat'], prompt['speech_feat_len']
+        speech_token, speech_token_len = prompt['speech_token'], prompt['speech_token_len']
+        embedding = prompt['embedding']
         model_input = {'text': tts_text_token, 'text_len': tts_text_token_len,
                        'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
                        'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
@@ -176,10 +291,10 @@ class CosyVoiceFrontEnd:
         return model_input
 
     def frontend_vc(self, source_speech_16k, prompt_speech_16k):
-        prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_speech_16k)
-        prompt_speech_22050 = torchaudio.transforms.Resample(orig_freq=16000, new_freq=22050)(prompt_speech_16k)
-        prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_speech_22050)
-        embedding = self._extract_spk_embedding(prompt_speech_16k)
+        prompt = self._extract_prompt(prompt_speech_16k)
+        prompt_speech_token, prompt_speech_token_len = prompt['speech_token'], prompt['speech_token_len']
+        prompt_speech_feat, prompt_speech_feat_len = prompt['speech_feat'], prompt['speech_feat_len']
+        embedding = prompt['embedding']
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
         model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
                        'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
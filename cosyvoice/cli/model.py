@@ -11,14 +11,60 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import math
 import torch
-import numpy as np
 import threading
-import time
 from torch.nn import functional as F
-from contextlib import nullcontext
+from torch.nn.utils.rnn import pad_sequence
+from contextlib import nullcontext, contextmanager, ExitStack
 import uuid
 from cosyvoice.utils.common import fade_in_out
+from cosyvoice.cli.scheduler import LLMScheduler
+
+
+class ModelSession:
+    """State of one tts/vc call, shared by the llm producer and the token2wav consumer."""
+    __slots__ = ('uuid', 'speech_token', 'llm_end', 'cancelled', 'cond', 'llm_job',
+                 'mel_overlap', 'flow_cache', 'flow_prompt_cache', 'hift_cache')
+
+    def __init__(self, uuid, speech_token=None, llm_end=False):
+        self.uuid = uuid
+        self.speech_token = [] if speech_token is None else speech_token
+        self.llm_end = llm_end
+        # set when the consumer goes away, llm stops decoding this session
+        self.cancelled = False
+        # notified by llm on every new token and on llm end
+        self.cond = threading.Condition()
+        # llm_job thread or LLMSession of llm scheduler, both can be joined
+        self.llm_job = None
+        self.mel_overlap = torch.zeros(1, 80, 0)
+        self.flow_cache = torch.zeros(1, 80, 0, 2)
+        self.flow_prompt_cache = None
+        self.hift_cache = None
+
+    def put_token(self, token):
+        with self.cond:
+            self.speech_token.append(token)
+            self.cond.notify()
+
+    def end(self):
+        with self.cond:
+            self.llm_end = True
+            self.cond.notify()
+
+    def wait_token(self, token_len):
+        """Block until token_len speech tokens are ready, return False if llm ended with fewer tokens."""
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.speech_token) >= token_len or self.llm_end is True)
+            return len(self.speech_token) >= token_len
+
+    def pop_token(self, token_len):
+        with self.cond:
+            self.speech_token = self.speech_token[token_len:]
+
+    def release(self):
+        """Drop every tensor held by this session."""
+        self.speech_token, self.mel_overlap, self.flow_cache, self.flow_prompt_cache, self.hift_cache = [], None, None, None, None
 
 
 class CosyVoiceModel:
@@ -27,8 +73,10 @@ class CosyVoiceModel:
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool):
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+                 fp16: bool,
+                 device: torch.device = None):
+        # None picks cuda when available
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else torch.device(device)
         self.llm = llm
         self.flow = flow
         self.hift = hift
@@ -38,23 +86,19 @@ class CosyVoiceModel:
         self.token_overlap_len = 20
         # mel fade in out
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
-        # hift cache
-        self.mel_cache_len = 20
-        self.source_cache_len = int(self.mel_cache_len * 256)
-        # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
+        self.mel_window_len = 2 * self.mel_overlap_len
         # rtf and decoding related
         self.stream_scale_factor = 1
+        # flow matching ode solver, None means the solver in flow config, both can be overridden per request
+        self.flow_n_timesteps = 10
+        self.flow_solver = None
         assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
-        self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
+        self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if self.device.type == 'cuda' else nullcontext()
         self.lock = threading.Lock()
-        # dict used to store session related variable
-        self.tts_speech_token_dict = {}
-        self.llm_end_dict = {}
-        self.mel_overlap_dict = {}
-        self.flow_cache_dict = {}
-        self.hift_cache_dict = {}
+        # running sessions, llm scheduler callbacks find their session by uuid
+        self.session_dict = {}
+        # continuous batching llm decode, disabled by default
+        self.llm_scheduler = None
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=False)
@@ -68,8 +112,16 @@ class CosyVoiceModel:
         self.hift.load_state_dict(hift_state_dict, strict=False)
         self.hift.to(self.device).eval()
 
+    def load_int8(self):
+        """Dynamic int8 quantization of llm and flow encoder linear layers, weights are int8 and activations are
+        quantized on the fly. Only for cpu inference with the eager fp32 llm and flow encoder."""
+        assert self.device.type == 'cpu', 'dynamic int8 quantization only has cpu kernels'
+        assert self.fp16 is False, 'set fp16=False if you want to use int8 model'
+        self.llm = torch.ao.quantization.quantize_dynamic(self.llm, {torch.nn.Linear}, dtype=torch.qint8)
+        self.flow.encoder = torch.ao.quantization.quantize_dynamic(self.flow.encoder, {torch.nn.Linear}, dtype=torch.qint8)
+
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
-        assert self.fp16 is True, "we only provide fp16 jit model, set fp16=True if you want to use jit model"
+        # jit llm is exported in one dtype, fp16 for gpu and fp32 for cpu, the caller picks the file matching self.fp16
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
         self.llm.text_encoder = llm_text_encoder
         llm_llm = torch.jit.load(llm_llm_model, map_location=self.device)
@@ -77,180 +129,246 @@ class CosyVoiceModel:
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
         self.flow.encoder = flow_encoder
 
-    def load_onnx(self, flow_decoder_estimator_model):
+    def load_onnx(self, flow_decoder_estimator_model, hift_decode_model=None, intra_op_num_threads=1, inter_op_num_threads=0,
+                  providers=None):
         import onnxruntime
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-        option.intra_op_num_threads = 1
-        providers = ['CUDAExecutionProvider' if torch.cuda.is_available() else 'CPUExecutionProvider']
+        option.intra_op_num_threads = intra_op_num_threads
+        # 0 lets onnxruntime decide
+        option.inter_op_num_threads = inter_op_num_threads
+        if providers is None:
+            providers = ['CUDAExecutionProvider' if self.device.type == 'cuda' else 'CPUExecutionProvider']
         del self.flow.decoder.estimator
         self.flow.decoder.estimator = onnxruntime.InferenceSession(flow_decoder_estimator_model, sess_options=option, providers=providers)
+        if hift_decode_model is not None:
+            self.hift.load_onnx_decode(onnxruntime.InferenceSession(hift_decode_model, sess_options=option, providers=providers))
+
+    def load_llm_scheduler(self, max_batch_size):
+        assert hasattr(self.llm.llm, 'forward_chunk_batch'), \
+            "continuous batching needs the eager llm, set load_jit=False if you want to use llm scheduler"
+        self.llm_scheduler = LLMScheduler(self.llm, self.device, self.fp16, self.llm_context,
+                                          on_token=self.llm_token_callback, on_end=self.llm_end_callback,
+                                          max_batch_size=max_batch_size)
+
+    def llm_token_callback(self, uuid, token):
+        # session is gone if its consumer has closed, nothing to deliver then
+        session = self.session_dict.get(uuid)
+        if session is not None:
+            session.put_token(token)
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
+    def llm_end_callback(self, uuid):
+        session = self.session_dict.get(uuid)
+        if session is not None:
+            session.end()
+
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, session):
         if self.fp16 is True:
             llm_embedding = llm_embedding.half()
-        with self.llm_context:
-            for i in self.llm.inference(text=text.to(self.device),
-                                        text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_text=prompt_text.to(self.device),
-                                        prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                        prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                        prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                        embedding=llm_embedding.to(self.device)):
-                self.tts_speech_token_dict[uuid].append(i)
-        self.llm_end_dict[uuid] = True
+        try:
+            with self.llm_context:
+                for i in self.llm.inference(text=text.to(self.device),
+                                            text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                                            prompt_text=prompt_text.to(self.device),
+                                            prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                                            prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                            prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]],
+                                                                                 dtype=torch.int32).to(self.device),
+                                            embedding=llm_embedding.to(self.device)):
+                    if session.cancelled is True:
+                        break
+                    session.put_token(i)
+        finally:
+            # always wake up the consumer, even if llm failed
+            session.end()
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
-        tts_mel, flow_cache = self.flow.inference(token=token.to(self.device),
-                                                  token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                                  prompt_token=prompt_token.to(self.device),
-                                                  prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                  prompt_feat=prompt_feat.to(self.device),
-                                                  prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                                  embedding=embedding.to(self.device),
-                                                  flow_cache=self.flow_cache_dict[uuid])
-        self.flow_cache_dict[uuid] = flow_cache
+    @contextmanager
+    def new_session(self, speech_token=None, llm_end=False):
+        """Create a session which is released when the caller exits, including generator close."""
+        session = ModelSession(str(uuid.uuid1()), speech_token, llm_end)
+        with self.lock:
+            self.session_dict[session.uuid] = session
+        try:
+            yield session
+        finally:
+            self.cancel(session)
+            with self.lock:
+                self.session_dict.pop(session.uuid)
+            session.release()
 
-        # mel overlap fade in out
-        if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
-        # append hift cache
-        if self.hift_cache_dict[uuid] is not None:
-            hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
-            tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
+    def cancel(self, session):
+        """Stop llm decoding of a session, a no-op if llm has already ended."""
+        session.cancelled = True
+        if self.llm_scheduler is not None and session.llm_job is not None:
+            self.llm_scheduler.cancel(session.llm_job)
+
+    def start_llm(self, session, text, prompt_text, llm_prompt_speech_token, llm_embedding):
+        if self.llm_scheduler is not None:
+            session.llm_job = self.llm_scheduler.submit(text, prompt_text, llm_prompt_speech_token, llm_embedding, session.uuid)
         else:
-            hift_cache_source = torch.zeros(1, 1, 0)
-        # keep overlap mel and hift cache
+            session.llm_job = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, session))
+            session.llm_job.start()
+
+    def encode_flow_prompt(self, prompt_token, prompt_feat, embedding, session):
+        if not hasattr(self.flow.encoder, 'forward_chunk'):
+            return
+        session.flow_prompt_cache = self.flow.inference_prompt(prompt_token=prompt_token.to(self.device),
+                                                               prompt_feat=prompt_feat.to(self.device),
+                                                               embedding=embedding.to(self.device))
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, session, finalize=False, speed=1.0, n_timesteps=None, solver=None):
+        tts_mel, session.flow_cache = self.flow.inference(token=token.to(self.device),
+                                                          token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                          prompt_token=prompt_token.to(self.device),
+                                                          prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                          prompt_feat=prompt_feat.to(self.device),
+                                                          prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                          embedding=embedding.to(self.device),
+                                                          flow_cache=session.flow_cache,
+                                                          n_timesteps=self.flow_n_timesteps if n_timesteps is None else n_timesteps,
+                                                          solver=self.flow_solver if solver is None else solver,
+                                                          prompt_cache=session.flow_prompt_cache)
+
+        # mel overlap fade in out
+        if session.mel_overlap.shape[2] != 0:
+            tts_mel = fade_in_out(tts_mel, session.mel_overlap, self.mel_window_len)
+        # keep overlap mel
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            session.mel_overlap = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
-            self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
-                                          'source': tts_source[:, :, -self.source_cache_len:],
-                                          'speech': tts_speech[:, -self.source_cache_len:]}
-            tts_speech = tts_speech[:, :-self.source_cache_len]
-        else:
+        if finalize is True and session.hift_cache is None:
+            # whole utterance in one chunk, no streaming state needed
             if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
-            if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+            tts_speech, _ = self.hift.inference(speech_feat=tts_mel)
+        else:
+            assert speed == 1.0, 'speed change only support non-stream inference mode'
+            # hift_cache holds hift left context, look ahead frames and sine phase, so each hop only adds its own frames
+            tts_speech, session.hift_cache = self.hift.inference_stream(speech_feat=tts_mel, cache=session.hift_cache, finalize=finalize)
         return tts_speech
 
-    def tts(self, text, flow_embedding, llm_embedding=torch.zeros(0, 192),
-            prompt_text=torch.zeros(1, 0, dtype=torch.int32),
-            llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
-        p.start()
+    def stream_token2wav(self, session, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, speed=1.0,
+                         stream=False, flow_n_timesteps=None, flow_solver=None):
         if stream is True:
+            self.encode_flow_prompt(flow_prompt_speech_token, prompt_speech_feat, flow_embedding, session)
             token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
+            while session.wait_token(token_hop_len + self.token_overlap_len) is True:
+                this_tts_speech_token = torch.tensor(session.speech_token[:token_hop_len + self.token_overlap_len]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 session=session,
+                                                 n_timesteps=flow_n_timesteps,
+                                                 solver=flow_solver,
+                                                 finalize=False)
+                yield {'tts_speech': this_tts_speech.cpu()}
+                session.pop_token(token_hop_len)
+                # increase token_hop_len for better speech quality
+                token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+            if session.llm_job is not None:
+                session.llm_job.join()
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            this_tts_speech_token = torch.tensor(session.speech_token).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
+                                             n_timesteps=flow_n_timesteps,
+                                             solver=flow_solver,
                                              finalize=True)
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+            if session.llm_job is not None:
+                session.llm_job.join()
+            this_tts_speech_token = torch.tensor(session.speech_token).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                              prompt_token=flow_prompt_speech_token,
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
-                                             uuid=this_uuid,
+                                             session=session,
+                                             n_timesteps=flow_n_timesteps,
+                                             solver=flow_solver,
                                              finalize=True,
                                              speed=speed)
             yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
 
-    def vc(self, source_speech_token, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream=False, speed=1.0, **kwargs):
-        # this_uuid is used to track variables related to this inference thread
-        this_uuid = str(uuid.uuid1())
-        with self.lock:
-            self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = source_speech_token.flatten().tolist(), True
-            self.hift_cache_dict[this_uuid] = None
-            self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
-            self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+    def tts(self, text, flow_embedding, llm_embedding=torch.zeros(0, 192),
+            prompt_text=torch.zeros(1, 0, dtype=torch.int32),
+            llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
+            flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
+            prompt_speech_feat=torch.zeros(1, 0, 80), stream=False, speed=1.0,
+            flow_n_timesteps=None, flow_solver=None, **kwargs):
+        # session is released when this generator finishes or is closed by the consumer
+        with self.new_session() as session:
+            self.start_llm(session, text, prompt_text, llm_prompt_speech_token, llm_embedding)
+            yield from self.stream_token2wav(session, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, speed=speed,
+                                             stream=stream, flow_n_timesteps=flow_n_timesteps, flow_solver=flow_solver)
+
+    def vc(self, source_speech_token, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, stream=False, speed=1.0,
+           flow_n_timesteps=None, flow_solver=None, **kwargs):
+        # source speech tokens are all known, so the session starts with llm ended
+        with self.new_session(speech_token=source_speech_token.flatten().tolist(), llm_end=True) as session:
+            yield from self.stream_token2wav(session, flow_prompt_speech_token, prompt_speech_feat, flow_embedding, speed=speed,
+                                             stream=stream, flow_n_timesteps=flow_n_timesteps, flow_solver=flow_solver)
+
+    def llm_batch(self, sessions, model_inputs):
+        """Decode speech tokens of all sessions and wait until every one has ended."""
+        scheduler = self.llm_scheduler
+        if scheduler is None and hasattr(self.llm.llm, 'forward_chunk_batch'):
+            # no background scheduler loaded, decode this batch together in the calling thread
+            scheduler = LLMScheduler(self.llm, self.device, self.fp16, self.llm_context,
+                                     on_token=self.llm_token_callback, on_end=self.llm_end_callback,
+                                     max_batch_size=len(sessions), background=False)
+        for session, model_input in zip(sessions, model_inputs):
+            if scheduler is not None:
+                session.llm_job = scheduler.submit(model_input['text'], model_input['prompt_text'], model_input['llm_prompt_speech_token'],
+                                                   model_input['llm_embedding'], session.uuid)
+            else:
+                # jit llm has no batched decode, fall back to one utterance after another
+                self.llm_job(model_input['text'], model_input['prompt_text'], model_input['llm_prompt_speech_token'],
+                             model_input['llm_embedding'], session)
+        if scheduler is not None and scheduler.thread is None:
+            scheduler.drain()
+        for session in sessions:
+            if session.llm_job is not None:
+                session.llm_job.join()
+
+    def tts_batch(self, model_inputs, speed=1.0, flow_n_timesteps=None, flow_solver=None):
+        """Non-streaming synthesis of several utterances together, returns a list of tts_speech in input order.
+
+        model_inputs are frontend outputs and may use different prompts. llm decodes all of them in one
+        batch, then flow and hift each run once over the padded batch. Put utterances of similar length
+        in one call, padding is wasted compute.
+        """
+        defaults = {'llm_embedding': torch.zeros(0, 192),
+                    'prompt_text': torch.zeros(1, 0, dtype=torch.int32),
+                    'llm_prompt_speech_token': torch.zeros(1, 0, dtype=torch.int32),
+                    'flow_prompt_speech_token': torch.zeros(1, 0, dtype=torch.int32),
+                    'prompt_speech_feat': torch.zeros(1, 0, 80)}
+        model_inputs = [{**defaults, **i} for i in model_inputs]
+        with ExitStack() as stack:
+            sessions = [stack.enter_context(self.new_session()) for _ in model_inputs]
+            self.llm_batch(sessions, model_inputs)
+            token = [torch.tensor(session.speech_token, dtype=torch.int32) for session in sessions]
+            prompt_token = [i['flow_prompt_speech_token'][0] for i in model_inputs]
+            prompt_feat = [i['prompt_speech_feat'][0] for i in model_inputs]
+            tts_mels = self.flow.inference_batch(token=pad_sequence(token, batch_first=True).to(self.device),
+                                                 token_len=torch.tensor([i.shape[0] for i in token], dtype=torch.int32).to(self.device),
+                                                 prompt_token=pad_sequence(prompt_token, batch_first=True).to(self.device),
+                                                 prompt_token_len=torch.tensor([i.shape[0] for i in prompt_token], dtype=torch.int32).to(self.device),
+                                                 prompt_feat=pad_sequence(prompt_feat, batch_first=True).to(self.device),
+                                                 prompt_feat_len=torch.tensor([i.shape[0] for i in prompt_feat], dtype=torch.int32).to(self.device),
+                                                 embedding=torch.concat([i['flow_embedding'] for i in model_inputs], dim=0).to(self.device),
+                                                 n_timesteps=self.flow_n_timesteps if flow_n_timesteps is None else flow_n_timesteps,
+                                                 solver=self.flow_solver if flow_solver is None else flow_solver)
+        if speed != 1.0:
+            tts_mels = [F.interpolate(i, size=int(i.shape[2] / speed), mode='linear') for i in tts_mels]
+        # pad with silence mel. hift and its f0 predictor are not causal, so within their receptive field (about 19 frames, see
+        # HiFTGenerator.receptive_field) the padding changes the real tail of every shorter item, and batched output differs
+        # from single item output near the end of those utterances. samples past each item's own length are cut off
+        tts_mel = pad_sequence([i[0].transpose(0, 1) for i in tts_mels], batch_first=True, padding_value=math.log(1e-5)).transpose(1, 2)
+        tts_speech, _ = self.hift.inference(speech_feat=tts_mel, cache_source=torch.zeros(1, 1, 0))
+        return [tts_speech[i:i + 1, :tts_mels[i].shape[2] * 256].cpu() for i in range(len(tts_mels))]
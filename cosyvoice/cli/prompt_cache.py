@@ -0,0 +1,99 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+import numpy as np
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+class PromptCache:
+    """LRU cache of prompt speech features, tokens and embeddings, keyed by a hash of the prompt wav.
+
+    The memory tier is capped by the total bytes of cached tensors and evicts the least recently
+    used entry first. The optional disk tier keeps every entry as {cache_dir}/{key}.pt, survives
+    restarts and refills the memory tier on a hit.
+    """
+
+    def __init__(self, max_bytes: int, cache_dir: Optional[str] = None, device: torch.device = torch.device('cpu')):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.device = device
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(speech: torch.Tensor, sample_rate: int = 16000) -> str:
+        speech = np.ascontiguousarray(speech.detach().cpu().float().numpy())
+        sha1 = hashlib.sha1()
+        sha1.update('{}_{}'.format(sample_rate, speech.shape).encode())
+        sha1.update(speech.tobytes())
+        return sha1.hexdigest()
+
+    @staticmethod
+    def entry_bytes(entry: Dict[str, torch.Tensor]) -> int:
+        return sum(v.numel() * v.element_size() for v in entry.values())
+
+    def get(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        entry = None
+        if self.cache_dir is not None and os.path.exists(self.path(key)):
+            try:
+                entry = torch.load(self.path(key), map_location=self.device)
+            except Exception:
+                logging.warning('failed to load prompt cache {}, extract again'.format(self.path(key)))
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.add(key, entry)
+        return entry
+
+    def put(self, key: str, entry: Dict[str, torch.Tensor]):
+        with self.lock:
+            self.add(key, entry)
+        if self.cache_dir is not None:
+            # write to a temporary file first, so a concurrent reader never sees a partial file
+            tmp_path = '{}.{}.tmp'.format(self.path(key), threading.get_ident())
+            torch.save({k: v.cpu() for k, v in entry.items()}, tmp_path)
+            os.replace(tmp_path, self.path(key))
+
+    def add(self, key: str, entry: Dict[str, torch.Tensor]):
+        # caller holds self.lock
+        if key in self.entries:
+            self.bytes -= self.entry_bytes(self.entries.pop(key))
+        size = self.entry_bytes(entry)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= self.entry_bytes(evicted)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, '{}.pt'.format(key))
@@ -0,0 +1,309 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import functools
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional
+import numpy as np
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+class ShmRing:
+    """Single producer single consumer byte ring in shared memory.
+
+    The first 16 bytes hold the head and tail byte counters, they only grow, so used space is head - tail.
+    The producer only moves head and the consumer only moves tail, no lock is needed between them.
+    """
+
+    def __init__(self, capacity: int, name: Optional[str] = None):
+        self.capacity = capacity
+        if name is None:
+            self.shm = SharedMemory(create=True, size=capacity + 16)
+        else:
+            self.shm = SharedMemory(name=name)
+            # the creator owns the segment, do not let this process unlink it on exit
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.counters = np.ndarray((2,), dtype=np.uint64, buffer=self.shm.buf[:16])
+        self.data = np.ndarray((capacity,), dtype=np.uint8, buffer=self.shm.buf[16:16 + capacity])
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def reset(self):
+        self.counters[:] = 0
+
+    def write(self, data: bytes, cancelled) -> bool:
+        """Wait for room and copy data in, return False if cancelled() turns True while waiting."""
+        view = np.frombuffer(data, dtype=np.uint8)
+        assert len(view) <= self.capacity, 'write {} bytes into a ring of {} bytes'.format(len(view), self.capacity)
+        while self.capacity - int(self.counters[0] - self.counters[1]) < len(view):
+            if cancelled():
+                return False
+            time.sleep(0.001)
+        head = int(self.counters[0])
+        pos = head % self.capacity
+        first = min(len(view), self.capacity - pos)
+        self.data[pos:pos + first] = view[:first]
+        self.data[:len(view) - first] = view[first:]
+        self.counters[0] = head + len(view)
+        return True
+
+    def read(self, nbytes: int) -> np.ndarray:
+        tail = int(self.counters[1])
+        pos = tail % self.capacity
+        first = min(nbytes, self.capacity - pos)
+        data = np.concatenate([self.data[pos:pos + first], self.data[:nbytes - first]])
+        self.counters[1] = tail + nbytes
+        return data
+
+    def close(self, unlink: bool = False):
+        del self.counters, self.data
+        self.shm.close()
+        if unlink is True:
+            self.shm.unlink()
+
+
+def core_sets(num_replicas: int, cores_per_replica: int) -> List[List[int]]:
+    """Split the cores this process may use into num_replicas disjoint sets of cores_per_replica."""
+    cores = sorted(os.sched_getaffinity(0))
+    assert num_replicas * cores_per_replica <= len(cores), \
+        '{} replicas of {} cores need more than the {} available cores'.format(num_replicas, cores_per_replica, len(cores))
+    return [cores[i * cores_per_replica: (i + 1) * cores_per_replica] for i in range(num_replicas)]
+
+
+def replica_worker(index, model_dir, cores, max_conc, ring_names, ring_bytes, request_queue, response_queue, cosyvoice_kwargs):
+    """Main of a replica process, load one CosyVoice and serve requests with up to max_conc threads."""
+    from cosyvoice.cli.cosyvoice import CosyVoice
+    try:
+        if cores is not None:
+            os.sched_setaffinity(0, cores)
+            torch.set_num_threads(len(cores))
+        cosyvoice = CosyVoice(model_dir, **cosyvoice_kwargs)
+    except Exception as e:
+        # the parent waits for ready, tell it instead of leaving it blocked
+        logging.exception('replica {} failed to load'.format(index))
+        response_queue.put(('error', None, repr(e)))
+        return
+    rings = [ShmRing(ring_bytes, name) for name in ring_names]
+    # cancel of a request that already ended is ignored, so cancelled only holds running requests
+    lock, running, cancelled = threading.Lock(), set(), set()
+
+    def run(request_id, slot, method, args, kwargs):
+        try:
+            with closing(getattr(cosyvoice, method)(*args, **kwargs)) as model_output:
+                for i in model_output:
+                    # closing model_output stops llm decoding
+                    if request_id in cancelled:
+                        return
+                    data = i['tts_speech'].numpy().astype(np.float32).tobytes()
+                    # a chunk larger than the ring goes in pieces, the last piece closes the chunk
+                    pieces = range(0, len(data), ring_bytes // 2)
+                    for start in pieces:
+                        piece = data[start: start + ring_bytes // 2]
+                        if rings[slot].write(piece, lambda: request_id in cancelled) is False:
+                            return
+                        response_queue.put(('chunk', request_id, (len(piece), start + ring_bytes // 2 >= len(data))))
+        except Exception as e:
+            logging.exception('replica {} request {} failed'.format(index, request_id))
+            response_queue.put(('error', request_id, repr(e)))
+        finally:
+            with lock:
+                running.discard(request_id)
+                cancelled.discard(request_id)
+            response_queue.put(('end', request_id, None))
+
+    executor = ThreadPoolExecutor(max_workers=max_conc)
+    response_queue.put(('ready', None, None))
+    while True:
+        message = request_queue.get()
+        if message is None:
+            break
+        with lock:
+            if message[0] == 'cancel':
+                if message[1] in running:
+                    cancelled.add(message[1])
+                continue
+            running.add(message[1])
+        executor.submit(run, *message[1:])
+    executor.shutdown()
+    for ring in rings:
+        ring.close()
+
+
+class Replica:
+
+    def __init__(self, process, request_queue, response_queue, rings):
+        self.process = process
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self.rings = rings
+        self.free_slots = list(range(len(rings)))
+        # request_id -> queue.Queue of events from the replica
+        self.requests = {}
+        # request_id -> slot of requests whose consumer stopped early, the slot is freed on their end event
+        self.abandoned = {}
+
+    @property
+    def load(self) -> int:
+        return len(self.rings) - len(self.free_slots)
+
+
+class ReplicaPool:
+    """Run num_replicas CosyVoice models in separate processes, optionally pinned to core sets.
+
+    Every request goes to the least loaded replica with a free slot. Audio comes back through a shared memory
+    ring per slot, only small control messages are pickled. inference_* methods have the same signature as
+    CosyVoice and yield {'tts_speech': tensor}, so runtimes use a pool in place of a CosyVoice.
+    """
+
+    def __init__(self, model_dir: str, num_replicas: int, core_sets: Optional[List[List[int]]] = None, max_conc: int = 2,
+                 ring_bytes: int = 8 * 2 ** 20, **cosyvoice_kwargs):
+        assert core_sets is None or len(core_sets) == num_replicas, 'one core set per replica'
+        # pieces of ring_bytes // 2 must keep whole float32 samples
+        assert ring_bytes % 8 == 0, 'ring_bytes should be a multiple of 8'
+        context = multiprocessing.get_context('spawn')
+        self.cond = threading.Condition()
+        self.request_ids = itertools.count()
+        self.replicas = []
+        for i in range(num_replicas):
+            rings = [ShmRing(ring_bytes) for _ in range(max_conc)]
+            request_queue, response_queue = context.Queue(), context.Queue()
+            process = context.Process(target=replica_worker, daemon=True,
+                                      args=(i, model_dir, None if core_sets is None else core_sets[i], max_conc,
+                                            [ring.name for ring in rings], ring_bytes, request_queue, response_queue, cosyvoice_kwargs))
+            process.start()
+            self.replicas.append(Replica(process, request_queue, response_queue, rings))
+        for i, replica in enumerate(self.replicas):
+            # loading takes a while, wait for all replicas before serving
+            event, payload = self.wait_ready(replica)
+            if event != 'ready':
+                self.terminate()
+                raise RuntimeError('replica {} failed to load, {}'.format(i, payload))
+            threading.Thread(target=self.dispatch, args=(replica,), daemon=True).start()
+            logging.info('replica {} ready, cores {}'.format(i, 'all' if core_sets is None else core_sets[i]))
+
+    def wait_ready(self, replica):
+        # a replica killed while loading, e.g. out of memory, never sends anything
+        while True:
+            try:
+                event, _, payload = replica.response_queue.get(timeout=1)
+                return event, payload
+            except queue.Empty:
+                if not replica.process.is_alive():
+                    return 'error', 'exit code {}'.format(replica.process.exitcode)
+
+    def dispatch(self, replica):
+        # route events of one replica to the requests waiting for them
+        while True:
+            event, request_id, payload = replica.response_queue.get()
+            with self.cond:
+                if request_id in replica.abandoned:
+                    if event == 'end':
+                        self.free(replica, replica.abandoned.pop(request_id))
+                elif request_id in replica.requests:
+                    replica.requests[request_id].put((event, payload))
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                candidates = [r for r in self.replicas if len(r.free_slots) != 0]
+                if len(candidates) != 0:
+                    break
+                self.cond.wait()
+            replica = min(candidates, key=lambda r: r.load)
+            slot = replica.free_slots.pop()
+            request_id = next(self.request_ids)
+            replica.requests[request_id] = queue.Queue()
+        # the replica has finished with this slot, so the ring can be reset from here
+        replica.rings[slot].reset()
+        return replica, slot, request_id
+
+    def free(self, replica, slot):
+        # caller holds self.cond
+        replica.free_slots.append(slot)
+        self.cond.notify()
+
+    def release(self, replica, slot, request_id):
+        with self.cond:
+            replica.requests.pop(request_id)
+            self.free(replica, slot)
+
+    def abandon(self, replica, slot, request_id):
+        """Cancel a request whose consumer stopped early, without waiting for the replica to leave the slot."""
+        with self.cond:
+            events = replica.requests.pop(request_id)
+            while not events.empty():
+                if events.get_nowait()[0] == 'end':
+                    # the replica ended before the consumer stopped
+                    self.free(replica, slot)
+                    return
+            replica.abandoned[request_id] = slot
+        replica.request_queue.put(('cancel', request_id))
+
+    def inference(self, method, *args, **kwargs):
+        replica, slot, request_id = self.acquire()
+        events = replica.requests[request_id]
+        ended = False
+        try:
+            replica.request_queue.put(('request', request_id, slot, method, args, kwargs))
+            pieces = []
+            while True:
+                event, payload = events.get()
+                if event == 'end':
+                    ended = True
+                    break
+                if event == 'error':
+                    raise RuntimeError('replica inference failed, {}'.format(payload))
+                nbytes, last = payload
+                pieces.append(replica.rings[slot].read(nbytes))
+                if last is True:
+                    yield {'tts_speech': torch.from_numpy(np.concatenate(pieces).view(np.float32)).unsqueeze(dim=0)}
+                    pieces = []
+        finally:
+            if ended is False:
+                # consumer stopped early or failed, the dispatch thread frees the slot once the replica leaves it
+                self.abandon(replica, slot, request_id)
+            else:
+                self.release(replica, slot, request_id)
+
+    def __getattr__(self, name):
+        if name.startswith('inference_'):
+            return functools.partial(self.inference, name)
+        raise AttributeError(name)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.request_queue.put(None)
+        for replica in self.replicas:
+            replica.process.join()
+            for ring in replica.rings:
+                ring.close(unlink=True)
+
+    def terminate(self):
+        for replica in self.replicas:
+            replica.process.terminate()
+        for replica in self.replicas:
+            replica.process.join()
+            for ring in replica.rings:
+                ring.close(unlink=True)
@@ -0,0 +1,214 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from collections import deque
+from typing import Callable
+import torch
+from torch.nn import functional as F
+from cosyvoice.utils.common import IGNORE_ID
+from cosyvoice.utils.file_utils import logging
+
+
+class LLMSession:
+
+    def __init__(self, uuid, llm_input):
+        self.uuid = uuid
+        self.llm_input = llm_input
+        self.out_tokens = []
+        self.min_len = 0
+        self.max_len = 0
+        # set by LLMScheduler.cancel, session leaves the batch at the next step
+        self.cancelled = False
+        self.finished = threading.Event()
+
+    def join(self, timeout=None):
+        # same interface as threading.Thread, so CosyVoiceModel can wait on it like llm_job
+        return self.finished.wait(timeout)
+
+
+class LLMScheduler:
+    """Continuous batching scheduler for TransformerLM decoding.
+
+    Every new session is prefilled alone when it joins, after that all active
+    sessions are decoded together, one batched forward_chunk_batch per step.
+    Sessions join and leave between two steps, so a long utterance never
+    blocks a short one and the device always runs the largest possible batch.
+    """
+
+    def __init__(self,
+                 llm: torch.nn.Module,
+                 device: torch.device,
+                 fp16: bool,
+                 llm_context,
+                 on_token: Callable,
+                 on_end: Callable,
+                 max_batch_size: int = 4,
+                 sampling: int = 25,
+                 history_len: int = 32,
+                 background: bool = True):
+        self.llm = llm
+        self.device = device
+        self.fp16 = fp16
+        self.llm_context = llm_context
+        self.on_token = on_token
+        self.on_end = on_end
+        self.max_batch_size = max_batch_size
+        self.sampling = sampling
+        # last decoded tokens of each session used by repetition aware sampling, should be no less than its win_size
+        self.history_len = history_len
+        self.cond = threading.Condition()
+        self.pending = deque()
+        # batch state, att_cache (elayers, B, head, T, d_k * 2) is left padded, key_mask (B, T) marks valid history,
+        # decoded (B, history_len) holds last decoded tokens padded with IGNORE_ID
+        self.active = []
+        self.att_cache = None
+        self.key_mask = None
+        self.decoded = None
+        # without background thread, the owner calls drain to decode submitted sessions
+        self.thread = None
+        if background is True:
+            self.thread = threading.Thread(target=self.loop, daemon=True)
+            self.thread.start()
+
+    def submit(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
+        if self.fp16 is True:
+            llm_embedding = llm_embedding.half()
+        llm_input = {'text': text.to(self.device),
+                     'text_len': torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
+                     'prompt_text': prompt_text.to(self.device),
+                     'prompt_text_len': torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
+                     'prompt_speech_token': llm_prompt_speech_token.to(self.device),
+                     'prompt_speech_token_len': torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
+                     'embedding': llm_embedding.to(self.device)}
+        session = LLMSession(uuid, llm_input)
+        with self.cond:
+            self.pending.append(session)
+            self.cond.notify()
+        return session
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while len(self.pending) == 0 and len(self.active) == 0:
+                    self.cond.wait()
+            self.run_once()
+
+    def run_once(self):
+        """Admit pending sessions and run one batched decode step."""
+        with self.cond:
+            joining = []
+            while len(self.pending) != 0 and len(self.active) + len(joining) < self.max_batch_size:
+                joining.append(self.pending.popleft())
+        try:
+            with self.llm_context, torch.inference_mode():
+                for session in joining:
+                    self.prefill(session)
+                if len(self.active) != 0:
+                    self.step()
+        except Exception:
+            logging.exception('llm scheduler step failed, finish all running sessions')
+            for session in joining + self.active:
+                if not session.finished.is_set():
+                    self.finish(session)
+            self.active, self.att_cache, self.key_mask, self.decoded = [], None, None, None
+
+    def drain(self):
+        """Decode in the calling thread until every submitted session has finished, used when background=False."""
+        while len(self.pending) != 0 or len(self.active) != 0:
+            self.run_once()
+
+    def cancel(self, session):
+        """Stop decoding a session whose consumer has gone away, a no-op for finished sessions."""
+        session.cancelled = True
+
+    def prefill(self, session):
+        if session.cancelled is True:
+            self.finish(session)
+            return
+        lm_input, session.min_len, session.max_len = self.llm.prepare_inference_input(**session.llm_input)
+        session.llm_input = None
+        if session.max_len <= 0:
+            self.finish(session)
+            return
+        logp, att_cache = self.llm.inference_prefill(lm_input)
+        top_ids = self.llm.sampling_ids(logp.squeeze(dim=0), session.out_tokens, self.sampling,
+                                        ignore_eos=True if session.min_len > 0 else False)
+        if self.update(session, top_ids.item()) is False:
+            self.finish(session)
+            return
+        decoded = torch.full((1, self.history_len), IGNORE_ID, dtype=torch.long, device=top_ids.device)
+        decoded[:, -1:] = top_ids
+        # join batch, left pad whichever side has the shorter history
+        att_cache = att_cache.unsqueeze(dim=1)
+        key_mask = torch.ones((1, att_cache.size(3)), dtype=torch.bool, device=att_cache.device)
+        if self.att_cache is None:
+            self.att_cache, self.key_mask, self.decoded = att_cache, key_mask, decoded
+        else:
+            pad = self.att_cache.size(3) - att_cache.size(3)
+            if pad > 0:
+                att_cache, key_mask = self.left_pad(att_cache, key_mask, pad)
+            elif pad < 0:
+                self.att_cache, self.key_mask = self.left_pad(self.att_cache, self.key_mask, -pad)
+            self.att_cache = torch.concat([self.att_cache, att_cache], dim=1)
+            self.key_mask = torch.concat([self.key_mask, key_mask], dim=0)
+            self.decoded = torch.concat([self.decoded, decoded], dim=0)
+        self.active.append(session)
+
+    def step(self):
+        att_mask = torch.concat([self.key_mask, torch.ones((len(self.active), 1), dtype=torch.bool, device=self.key_mask.device)], dim=1)
+        logp, self.att_cache = self.llm.inference_step_batch(self.decoded[:, -1], self.att_cache, att_mask.unsqueeze(dim=1))
+        self.key_mask = att_mask
+        # sample all sessions together, only the final token ids are copied to host
+        top_ids = self.llm.sampling_ids(logp, self.decoded, self.sampling,
+                                        ignore_eos=[len(session.out_tokens) < session.min_len for session in self.active])
+        self.decoded = torch.concat([self.decoded[:, 1:], top_ids], dim=1)
+        keep = []
+        for i, (session, top_id) in enumerate(zip(self.active, top_ids.flatten().tolist())):
+            if self.update(session, top_id) is True:
+                keep.append(i)
+            else:
+                self.finish(session)
+        if len(keep) == len(self.active):
+            return
+        if len(keep) == 0:
+            self.active, self.att_cache, self.key_mask, self.decoded = [], None, None, None
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.att_cache.device)
+        self.active = [self.active[i] for i in keep]
+        self.att_cache = self.att_cache.index_select(1, index)
+        self.key_mask = self.key_mask.index_select(0, index)
+        self.decoded = self.decoded.index_select(0, index)
+        # drop padding columns which no remaining session needs
+        start = int(self.key_mask.any(dim=0).int().argmax())
+        if start > 0:
+            self.att_cache = self.att_cache[:, :, :, start:]
+            self.key_mask = self.key_mask[:, start:]
+
+    def update(self, session, top_id):
+        """Record sampled token of one session, return False if this session should stop."""
+        if top_id == self.llm.speech_token_size or session.cancelled is True:
+            return False
+        self.on_token(session.uuid, top_id)
+        session.out_tokens.append(top_id)
+        return len(session.out_tokens) < session.max_len
+
+    def finish(self, session):
+        self.on_end(session.uuid)
+        session.finished.set()
+
+    @staticmethod
+    def left_pad(att_cache, key_mask, pad):
+        att_cache = F.pad(att_cache, (0, 0, pad, 0))
+        key_mask = torch.concat([torch.zeros((key_mask.size(0), pad), dtype=torch.bool, device=key_mask.device), key_mask], dim=1)
+        return att_cache, key_mask
@@ -0,0 +1,150 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+class SpeakerRegistry:
+    """Persistent store of registered speakers, so a cloned voice can be used by id.
+
+    Layout of root_dir:
+        manifest.json    {spk_id: {'file': ..., 'prompt_text': ..., 'speech_token_len': ..., 'created_at': ...}}
+        <file>.pt        {'embedding', 'speech_token', 'speech_feat'} saved by torch.save, loaded with mmap
+
+    manifest.json is replaced atomically on every change, and its mtime is checked on every lookup,
+    so speakers registered by another process show up without restarting the model.
+    Changes take manifest.lock, so concurrent registrations from several processes are all kept.
+    A replaced or removed speaker file is deleted only gc_delay seconds later, readers still holding
+    the old manifest can load it until then.
+    """
+
+    def __init__(self, root_dir: str, device: torch.device = torch.device('cpu'), gc_delay: float = 3600):
+        self.root_dir = root_dir
+        self.device = device
+        self.gc_delay = gc_delay
+        self.lock = threading.Lock()
+        self.manifest = {}
+        self.manifest_mtime = None
+        # spk_id -> tensors on device, filled lazily
+        self.loaded = {}
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.reload()
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.root_dir, 'manifest.json')
+
+    def reload(self):
+        """Re-read manifest.json if it changed on disk, drop loaded speakers whose file changed."""
+        mtime = os.stat(self.manifest_path).st_mtime_ns if os.path.exists(self.manifest_path) else None
+        with self.lock:
+            if mtime == self.manifest_mtime:
+                return
+            manifest = {}
+            if mtime is not None:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+            self.set_manifest(manifest, mtime)
+        logging.info('speaker registry {} loaded, {} speakers'.format(self.root_dir, len(manifest)))
+
+    def set_manifest(self, manifest: Dict, mtime: Optional[int]):
+        # keep loaded speakers whose file did not change, called with self.lock held
+        self.loaded = {k: v for k, v in self.loaded.items() if k in manifest and manifest[k]['file'] == self.manifest[k]['file']}
+        self.manifest, self.manifest_mtime = manifest, mtime
+
+    def list_spks(self) -> List[str]:
+        self.reload()
+        return list(self.manifest.keys())
+
+    def __contains__(self, spk_id: str) -> bool:
+        self.reload()
+        return spk_id in self.manifest
+
+    def get(self, spk_id: str) -> Optional[Dict]:
+        """Return prompt_text, embedding, speech_token and speech_feat of a speaker, None if not registered."""
+        self.reload()
+        with self.lock:
+            if spk_id not in self.manifest:
+                return None
+            if spk_id not in self.loaded:
+                info = self.manifest[spk_id]
+                tensors = torch.load(os.path.join(self.root_dir, info['file']), map_location='cpu', mmap=True, weights_only=True)
+                self.loaded[spk_id] = {'prompt_text': info['prompt_text'], **{k: v.to(self.device) for k, v in tensors.items()}}
+            return self.loaded[spk_id]
+
+    def register(self, spk_id: str, prompt_text: str, embedding: torch.Tensor, speech_token: torch.Tensor, speech_feat: torch.Tensor):
+        """Persist a speaker, overwriting an existing one with the same id."""
+        # a new file name on every register, so readers holding the old manifest still load a complete file
+        file = '{}.pt'.format(hashlib.sha1('{}_{}'.format(spk_id, time.time()).encode()).hexdigest())
+        tmp_path = os.path.join(self.root_dir, '{}.tmp'.format(file))
+        torch.save({'embedding': embedding.cpu(), 'speech_token': speech_token.cpu(), 'speech_feat': speech_feat.cpu()}, tmp_path)
+        os.replace(tmp_path, os.path.join(self.root_dir, file))
+        self.update_manifest(spk_id, {'file': file,
+                                      'prompt_text': prompt_text,
+                                      'speech_token_len': speech_token.shape[1],
+                                      'created_at': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+    def remove(self, spk_id: str):
+        self.update_manifest(spk_id, None)
+
+    @contextmanager
+    def file_lock(self):
+        """Exclusive lock across processes sharing root_dir."""
+        with open(os.path.join(self.root_dir, 'manifest.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def update_manifest(self, spk_id: str, info: Optional[Dict]):
+        with self.lock, self.file_lock():
+            # read the manifest under the file lock, another process may have changed it since the last reload
+            manifest = {}
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+            manifest.pop(spk_id, None)
+            if info is not None:
+                manifest[spk_id] = info
+            tmp_path = '{}.{}.{}.tmp'.format(self.manifest_path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+            self.set_manifest(manifest, os.stat(self.manifest_path).st_mtime_ns)
+            self.loaded.pop(spk_id, None)
+            self.collect_garbage(manifest)
+
+    def collect_garbage(self, manifest: Dict):
+        """Delete speaker and tmp files no manifest entry points to, once they are older than gc_delay."""
+        files = {v['file'] for v in manifest.values()}
+        now = time.time()
+        for name in os.listdir(self.root_dir):
+            path = os.path.join(self.root_dir, name)
+            if not name.endswith(('.pt', '.tmp')) or name in files:
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.gc_delay:
+                    os.remove(path)
+            except FileNotFoundError:
+                # removed by another process at the same time
+                pass
@@ -21,7 +21,7 @@ from functools import partial
 import torch
 import torch.distributed as dist
 from torch.utils.data import IterableDataset
-from cosyvoice.utils.file_utils import read_lists, read_json_lists
+from cosyvoice.utils.file_utils import read_lists, read_json_lists, logging
 
 
 class Processor(IterableDataset):
@@ -123,6 +123,97 @@ class DataList(IterableDataset):
             yield data
 
 
+class BucketSampler(DistributedSampler):
+
+    def __init__(self, max_frames_in_batch=12000, shard_window=8, shuffle=True, partition=True):
+        super().__init__(shuffle, partition)
+        self.max_frames_in_batch = max_frames_in_batch
+        self.shard_window = shard_window
+
+    def sample(self, shard_lengths):
+        """ Sample shards according to rank/world_size/num_workers like
+            DistributedSampler, then plan length bucketed batches within
+            windows of shard_window shards of this worker
+
+            A batch only takes utts of the shards of one window, so a worker
+            reads every shard once per epoch while the window is cached.
+
+            Args:
+                shard_lengths(List[List[int]]): num frames of every utt of
+                    every shard
+
+            Returns:
+                List[List[Tuple[int, int]]]: (shard index, utt index) of
+                    every batch for this worker
+                float: padding efficiency of these batches
+        """
+        shards = super().sample(shard_lengths)
+        rng = random.Random(self.epoch)
+        batches, total_frames, padded_frames = [], 0, 0
+        for start in range(0, len(shards), self.shard_window):
+            items = [(shard, i) for shard in shards[start: start + self.shard_window] for i in range(len(shard_lengths[shard]))]
+            if self.shuffle:
+                # shuffle before the stable sort, so utts of equal length meet different neighbours every epoch
+                rng.shuffle(items)
+            items.sort(key=lambda x: shard_lengths[x[0]][x[1]])
+            # same rule as processor.dynamic_batch, padded frames of a batch are longest * batch size
+            window_batches, buf, longest = [], [], 0
+            for shard, i in items:
+                length = shard_lengths[shard][i]
+                if len(buf) > 0 and max(longest, length) * (len(buf) + 1) > self.max_frames_in_batch:
+                    window_batches.append(buf)
+                    padded_frames += longest * len(buf)
+                    buf, longest = [], 0
+                buf.append((shard, i))
+                longest = max(longest, length)
+                total_frames += length
+            if len(buf) > 0:
+                window_batches.append(buf)
+                padded_frames += longest * len(buf)
+            if self.shuffle:
+                rng.shuffle(window_batches)
+            batches.extend(window_batches)
+        return batches, total_frames / max(padded_frames, 1)
+
+
+class BucketDataList(IterableDataset):
+    """ Yield {src, utts, batch_id} pieces of length bucketed batches,
+        parquet_opener reads the utts of a piece from shard src.
+
+        Lengths come from the {shard}.len.json files written by
+        tools/make_parquet_list.py.
+    """
+
+    def __init__(self, lists, max_frames_in_batch=12000, shard_window=8, shuffle=True, partition=True):
+        self.lists = lists
+        self.utts, self.lengths = [], []
+        for src in lists:
+            with open('{}.len.json'.format(src), 'r', encoding='utf8') as f:
+                utt2len = json.load(f)
+            self.utts.append(sorted(utt2len.keys()))
+            self.lengths.append([utt2len[utt] for utt in self.utts[-1]])
+        self.sampler = BucketSampler(max_frames_in_batch, shard_window, shuffle, partition)
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        sampler_info = self.sampler.update()
+        batches, efficiency = self.sampler.sample(self.lengths)
+        if sampler_info['rank'] == 0 and sampler_info['worker_id'] == 0:
+            logging.info('epoch {} bucket sampler {} batches for this worker, padding efficiency {:.4f}'.format(
+                self.sampler.epoch, len(batches), efficiency))
+        for batch_id, batch in enumerate(batches):
+            # group utts of a batch by shard, parquet_opener keeps the shards of the current window in memory
+            src2utts = {}
+            for shard, i in sorted(batch):
+                src2utts.setdefault(shard, []).append(self.utts[shard][i])
+            for src, utts in src2utts.items():
+                data = dict(src=self.lists[src], utts=utts, batch_id=batch_id)
+                data.update(sampler_info)
+                yield data
+
+
 def Dataset(data_list_file,
             data_pipeline,
             mode='train',
@@ -130,7 +221,9 @@ def Dataset(data_list_file,
             shuffle=True,
             partition=True,
             tts_file='',
-            prompt_utt2data=''):
+            prompt_utt2data='',
+            feat_cache=False,
+            bucket_conf=None):
     """ Construct dataset from arguments
 
         We have two shuffle stage in the Dataset. The first is global
@@ -141,6 +234,11 @@ def Dataset(data_list_file,
             data_type(str): raw/shard
             tokenizer (BaseTokenizer): tokenizer to tokenize
             partition(bool): whether to do data partition in terms of rank
+            feat_cache(bool): read speech/speech_feat/pitch_feat written by
+                tools/make_feat_cache.py instead of decoding audio_data
+            bucket_conf(dict): use BucketDataList with these arguments
+                instead of shuffling shards, the pipeline should batch with
+                processor.bucket_batch, needs feat_cache
     """
     assert mode in ['train', 'inference']
     lists = read_lists(data_list_file)
@@ -150,12 +248,27 @@ def Dataset(data_list_file,
         utt2lists = read_json_lists(prompt_utt2data)
         # filter unnecessary file in inference mode
         lists = list({utt2lists[utt] for utt in tts_data.keys() if utt2lists[utt] in lists})
-    dataset = DataList(lists,
-                       shuffle=shuffle,
-                       partition=partition)
+    if bucket_conf is not None:
+        assert mode == 'train', 'bucket sampler is only for train mode'
+        # a batch reads a few utts of many shards, only the feat cache reads them without decoding whole shards
+        assert feat_cache is True, 'bucket sampler needs feat_cache, run tools/make_feat_cache.py first'
+        dataset = BucketDataList(lists,
+                                 shuffle=shuffle,
+                                 partition=partition,
+                                 **bucket_conf)
+    else:
+        dataset = DataList(lists,
+                           shuffle=shuffle,
+                           partition=partition)
     if mode == 'inference':
         # map partial arg to parquet_opener func in inference mode
         data_pipeline[0] = partial(data_pipeline[0], tts_data=tts_data)
+    if feat_cache is True:
+        # map partial arg to parquet_opener func to read the feat cache
+        data_pipeline[0] = partial(data_pipeline[0], feat_cache=feat_cache)
+    if bucket_conf is not None:
+        # map partial arg to parquet_opener func to keep every shard of a bucket sampler window in memory
+        data_pipeline[0] = partial(data_pipeline[0], cache_shards=bucket_conf.get('shard_window', 8))
     if gan is True:
         # map partial arg to padding func in gan mode
         data_pipeline[-1] = partial(data_pipeline[-1], gan=gan)
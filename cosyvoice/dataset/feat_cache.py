@@ -0,0 +1,110 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+from typing import Dict, Optional
+import numpy as np
+import torch
+
+# features tools/make_feat_cache.py may store next to a parquet shard
+FEAT_CACHE_KEYS = ('speech', 'speech_feat', 'pitch_feat')
+
+
+def feat_cache_path(src: str, key: str) -> str:
+    """Sidecar files of a parquet shard, {src}.feat.json for the index and {src}.{key}.f32 for raw float32 rows."""
+    return '{}.feat.json'.format(src) if key == 'index' else '{}.{}.f32'.format(src, key)
+
+
+class FeatCacheWriter:
+    """Append features of one parquet shard to raw float32 files, the index is written last by close.
+
+    Index layout:
+        {'sample_rate': ..., 'dims': {key: row dim}, 'utts': {utt: {key: [row offset, num rows]}}}
+    speech rows are samples, speech_feat and pitch_feat rows are mel frames.
+    """
+
+    def __init__(self, src: str, sample_rate: int):
+        self.src = src
+        self.index = {'sample_rate': sample_rate, 'dims': {}, 'utts': {}}
+        self.files, self.offsets = {}, {}
+
+    def add(self, utt: str, feats: Dict[str, torch.Tensor]):
+        self.index['utts'][utt] = {}
+        for key, value in feats.items():
+            assert key in FEAT_CACHE_KEYS, 'unknown feat cache key {}'.format(key)
+            value = value.float().contiguous().cpu().numpy()
+            # speech comes as (1, num_samples), store one sample per row
+            value = value.reshape(-1, 1) if key == 'speech' else value.reshape(value.shape[0], -1)
+            if key not in self.files:
+                self.files[key] = open('{}.tmp'.format(feat_cache_path(self.src, key)), 'wb')
+                self.offsets[key] = 0
+                self.index['dims'][key] = value.shape[1]
+            assert value.shape[1] == self.index['dims'][key], \
+                '{} of {} has dim {}, expect {}'.format(key, utt, value.shape[1], self.index['dims'][key])
+            self.files[key].write(value.tobytes())
+            self.index['utts'][utt][key] = [self.offsets[key], value.shape[0]]
+            self.offsets[key] += value.shape[0]
+
+    def close(self):
+        for key, f in self.files.items():
+            f.close()
+            os.replace('{}.tmp'.format(feat_cache_path(self.src, key)), feat_cache_path(self.src, key))
+        # the index marks the cache complete, so a crashed job never leaves a readable half cache
+        tmp_path = '{}.tmp'.format(feat_cache_path(self.src, 'index'))
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, feat_cache_path(self.src, 'index'))
+
+
+class FeatCache:
+    """Read only view of the features of one parquet shard.
+
+    Files are mapped copy on write, get returns tensors sharing memory with the mapping, so nothing is read
+    from disk until a tensor is touched and inplace ops in later stages never reach the file.
+    """
+
+    def __init__(self, src: str):
+        with open(feat_cache_path(src, 'index'), 'r', encoding='utf8') as f:
+            self.index = json.load(f)
+        self.sample_rate = self.index['sample_rate']
+        self.arrays = {}
+        for key, dim in self.index['dims'].items():
+            path = feat_cache_path(src, key)
+            num_rows = os.path.getsize(path) // (4 * dim)
+            # np.memmap refuses empty files
+            if num_rows != 0:
+                self.arrays[key] = np.memmap(path, dtype=np.float32, mode='c', shape=(num_rows, dim))
+            else:
+                self.arrays[key] = np.zeros((0, dim), dtype=np.float32)
+
+    @staticmethod
+    def exists(src: str) -> bool:
+        return os.path.exists(feat_cache_path(src, 'index'))
+
+    def __contains__(self, utt: str) -> bool:
+        return utt in self.index['utts']
+
+    def get(self, utt: str) -> Optional[Dict[str, torch.Tensor]]:
+        """Return {'speech': (1, num_samples), 'speech_feat': (num_frames, num_mels), 'pitch_feat': (num_frames,)}."""
+        if utt not in self.index['utts']:
+            return None
+        feats = {}
+        for key, (offset, num_rows) in self.index['utts'][utt].items():
+            value = torch.from_numpy(self.arrays[key][offset: offset + num_rows])
+            if key == 'speech':
+                value = value.reshape(1, -1)
+            elif key == 'pitch_feat':
+                value = value.reshape(-1)
+            feats[key] = value
+        return feats
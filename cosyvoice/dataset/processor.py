@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
+import math
 import random
+from collections import OrderedDict
 
 import pyarrow.parquet as pq
 from io import BytesIO
@@ -21,36 +23,97 @@ import torchaudio
 from torch.nn.utils.rnn import pad_sequence
 import torch.nn.functional as F
 
+from cosyvoice.dataset.feat_cache import FeatCache
+
 torchaudio.set_audio_backend('soundfile')
 
 AUDIO_FORMAT_SETS = {'flac', 'mp3', 'm4a', 'ogg', 'opus', 'wav', 'wma'}
 
 
-def parquet_opener(data, mode='train', tts_data={}):
+def read_parquet_rows(url, columns=None, batch_size=64, feat_cache=False, utts=None):
+    """ Read rows of one parquet shard as dicts, one record batch at a time
+
+        Args:
+            url(str): parquet shard
+            columns(List[str]): columns to read, None for all columns
+            batch_size(int): rows per record batch
+            feat_cache(bool): skip audio_data and attach speech, speech_feat
+                and pitch_feat precomputed by tools/make_feat_cache.py
+            utts(Set[str]): only build rows of these utts, None for all rows
+
+        Returns:
+            Iterable[{utt, ...}]
+    """
+    with pq.ParquetFile(url) as pf:
+        cache = None
+        if feat_cache is True:
+            assert FeatCache.exists(url), 'no feat cache for {}, run tools/make_feat_cache.py first'.format(url)
+            cache = FeatCache(url)
+            columns = [k for k in (pf.schema_arrow.names if columns is None else columns) if k != 'audio_data']
+        for record_batch in pf.iter_batches(batch_size=batch_size, columns=columns):
+            if utts is not None:
+                # skip the rest of the batch before any row is built
+                keep = [i for i, utt in enumerate(record_batch.column('utt').to_pylist()) if utt in utts]
+                if len(keep) == 0:
+                    continue
+                record_batch = record_batch.take(keep)
+            for row in record_batch.to_pylist():
+                if cache is not None:
+                    if row['utt'] not in cache:
+                        continue
+                    row.update(cache.get(row['utt']))
+                    row['sample_rate'] = cache.sample_rate
+                yield row
+
+
+def parquet_opener(data, mode='train', tts_data={}, columns=None, batch_size=64, feat_cache=False, cache_shards=8):
     """ Give url or local file, return file descriptor
         Inplace operation.
 
         Args:
             data(Iterable[str]): url or local file list
+            columns(List[str]): columns to read, None for all columns,
+                unused columns are never decoded from the shard
+            batch_size(int): rows per record batch, only one record batch
+                of a shard is held in memory at a time
+            feat_cache(bool): skip audio_data and attach speech, speech_feat
+                and pitch_feat precomputed by tools/make_feat_cache.py
+            cache_shards(int): shards kept in memory when the source asks for
+                some utts of a shard at a time, at least the shard_window of
+                BucketDataList so every shard is read once per epoch. needs
+                feat_cache, so a cached shard holds no audio_data and its
+                features stay on disk until an utt is used
 
         Returns:
             Iterable[{src, stream}]
     """
+    if columns is not None and 'utt' not in columns:
+        columns = ['utt'] + list(columns)
+    shard_rows = OrderedDict()
     for sample in data:
         assert 'src' in sample
+        assert 'utts' not in sample or feat_cache is True, 'reading some utts of a shard needs the feat cache'
         url = sample['src']
         try:
-            df = pq.read_table(url).to_pandas()
-            for i in range(len(df)):
-                if mode == 'inference' and df.loc[i, 'utt'] not in tts_data:
-                    continue
-                sample.update(dict(df.loc[i]))
+            if 'utts' in sample:
+                # bucket sampler asks for the utts of one batch in this shard, keep recent shards in memory
+                if url not in shard_rows:
+                    shard_rows[url] = {row['utt']: row for row in read_parquet_rows(url, columns, batch_size, feat_cache)}
+                    if len(shard_rows) > cache_shards:
+                        shard_rows.popitem(last=False)
+                shard_rows.move_to_end(url)
+                utts = sample.pop('utts')
+                for utt in utts:
+                    if utt in shard_rows[url]:
+                        yield {**sample, **shard_rows[url][utt]}
+                continue
+            for row in read_parquet_rows(url, columns, batch_size, feat_cache, utts=tts_data if mode == 'inference' else None):
                 if mode == 'train':
                     # NOTE do not return sample directly, must initialize a new dict
-                    yield {**sample}
+                    yield {**sample, **row}
                 else:
-                    for index, text in enumerate(tts_data[df.loc[i, 'utt']]):
-                        yield {**sample, 'tts_index': index, 'tts_text': text}
+                    for index, text in enumerate(tts_data[row['utt']]):
+                        yield {**sample, **row, 'tts_index': index, 'tts_text': text}
         except Exception as ex:
             logging.warning('Failed to open {}, ex info {}'.format(url, ex))
 
@@ -84,9 +147,11 @@ def filter(data,
             Iterable[{key, wav, label, sample_rate}]
     """
     for sample in data:
-        sample['speech'], sample['sample_rate'] = torchaudio.load(BytesIO(sample['audio_data']))
-        sample['speech'] = sample['speech'].mean(dim=0, keepdim=True)
-        del sample['audio_data']
+        # speech is already there when read from feat cache
+        if 'audio_data' in sample:
+            sample['speech'], sample['sample_rate'] = torchaudio.load(BytesIO(sample['audio_data']))
+            sample['speech'] = sample['speech'].mean(dim=0, keepdim=True)
+            del sample['audio_data']
         # sample['wav'] is torch.Tensor, we have 100 frames every second
         num_frames = sample['speech'].size(1) / sample['sample_rate'] * 100
         if num_frames < min_length:
@@ -135,24 +200,40 @@ def resample(data, resample_rate=22050, min_sample_rate=16000, mode='train'):
         yield sample
 
 
-def truncate(data, truncate_length=24576, mode='train'):
+def truncate(data, truncate_length=24576, hop_size=256, mode='train'):
     """ Truncate data.
 
         Args:
             data: Iterable[{key, wav, label, sample_rate}]
             truncate_length: truncate length
+            hop_size: samples per mel frame, cached speech_feat/pitch_feat
+                are cut at the same frames as speech
 
         Returns:
             Iterable[{key, wav, label, sample_rate}]
     """
     for sample in data:
         waveform = sample['speech']
+        cached = 'speech_feat' in sample
         if waveform.shape[1] > truncate_length:
-            start = random.randint(0, waveform.shape[1] - truncate_length)
+            if cached:
+                # keep frame alignment between speech and cached features
+                start = random.randint(0, (waveform.shape[1] - truncate_length) // hop_size) * hop_size
+            else:
+                start = random.randint(0, waveform.shape[1] - truncate_length)
             waveform = waveform[:, start: start + truncate_length]
         else:
+            start = 0
             waveform = torch.concat([waveform, torch.zeros(1, truncate_length - waveform.shape[1])], dim=1)
         sample['speech'] = waveform
+        if cached:
+            num_frames = truncate_length // hop_size
+            speech_feat = sample['speech_feat'][start // hop_size: start // hop_size + num_frames]
+            # log mel of zero padded speech is the clamp value log(1e-5)
+            sample['speech_feat'] = F.pad(speech_feat, (0, 0, 0, num_frames - speech_feat.shape[0]), value=math.log(1e-5))
+            if 'pitch_feat' in sample:
+                pitch_feat = sample['pitch_feat'][start // hop_size: start // hop_size + num_frames]
+                sample['pitch_feat'] = F.pad(pitch_feat, (0, num_frames - pitch_feat.shape[0]), value=0)
         yield sample
 
 
@@ -172,6 +253,9 @@ def compute_fbank(data,
         assert 'speech' in sample
         assert 'utt' in sample
         assert 'text_token' in sample
+        if 'speech_feat' in sample:
+            yield sample
+            continue
         waveform = sample['speech']
         mat = feat_extractor(waveform).squeeze(dim=0).transpose(0, 1)
         sample['speech_feat'] = mat
@@ -192,6 +276,9 @@ def compute_f0(data, pitch_extractor, mode='train'):
         assert 'speech' in sample
         assert 'utt' in sample
         assert 'text_token' in sample
+        if 'pitch_feat' in sample:
+            yield sample
+            continue
         waveform = sample['speech']
         mat = pitch_extractor(waveform).transpose(1, 2)
         mat = F.interpolate(mat, size=sample['speech_feat'].shape[0], mode='linear')
@@ -209,11 +296,13 @@ def parse_embedding(data, normalize, mode='train'):
             Iterable[{key, feat, label}]
     """
     for sample in data:
-        sample['utt_embedding'] = torch.tensor(sample['utt_embedding'], dtype=torch.float32)
-        sample['spk_embedding'] = torch.tensor(sample['spk_embedding'], dtype=torch.float32)
-        if normalize:
-            sample['utt_embedding'] = F.normalize(sample['utt_embedding'], dim=0)
-            sample['spk_embedding'] = F.normalize(sample['spk_embedding'], dim=0)
+        # embedding columns may be projected away by parquet_opener, e.g. in gan train
+        for key in ['utt_embedding', 'spk_embedding']:
+            if key not in sample:
+                continue
+            sample[key] = torch.tensor(sample[key], dtype=torch.float32)
+            if normalize:
+                sample[key] = F.normalize(sample[key], dim=0)
         yield sample
 
 
@@ -351,6 +440,26 @@ def batch(data, batch_type='static', batch_size=16, max_frames_in_batch=12000, m
             logging.fatal('Unsupported batch type {}'.format(batch_type))
 
 
+def bucket_batch(data, mode='train'):
+    """ Batch the data as planned by BucketSampler, samples of one
+        batch come one after another with the same `batch_id`
+
+        Args:
+            data: Iterable[{key, feat, label, batch_id}]
+
+        Returns:
+            Iterable[List[{key, feat, label}]]
+    """
+    buf = []
+    for sample in data:
+        if len(buf) > 0 and sample['batch_id'] != buf[-1]['batch_id']:
+            yield buf
+            buf = []
+        buf.append(sample)
+    if len(buf) > 0:
+        yield buf
+
+
 def padding(data, use_spk_embedding, mode='train', gan=False):
     """ Padding the data into training data
 
@@ -384,8 +493,6 @@ def padding(data, use_spk_embedding, mode='train', gan=False):
         text_token = [torch.tensor(sample[i]['text_token']) for i in order]
         text_token_len = torch.tensor([i.size(0) for i in text_token], dtype=torch.int32)
         text_token = pad_sequence(text_token, batch_first=True, padding_value=0)
-        utt_embedding = torch.stack([sample[i]['utt_embedding'] for i in order], dim=0)
-        spk_embedding = torch.stack([sample[i]['spk_embedding'] for i in order], dim=0)
         batch = {
             "utts": utts,
             "speech": speech,
@@ -397,9 +504,10 @@ def padding(data, use_spk_embedding, mode='train', gan=False):
             "text": text,
             "text_token": text_token,
             "text_token_len": text_token_len,
-            "utt_embedding": utt_embedding,
-            "spk_embedding": spk_embedding,
         }
+        for key in ['utt_embedding', 'spk_embedding']:
+            if key in sample[0]:
+                batch[key] = torch.stack([sample[i][key] for i in order], dim=0)
         if gan is True:
             # in gan train, we need pitch_feat
             pitch_feat = [sample[i]['pitch_feat'] for i in order]
@@ -423,8 +531,7 @@ def padding(data, use_spk_embedding, mode='train', gan=False):
                           'tts_index': tts_index,
                           'tts_text_token': tts_text_token,
                           'tts_text_token_len': tts_text_token_len})
-        if use_spk_embedding is True:
-            batch["embedding"] = batch["spk_embedding"]
-        else:
-            batch["embedding"] = batch["utt_embedding"]
+        embedding_key = "spk_embedding" if use_spk_embedding is True else "utt_embedding"
+        if embedding_key in batch:
+            batch["embedding"] = batch[embedding_key]
         yield batch
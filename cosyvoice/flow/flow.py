@@ -17,6 +17,7 @@ from typing import Dict, Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.utils.rnn import pad_sequence
 from omegaconf import DictConfig
 from cosyvoice.utils.mask import make_pad_mask
 
@@ -101,6 +102,27 @@ class MaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    @torch.inference_mode()
+    def inference_prompt(self,
+                         prompt_token,
+                         prompt_feat,
+                         embedding):
+        """Encode the prompt once per session, so streaming hops only encode their own tokens.
+
+        Returns a dict with the projected speaker embedding, the projected prompt encoding h,
+        the encoder key/value cache of the prompt and the prompt mel used as conds.
+        """
+        assert prompt_token.shape[0] == 1
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+        if prompt_token.shape[1] != 0:
+            token = self.input_embedding(torch.clamp(prompt_token, min=0))
+            h, att_cache, _ = self.encoder.forward_chunk(token, offset=0, required_cache_size=-1)
+            h = self.encoder_proj(h)
+        else:
+            h, att_cache = torch.zeros(1, 0, self.output_size, device=embedding.device), torch.zeros(0, 0, 0, 0, device=embedding.device)
+        return {'embedding': embedding, 'h': h, 'att_cache': att_cache, 'feat': prompt_feat}
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -110,23 +132,35 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None,
+                  prompt_cache=None):
         assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        if prompt_cache is not None:
+            # prompt already encoded by inference_prompt, new tokens attend to its cached keys and values
+            embedding, prompt_feat = prompt_cache['embedding'], prompt_cache['feat']
+            token_len1, token_len2 = prompt_cache['h'].shape[1], token.shape[1]
+            token = self.input_embedding(torch.clamp(token, min=0))
+            h, _, _ = self.encoder.forward_chunk(token, offset=token_len1, required_cache_size=0, att_cache=prompt_cache['att_cache'])
+            h1, h2 = prompt_cache['h'], self.encoder_proj(h)
+        else:
+            # xvec projection
+            embedding = F.normalize(embedding, dim=1)
+            embedding = self.spk_embed_affine_layer(embedding)
 
-        # concat text and prompt_text
-        token_len1, token_len2 = prompt_token.shape[1], token.shape[1]
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
-        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+            # concat text and prompt_text
+            token_len1, token_len2 = prompt_token.shape[1], token.shape[1]
+            token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+            mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+            token = self.input_embedding(torch.clamp(token, min=0)) * mask
 
-        # text encode
-        h, h_lengths = self.encoder(token, token_len)
-        h = self.encoder_proj(h)
+            # text encode
+            h, h_lengths = self.encoder(token, token_len)
+            h = self.encoder_proj(h)
+            h1, h2 = h[:, :token_len1], h[:, token_len1:]
         mel_len1, mel_len2 = prompt_feat.shape[1], int(token_len2 / self.input_frame_rate * 22050 / 256)
-        h, h_lengths = self.length_regulator.inference(h[:, :token_len1], h[:, token_len1:], mel_len1, mel_len2, self.input_frame_rate)
+        h, h_lengths = self.length_regulator.inference(h1, h2, mel_len1, mel_len2, self.input_frame_rate)
 
         # get conditions
         conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device)
@@ -139,10 +173,68 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            flow_cache=flow_cache
+            flow_cache=flow_cache,
+            solver=solver
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat, flow_cache
+
+    @torch.inference_mode()
+    def inference_batch(self,
+                        token,
+                        token_len,
+                        prompt_token,
+                        prompt_token_len,
+                        prompt_feat,
+                        prompt_feat_len,
+                        embedding,
+                        n_timesteps=10,
+                        solver=None):
+        """Non-streaming inference of a batch, every item may have its own prompt.
+
+        token, prompt_token and prompt_feat are right padded, returns a list with one mel of shape (1, 80, mel_len2) per item.
+        """
+        batch_size = token.shape[0]
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # concat prompt_token and token of every item, so each item has no padding in the middle
+        token_len1, token_len2 = prompt_token_len.tolist(), token_len.tolist()
+        token = pad_sequence([torch.concat([prompt_token[i, :token_len1[i]], token[i, :token_len2[i]]]) for i in range(batch_size)],
+                             batch_first=True, padding_value=0)
+        token_len = prompt_token_len + token_len
+        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+        # text encode
+        h, h_lengths = self.encoder(token, token_len)
+        h = self.encoder_proj(h)
+
+        # length regulate every item alone, so prompt and new tokens keep a clear separation point
+        mel_len1 = prompt_feat_len.tolist()
+        mel_len2 = [int(i / self.input_frame_rate * 22050 / 256) for i in token_len2]
+        mu, conds = [], []
+        for i in range(batch_size):
+            h1, h2 = h[i:i + 1, :token_len1[i]], h[i:i + 1, token_len1[i]:token_len1[i] + token_len2[i]]
+            mu_i, _ = self.length_regulator.inference(h1, h2, mel_len1[i], mel_len2[i], self.input_frame_rate)
+            mu.append(mu_i[0])
+            cond = torch.zeros([mel_len1[i] + mel_len2[i], self.output_size], device=token.device)
+            cond[:mel_len1[i]] = prompt_feat[i, :mel_len1[i]]
+            conds.append(cond)
+        mu = pad_sequence(mu, batch_first=True).transpose(1, 2).contiguous()
+        conds = pad_sequence(conds, batch_first=True).transpose(1, 2).contiguous()
+
+        mask = (~make_pad_mask(torch.tensor([a + b for a, b in zip(mel_len1, mel_len2)]))).to(mu)
+        feat, _ = self.decoder(
+            mu=mu,
+            mask=mask.unsqueeze(1),
+            spks=embedding,
+            cond=conds,
+            n_timesteps=n_timesteps,
+            solver=solver
+        )
+        return [feat[i:i + 1, :, mel_len1[i]:mel_len1[i] + mel_len2[i]] for i in range(batch_size)]
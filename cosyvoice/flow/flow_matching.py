@@ -29,12 +29,18 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # run conditional and unconditional estimator in one batch of 2 instead of two sequential calls
+        self.inference_cfg_batch = cfm_params.get('inference_cfg_batch', True)
+        # tolerance of adaptive step solvers
+        self.solver_atol = cfm_params.get('solver_atol', 1e-2)
+        self.solver_rtol = cfm_params.get('solver_rtol', 1e-2)
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2),
+                solver=None):
         """Forward diffusion
 
         Args:
@@ -47,6 +53,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): key of COSYVOICE_ODE_SOLVERS, None means the solver in cfm_params.
 
         Returns:
             sample: generated mel-spectrogram
@@ -66,7 +73,9 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        solver = self.solver if solver is None else solver
+        assert solver in COSYVOICE_ODE_SOLVERS, 'unknown ode solver {}, choose from {}'.format(solver, list(COSYVOICE_ODE_SOLVERS))
+        return COSYVOICE_ODE_SOLVERS[solver](self, z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
 
     def solve_euler(self, x, t_span, mu, mask, spks, cond):
         """
@@ -83,6 +92,7 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
+        velocity = self.velocity_fn(mu, mask, spks, cond)
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
         t = t.unsqueeze(dim=0)
 
@@ -91,17 +101,7 @@ class ConditionalCFM(BASECFM):
         sol = []
 
         for step in range(1, len(t_span)):
-            dphi_dt = self.forward_estimator(x, mask, mu, t, spks, cond)
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            if self.inference_cfg_rate > 0:
-                cfg_dphi_dt = self.forward_estimator(
-                    x, mask,
-                    torch.zeros_like(mu), t,
-                    torch.zeros_like(spks) if spks is not None else None,
-                    torch.zeros_like(cond)
-                )
-                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt -
-                           self.inference_cfg_rate * cfg_dphi_dt)
+            dphi_dt = velocity(x, t)
             x = x + dt * dphi_dt
             t = t + dt
             sol.append(x)
@@ -110,6 +110,101 @@ class ConditionalCFM(BASECFM):
 
         return sol[-1]
 
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond):
+        """
+        Fixed explicit midpoint solver, second order with 2 estimator calls per step.
+        Args are the same as solve_euler.
+        """
+        velocity = self.velocity_fn(mu, mask, spks, cond)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1].unsqueeze(dim=0), t_span[step] - t_span[step - 1]
+            x_mid = x + 0.5 * dt * velocity(x, t)
+            x = x + dt * velocity(x_mid, t + 0.5 * dt)
+        return x
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond):
+        """
+        Fixed heun solver (explicit trapezoidal), second order with 2 estimator calls per step.
+        Args are the same as solve_euler.
+        """
+        velocity = self.velocity_fn(mu, mask, spks, cond)
+        for step in range(1, len(t_span)):
+            t, dt = t_span[step - 1].unsqueeze(dim=0), t_span[step] - t_span[step - 1]
+            k1 = velocity(x, t)
+            k2 = velocity(x + dt * k1, t + dt)
+            x = x + 0.5 * dt * (k1 + k2)
+        return x
+
+    def solve_rk23(self, x, t_span, mu, mask, spks, cond):
+        """
+        Adaptive step Bogacki-Shampine solver, 3 estimator calls per accepted step.
+        The first step size is taken from t_span, so the cosine t_scheduler still decides
+        how carefully the start of the trajectory is treated, later steps are chosen by the
+        local error estimate against solver_atol/solver_rtol. At most 2 * n_timesteps steps are tried.
+        Args are the same as solve_euler.
+        """
+        velocity = self.velocity_fn(mu, mask, spks, cond)
+        t_end = float(t_span[-1])
+        t, dt = float(t_span[0]), float(t_span[1] - t_span[0])
+        max_steps = 2 * (len(t_span) - 1)
+        k1 = velocity(x, torch.tensor([t], device=x.device, dtype=x.dtype))
+        for step in range(max_steps):
+            # last allowed step always reaches t_end
+            dt = t_end - t if step == max_steps - 1 else min(dt, t_end - t)
+            k2 = velocity(x + 0.5 * dt * k1, torch.tensor([t + 0.5 * dt], device=x.device, dtype=x.dtype))
+            k3 = velocity(x + 0.75 * dt * k2, torch.tensor([t + 0.75 * dt], device=x.device, dtype=x.dtype))
+            x_new = x + dt * (2 / 9 * k1 + 1 / 3 * k2 + 4 / 9 * k3)
+            k4 = velocity(x_new, torch.tensor([t + dt], device=x.device, dtype=x.dtype))
+            err = dt * (-5 / 72 * k1 + 1 / 12 * k2 + 1 / 9 * k3 - 1 / 8 * k4)
+            scale = self.solver_atol + self.solver_rtol * torch.maximum(x.abs(), x_new.abs())
+            err_norm = float(((err / scale) ** 2 * mask).sum().float() / (mask.sum().float() * x.size(1))) ** 0.5
+            if err_norm <= 1 or step == max_steps - 1:
+                x, t, k1 = x_new, t + dt, k4
+                if t >= t_end - 1e-6:
+                    break
+            dt = dt * min(5.0, max(0.2, 0.9 * max(err_norm, 1e-10) ** (-1 / 3)))
+        return x
+
+    def velocity_fn(self, mu, mask, spks, cond):
+        """
+        Return f(x, t) which computes the classifier free guided flow dphi_dt, shared by all solvers.
+        """
+        if self.inference_cfg_rate > 0 and self.inference_cfg_batch is True:
+            # conditional input in the first half, unconditional input in the second half,
+            # only x and t change between calls, so the rest is stacked once
+            batch_size = mu.size(0)
+            x_in = torch.zeros([2 * batch_size, *mu.shape[1:]], device=mu.device, dtype=mu.dtype)
+            t_in = torch.zeros([2 * batch_size], device=mu.device, dtype=mu.dtype)
+            mask_in = torch.concat([mask, mask], dim=0)
+            mu_in = torch.concat([mu, torch.zeros_like(mu)], dim=0)
+            spks_in = torch.concat([spks, torch.zeros_like(spks)], dim=0) if spks is not None else None
+            cond_in = torch.concat([cond, torch.zeros_like(cond)], dim=0)
+
+        def velocity(x, t):
+            # Classifier-Free Guidance inference introduced in VoiceBox
+            if self.inference_cfg_rate > 0 and self.inference_cfg_batch is True:
+                x_in[:batch_size] = x
+                x_in[batch_size:] = x
+                t_in[:] = t
+                dphi_dt, cfg_dphi_dt = torch.split(self.forward_estimator(x_in, mask_in, mu_in, t_in, spks_in, cond_in),
+                                                   batch_size, dim=0)
+                dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt -
+                           self.inference_cfg_rate * cfg_dphi_dt)
+            else:
+                dphi_dt = self.forward_estimator(x, mask, mu, t, spks, cond)
+                if self.inference_cfg_rate > 0:
+                    cfg_dphi_dt = self.forward_estimator(
+                        x, mask,
+                        torch.zeros_like(mu), t,
+                        torch.zeros_like(spks) if spks is not None else None,
+                        torch.zeros_like(cond)
+                    )
+                    dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt -
+                               self.inference_cfg_rate * cfg_dphi_dt)
+            return dphi_dt
+
+        return velocity
+
     def forward_estimator(self, x, mask, mu, t, spks, cond):
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator.forward(x, mask, mu, t, spks, cond)
@@ -165,3 +260,12 @@ class ConditionalCFM(BASECFM):
         pred = self.estimator(y, mask, mu, t.squeeze(), spks, cond)
         loss = F.mse_loss(pred * mask, u * mask, reduction="sum") / (torch.sum(mask) * u.shape[1])
         return loss, y
+
+
+# every solver is called as solver(cfm, x, t_span, mu, mask, spks, cond), add new solvers here
+COSYVOICE_ODE_SOLVERS = {
+    'euler': ConditionalCFM.solve_euler,
+    'midpoint': ConditionalCFM.solve_midpoint,
+    'heun': ConditionalCFM.solve_heun,
+    'rk23': ConditionalCFM.solve_rk23,
+}
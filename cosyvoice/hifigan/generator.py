@@ -14,6 +14,7 @@
 
 """HIFI-GAN"""
 
+import math
 from typing import Dict, Optional, List
 import numpy as np
 from scipy.signal import get_window
@@ -135,9 +136,10 @@ class SineGen(torch.nn.Module):
         return uv
 
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, phase=None):
         """
         :param f0: [B, 1, sample_len], Hz
+        :param phase: [B, harmonic_num + 1, 1], initial phase in cycles, random harmonic phases if None
         :return: [B, 1, sample_len]
         """
 
@@ -145,10 +147,15 @@ class SineGen(torch.nn.Module):
         for i in range(self.harmonic_num + 1):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
+        if phase is not None:
+            # streaming continues the phase of the previous chunk
+            F_mat[:, :, :1] += phase
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
         u_dist = Uniform(low=-np.pi, high=np.pi)
         phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
         phase_vec[:, 0, :] = 0
+        if phase is not None:
+            phase_vec.zero_()
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
@@ -201,7 +208,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, phase=None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
@@ -210,7 +217,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), phase)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
@@ -244,6 +251,9 @@ class HiFTGenerator(nn.Module):
             lrelu_slope: float = 0.1,
             audio_limit: float = 0.99,
             f0_predictor: torch.nn.Module = None,
+            stream_context_len: Optional[int] = None,
+            stream_lookahead_len: Optional[int] = None,
+            stream_crossfade_len: int = 2,
     ):
         super(HiFTGenerator, self).__init__()
 
@@ -253,6 +263,10 @@ class HiFTGenerator(nn.Module):
         self.istft_params = istft_params
         self.lrelu_slope = lrelu_slope
         self.audio_limit = audio_limit
+        # streaming inference, mel frames of left context and look ahead, None means the receptive field, see inference_stream
+        self.stream_context_len = stream_context_len
+        self.stream_lookahead_len = stream_lookahead_len
+        self.stream_crossfade_len = stream_crossfade_len
 
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
@@ -313,8 +327,52 @@ class HiFTGenerator(nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        # stft and istft run as strided convolutions with windowed dft kernels, the buffers follow the module to its device
+        n_fft = istft_params["n_fft"]
+        stft_window = torch.from_numpy(get_window("hann", n_fft, fftbins=True).astype(np.float32))
+        angle = 2 * np.pi * torch.arange(n_fft // 2 + 1).unsqueeze(1) * torch.arange(n_fft).unsqueeze(0) / n_fft
+        # irfft counts every bin except dc and nyquist twice
+        scale = torch.full((n_fft // 2 + 1, 1), 2.0)
+        scale[0], scale[-1] = 1.0, 1.0
+        self.register_buffer('stft_window', stft_window, persistent=False)
+        self.register_buffer('stft_kernel', torch.concat([torch.cos(angle), -torch.sin(angle)], dim=0).mul(stft_window).unsqueeze(1),
+                             persistent=False)
+        self.register_buffer('istft_kernel', torch.concat([torch.cos(angle), -torch.sin(angle)], dim=0).mul(scale.repeat(2, 1) / n_fft)
+                             .mul(stft_window).unsqueeze(1), persistent=False)
         self.f0_predictor = f0_predictor
+        # onnxruntime session of decode, see load_onnx_decode
+        self.decode_session = None
+        if self.stream_context_len is None or self.stream_lookahead_len is None:
+            field = self.receptive_field()
+            self.stream_context_len = field if self.stream_context_len is None else self.stream_context_len
+            self.stream_lookahead_len = field if self.stream_lookahead_len is None else self.stream_lookahead_len
+        # periodic hann halves sum to one, fade out of the held back chunk tail plus fade in of the next chunk keeps the level
+        crossfade = torch.hann_window(2 * stream_crossfade_len * int(self.f0_upsamp.scale_factor), periodic=True)
+        self.register_buffer('stream_crossfade', crossfade, persistent=False)
+
+    def receptive_field(self) -> int:
+        """One sided receptive field of f0_predictor + decode in mel frames, rounded up.
+
+        Chunks vocoded with at least this many frames of left context and look ahead match offline vocoding.
+        """
+        def reach(module):
+            # convs of a module run one after another, so their one sided reaches add up
+            return sum(m.dilation[0] * (m.kernel_size[0] - 1) // 2 for m in module.modules() if isinstance(m, Conv1d))
+
+        frame_len = int(self.f0_upsamp.scale_factor)
+        half_window = self.istft_params["n_fft"] // 2 / frame_len
+        # the stft of the source runs at the rate of the last upsample
+        stft_rate = frame_len / self.istft_params["hop_len"]
+        field, rate = reach(self.conv_pre), 1
+        for i in range(self.num_upsamples):
+            field += self.ups[i].kernel_size[0] / 2 / self.ups[i].stride[0] / rate
+            rate *= self.ups[i].stride[0]
+            source = reach(self.f0_predictor) + half_window + self.source_downs[i].kernel_size[0] // 2 / stft_rate + \
+                reach(self.source_resblocks[i]) / rate
+            field = max(field, source) + max(reach(self.resblocks[i * self.num_kernels + j]) for j in range(self.num_kernels)) / rate
+        # reflection pad, conv_post and istft
+        field += 1 / rate + reach(self.conv_post) / rate + half_window
+        return math.ceil(field)
 
     def remove_weight_norm(self):
         print('Removing weight norm...')
@@ -331,20 +389,22 @@ class HiFTGenerator(nn.Module):
             l.remove_weight_norm()
 
     def _stft(self, x):
-        spec = torch.stft(
-            x,
-            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
-            return_complex=True)
-        spec = torch.view_as_real(spec)  # [B, F, TT, 2]
-        return spec[..., 0], spec[..., 1]
+        # same as torch.stft(center=True, window=hann), real and imaginary parts stacked on dim 1
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
+        x = F.pad(x.unsqueeze(1), (n_fft // 2, n_fft // 2), mode='reflect')
+        spec = F.conv1d(x, self.stft_kernel, stride=hop_len)  # [B, F * 2, TT]
+        return spec[:, :n_fft // 2 + 1], spec[:, n_fft // 2 + 1:]
 
     def _istft(self, magnitude, phase):
+        # same as torch.istft(center=True, window=hann), magnitude and phase go to waveform by one transposed convolution
+        n_fft, hop_len = self.istft_params["n_fft"], self.istft_params["hop_len"]
         magnitude = torch.clip(magnitude, max=1e2)
-        real = magnitude * torch.cos(phase)
-        img = magnitude * torch.sin(phase)
-        inverse_transform = torch.istft(torch.complex(real, img), self.istft_params["n_fft"], self.istft_params["hop_len"],
-                                        self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
-        return inverse_transform
+        spec = torch.cat([magnitude * torch.cos(phase), magnitude * torch.sin(phase)], dim=1)
+        x = F.conv_transpose1d(spec, self.istft_kernel, stride=hop_len)
+        # overlap add of the squared window
+        envelope = F.conv_transpose1d(torch.ones_like(spec[:1, :1]), self.stft_window.square().view(1, 1, -1), stride=hop_len)
+        x = x / envelope.clamp(min=1e-11)
+        return x[:, 0, n_fft // 2: -(n_fft // 2)]
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
@@ -374,12 +434,23 @@ class HiFTGenerator(nn.Module):
         x = F.leaky_relu(x)
         x = self.conv_post(x)
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
-        phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
+        phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy, but the model is trained with it
 
         x = self._istft(magnitude, phase)
         x = torch.clamp(x, -self.audio_limit, self.audio_limit)
         return x
 
+    def forward_decode(self, x: torch.Tensor, s: torch.Tensor) -> torch.Tensor:
+        if self.decode_session is None:
+            return self.decode(x=x, s=s)
+        ort_inputs = {'x': x.cpu().numpy(), 's': s.cpu().numpy()}
+        output = self.decode_session.run(None, ort_inputs)[0]
+        return torch.tensor(output, dtype=x.dtype, device=x.device)
+
+    def load_onnx_decode(self, decode_session):
+        """Run decode, including istft, with an onnxruntime session exported by cosyvoice/bin/export_onnx.py."""
+        self.decode_session = decode_session
+
     def forward(
             self,
             batch: dict,
@@ -407,5 +478,55 @@ class HiFTGenerator(nn.Module):
         # use cache_source to avoid glitch
         if cache_source.shape[2] != 0:
             s[:, :, :cache_source.shape[2]] = cache_source
-        generated_speech = self.decode(x=speech_feat, s=s)
+        generated_speech = self.forward_decode(x=speech_feat, s=s)
         return generated_speech, s
+
+    @torch.inference_mode()
+    def inference_stream(self, speech_feat: torch.Tensor, cache: Optional[Dict] = None, finalize: bool = False):
+        """Vocode the next chunk of mel frames of an utterance, cache carries state between chunks.
+
+        HiFT convolutions and f0_predictor are not causal, so cache keeps stream_context_len already vocoded frames
+        as left context and holds back the last stream_lookahead_len frames until their right context arrives. With
+        both at least receptive_field(), a chunk computes the same samples as offline vocoding. Sine source phase
+        continues from the last emitted sample, and the last stream_crossfade_len emitted frames are vocoded again
+        by the next chunk and crossfaded, which hides the random source noise that differs between chunks.
+        Pass cache=None with the first chunk and finalize=True with the last one.
+        Returns speech of the emitted frames and the new cache.
+        """
+        upsample_scale = int(self.f0_upsamp.scale_factor)
+        if cache is None:
+            # random harmonic phases like SineGen, fundamental starts at 0
+            phase = torch.rand(speech_feat.size(0), self.nb_harmonics + 1, 1, device=speech_feat.device)
+            phase[:, 0] = 0
+            cache = {'mel': speech_feat[:, :, :0], 'context_len': 0, 'phase': phase, 'tail': speech_feat.new_zeros(speech_feat.size(0), 0)}
+        mel = torch.concat([cache['mel'], speech_feat], dim=2)
+        context_len, tail = cache['context_len'], cache['tail']
+        if finalize is True:
+            emit_len = end_len = mel.shape[2]
+        else:
+            emit_len = mel.shape[2] - self.stream_lookahead_len
+            end_len = emit_len - self.stream_crossfade_len
+            if end_len < context_len + tail.shape[1] // upsample_scale:
+                # too few frames to cover the pending crossfade, wait for the next chunk
+                return speech_feat.new_zeros(speech_feat.size(0), 0), {**cache, 'mel': mel}
+        # mel->f0
+        f0 = self.f0_predictor(mel)
+        # sine cycles of every frame per harmonic, used to start the source so that the first emitted sample continues the last one
+        harmonics = torch.arange(1, self.nb_harmonics + 2, device=mel.device).view(1, -1, 1)
+        frame_cycles = f0[:, None] * harmonics * upsample_scale / self.sampling_rate
+        phase = cache['phase'] - frame_cycles[:, :, :context_len].sum(dim=2, keepdim=True)
+        # f0->source
+        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+        s, _, _ = self.m_source(s, phase)
+        s = s.transpose(1, 2)
+        generated_speech = self.forward_decode(x=mel, s=s)
+        tts_speech = generated_speech[:, context_len * upsample_scale: end_len * upsample_scale]
+        if tail.shape[1] != 0:
+            tts_speech[:, :tail.shape[1]] = tts_speech[:, :tail.shape[1]] * self.stream_crossfade[:tail.shape[1]] + \
+                tail * self.stream_crossfade[tail.shape[1]:]
+        next_context_len = min(end_len, self.stream_context_len)
+        cache = {'mel': mel[:, :, end_len - next_context_len:],
+                 'context_len': next_context_len,
+                 'phase': (cache['phase'] + frame_cycles[:, :, context_len:end_len].sum(dim=2, keepdim=True)) % 1,
+                 'tail': generated_speech[:, end_len * upsample_scale: emit_len * upsample_scale]}
+        return tts_speech, cache
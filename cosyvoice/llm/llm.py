@@ -11,7 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Dict, Optional, Callable, List, Generator
+from typing import Dict, Optional, Callable, List, Generator, Union
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -139,18 +139,20 @@ class TransformerLM(torch.nn.Module):
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
-            decoded_tokens: List,
+            decoded_tokens: Union[List, torch.Tensor],
             sampling: int,
-            ignore_eos: bool = True,
+            ignore_eos: Union[bool, List[bool]] = True,
     ):
-        while True:
-            top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
-            if (not ignore_eos) or (self.speech_token_size not in top_ids):
-                break
+        """Sample next token for weighted_scores (V,), or (B, V) with ignore_eos given per sequence.
+
+        eos is masked out of the distribution instead of resampled until it is not drawn.
+        """
+        ignore_mask = torch.zeros_like(weighted_scores, dtype=torch.bool)
+        ignore_mask[..., self.speech_token_size] = torch.as_tensor(ignore_eos, dtype=torch.bool, device=weighted_scores.device)
+        top_ids = self.sampling(weighted_scores, decoded_tokens, sampling, ignore_mask=ignore_mask)
         return top_ids
 
-    @torch.inference_mode()
-    def inference(
+    def prepare_inference_input(
             self,
             text: torch.Tensor,
             text_len: torch.Tensor,
@@ -159,10 +161,9 @@ class TransformerLM(torch.nn.Module):
             prompt_speech_token: torch.Tensor,
             prompt_speech_token_len: torch.Tensor,
             embedding: torch.Tensor,
-            sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
-    ) -> Generator[torch.Tensor, None, None]:
+    ):
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
         text_len += prompt_text_len
@@ -191,22 +192,88 @@ class TransformerLM(torch.nn.Module):
         # 4. cal min/max_length
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
+        return lm_input, min_len, max_len
+
+    @torch.inference_mode()
+    def inference(
+            self,
+            text: torch.Tensor,
+            text_len: torch.Tensor,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+            use_kv_cache: bool = True,
+    ) -> Generator[torch.Tensor, None, None]:
+        lm_input, min_len, max_len = self.prepare_inference_input(text, text_len, prompt_text, prompt_text_len,
+                                                                  prompt_speech_token, prompt_speech_token_len, embedding,
+                                                                  max_token_text_ratio, min_token_text_ratio)
 
         # 5. step by step decode
-        out_tokens = []
+        # decoded tokens stay on device, so sampling does not rebuild them every step
+        decoded_tokens = torch.zeros(max_len, dtype=torch.long, device=lm_input.device)
         offset = 0
-        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        # preallocated kv cache is written in place, jit llm does not export it and keeps the concat cache
+        if use_kv_cache is True and hasattr(self.llm, 'forward_chunk_kv_cache'):
+            kv_cache = self.llm.init_kv_cache(lm_input.shape[1] + max_len, dtype=lm_input.dtype, device=lm_input.device)
+            # causal mask is only needed for the first chunk, later chunk has one frame and attends to all valid cache
+            att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool)
+        else:
+            kv_cache = None
+            att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
         for i in range(max_len):
-            y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
-                                                                  att_cache=att_cache, cnn_cache=cnn_cache,
-                                                                  att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
-                                                                                                 device=lm_input.device)).to(torch.bool))
+            if kv_cache is not None:
+                y_pred = self.llm.forward_chunk_kv_cache(lm_input, offset, kv_cache, att_mask=att_mask)
+                att_mask = torch.ones((0, 0, 0), dtype=torch.bool)
+            else:
+                y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
+                                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                                      att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
+                                                                                                     device=lm_input.device)).to(torch.bool))
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False).item()
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), decoded_tokens[:i], sampling, ignore_eos=True if i < min_len else False)
+            decoded_tokens[i:i + 1] = top_ids
+            top_ids = top_ids.item()
             if top_ids == self.speech_token_size:
                 break
             # in stream mode, yield token one by one
             yield top_ids
-            out_tokens.append(top_ids)
             offset += lm_input.size(1)
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+
+    @torch.inference_mode()
+    def inference_prefill(self, lm_input: torch.Tensor):
+        """Run the whole llm_input of one sequence, used before it joins batched decoding.
+
+        Returns:
+            logp: log probability of the first speech token (1, speech_token_size + 1)
+            att_cache: attention cache (elayers, head, T, d_k * 2)
+        """
+        att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
+        y_pred, att_cache, _ = self.llm.forward_chunk(lm_input, offset=0, required_cache_size=-1,
+                                                      att_cache=att_cache, cnn_cache=cnn_cache,
+                                                      att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
+                                                                                     device=lm_input.device)).to(torch.bool))
+        logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        return logp, att_cache
+
+    @torch.inference_mode()
+    def inference_step_batch(self, top_ids: torch.Tensor, att_cache: torch.Tensor, att_mask: torch.Tensor):
+        """Decode one step for a batch of sequences with left padded attention cache.
+
+        Args:
+            top_ids: last decoded speech token of each sequence (B,)
+            att_cache: attention cache (elayers, B, head, T, d_k * 2)
+            att_mask: valid key mask (B, 1, T + 1)
+        Returns:
+            logp: log probability of next speech token (B, speech_token_size + 1)
+            att_cache: attention cache (elayers, B, head, T + 1, d_k * 2)
+        """
+        lm_input = self.speech_embedding.weight[top_ids].unsqueeze(dim=1)
+        y_pred, att_cache = self.llm.forward_chunk_batch(lm_input, att_cache=att_cache, att_mask=att_mask)
+        logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+        return logp, att_cache
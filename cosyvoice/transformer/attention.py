@@ -126,6 +126,47 @@ class MultiHeadedAttention(nn.Module):
 
         return self.linear_out(x)  # (batch, time1, d_model)
 
+    def update_cache(
+        self,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        cache: torch.Tensor,
+        cache_offset: int = -1
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Append current key and value to cache.
+
+        Args:
+            k (torch.Tensor): Transformed key (#batch, n_head, time1, d_k).
+            v (torch.Tensor): Transformed value (#batch, n_head, time1, d_k).
+            cache (torch.Tensor): Cache tensor (#batch, head, cache_t, d_k * 2).
+            cache_offset (int): <0 means cache only holds history and a new
+                cache is returned by concatenation. >=0 means cache is a
+                preallocated buffer whose first cache_offset frames are valid,
+                current key and value are written in place after them.
+
+        Returns:
+            torch.Tensor: Key to attend (#batch, n_head, time2, d_k).
+            torch.Tensor: Value to attend (#batch, n_head, time2, d_k).
+            torch.Tensor: New cache (#batch, head, time2, d_k * 2), or the
+                preallocated buffer itself when cache_offset >= 0.
+
+        """
+        if cache_offset >= 0:
+            end = cache_offset + k.size(2)
+            cache[:, :, cache_offset:end, :self.d_k] = k
+            cache[:, :, cache_offset:end, self.d_k:] = v
+            return cache[:, :, :end, :self.d_k], cache[:, :, :end, self.d_k:], cache
+        if cache.size(0) > 0:
+            key_cache, value_cache = torch.split(cache,
+                                                 cache.size(-1) // 2,
+                                                 dim=-1)
+            k = torch.cat([key_cache, k], dim=2)
+            v = torch.cat([value_cache, v], dim=2)
+        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
+        #   non-trivial to calculate `next_cache_start` here.
+        new_cache = torch.cat((k, v), dim=-1)
+        return k, v, new_cache
+
     def forward(
         self,
         query: torch.Tensor,
@@ -133,7 +174,8 @@ class MultiHeadedAttention(nn.Module):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute scaled dot product attention.
 
@@ -156,6 +198,8 @@ class MultiHeadedAttention(nn.Module):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_offset (int): valid length of a preallocated cache, <0 means
+                cache is not preallocated, see `update_cache`.
 
 
         Returns:
@@ -183,15 +227,7 @@ class MultiHeadedAttention(nn.Module):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        k, v, new_cache = self.update_cache(k, v, cache, cache_offset)
 
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
         return self.forward_attention(v, scores, mask), new_cache
@@ -253,7 +289,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         value: torch.Tensor,
         mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         pos_emb: torch.Tensor = torch.empty(0),
-        cache: torch.Tensor = torch.zeros((0, 0, 0, 0))
+        cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        cache_offset: int = -1
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Compute 'Scaled Dot Product Attention' with rel. positional encoding.
         Args:
@@ -267,6 +304,8 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
             cache (torch.Tensor): Cache tensor (1, head, cache_t, d_k * 2),
                 where `cache_t == chunk_size * num_decoding_left_chunks`
                 and `head * d_k == size`
+            cache_offset (int): valid length of a preallocated cache, <0 means
+                cache is not preallocated, see `update_cache`.
         Returns:
             torch.Tensor: Output tensor (#batch, time1, d_model).
             torch.Tensor: Cache tensor (1, head, cache_t + time1, d_k * 2)
@@ -292,15 +331,7 @@ class RelPositionMultiHeadedAttention(MultiHeadedAttention):
         # >>> torch.equal(b, c)        # True
         # >>> d = torch.split(a, 2, dim=-1)
         # >>> torch.equal(d[0], d[1])  # True
-        if cache.size(0) > 0:
-            key_cache, value_cache = torch.split(cache,
-                                                 cache.size(-1) // 2,
-                                                 dim=-1)
-            k = torch.cat([key_cache, k], dim=2)
-            v = torch.cat([value_cache, v], dim=2)
-        # NOTE(xcsong): We do cache slicing in encoder.forward_chunk, since it's
-        #   non-trivial to calculate `next_cache_start` here.
-        new_cache = torch.cat((k, v), dim=-1)
+        k, v, new_cache = self.update_cache(k, v, cache, cache_offset)
 
         n_batch_pos = pos_emb.size(0)
         p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
@@ -271,6 +271,128 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    @torch.jit.unused
+    def init_kv_cache(self, max_len: int, dtype: torch.dtype,
+                      device: torch.device) -> torch.Tensor:
+        """ Preallocate KEY & VALUE cache for forward_chunk_kv_cache
+
+        Returns:
+            torch.Tensor: zero cache with shape
+                (elayers, b=1, head, max_len, d_k * 2)
+        """
+        self_attn = self.encoders[0].self_attn
+        return torch.zeros((len(self.encoders), 1, self_attn.h, max_len,
+                            self_attn.d_k * 2),
+                           dtype=dtype,
+                           device=device)
+
+    @torch.jit.unused
+    def forward_chunk_kv_cache(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        kv_cache: torch.Tensor,
+        att_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> torch.Tensor:
+        """ Forward just one chunk with a preallocated KEY & VALUE cache
+
+        Same as forward_chunk with required_cache_size < 0, but key and value
+        of current chunk are written in place into kv_cache, so the history
+        is never copied again and the cost of each step does not grow with
+        the number of decoded frames.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b=1, time, mel-dim)
+            offset (int): number of valid frames in kv_cache, it equals to
+                current offset in encoder output time stamp
+            kv_cache (torch.Tensor): cache from init_kv_cache, with shape
+                (elayers, b=1, head, max_len, d_k * 2), updated in place
+            att_mask (torch.Tensor): mask with shape
+                (b=1, time, offset + time), (0, 0, 0) means fake mask, which
+                is enough when time == 1
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b=1, chunk_size, hidden-dim).
+
+        """
+        assert xs.size(0) == 1
+        assert offset + xs.size(1) <= kv_cache.size(3)
+        # tmp_masks is just for interface compatibility
+        tmp_masks = torch.ones(1,
+                               xs.size(1),
+                               device=xs.device,
+                               dtype=torch.bool)
+        tmp_masks = tmp_masks.unsqueeze(1)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, offset)
+        pos_emb = self.embed.position_encoding(offset=0,
+                                               size=offset + xs.size(1))
+        for i, layer in enumerate(self.encoders):
+            xs, _, _, _ = layer(xs,
+                                att_mask,
+                                pos_emb,
+                                att_cache=kv_cache[i],
+                                cache_offset=offset)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
+    @torch.jit.unused
+    def forward_chunk_batch(
+        self,
+        xs: torch.Tensor,
+        att_cache: torch.Tensor,
+        att_mask: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Forward one chunk for a batch of sequences with different history
+            length, used by continuous batching decode
+
+        Sequences are right aligned, shorter history is left padded in
+        att_cache and masked out by att_mask. Right aligned sequences share
+        the same relative positions, so this only works with relative (or no)
+        positional encoding, which is the case for TransformerLM.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b, chunk_size, dim)
+            att_cache (torch.Tensor): cache tensor for KEY & VALUE,
+                with shape (elayers, b, head, cache_t1, d_k * 2)
+            att_mask (torch.Tensor): valid key mask,
+                with shape (b, chunk_size, cache_t1 + chunk_size)
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b, chunk_size, hidden-dim).
+            torch.Tensor: new attention cache, with shape
+                (elayers, b, head, cache_t1 + chunk_size, d_k * 2)
+
+        """
+        # tmp_masks is just for interface compatibility
+        tmp_masks = torch.ones(xs.size(0),
+                               1,
+                               xs.size(1),
+                               device=xs.device,
+                               dtype=torch.bool)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, _ = self.embed(xs, tmp_masks, 0)
+        elayers, cache_t1 = att_cache.size(0), att_cache.size(3)
+        pos_emb = self.embed.position_encoding(offset=0,
+                                               size=cache_t1 + xs.size(1))
+        r_att_cache = []
+        for i, layer in enumerate(self.encoders):
+            xs, _, new_att_cache, _ = layer(
+                xs,
+                att_mask,
+                pos_emb,
+                att_cache=att_cache[i] if elayers > 0 else att_cache)
+            r_att_cache.append(new_att_cache)
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        r_att_cache = torch.stack(r_att_cache, dim=0)
+        return xs, r_att_cache
+
     @torch.jit.unused
     def forward_chunk_by_chunk(
         self,
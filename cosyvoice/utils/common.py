@@ -16,6 +16,7 @@
 """Unility functions for Transformer."""
 
 import random
+from functools import lru_cache
 from typing import List
 
 import numpy as np
@@ -106,44 +107,78 @@ def init_weights(m, mean=0.0, std=0.01):
 
 
 # Repetition Aware Sampling in VALL-E 2
-def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
-    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
-    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
-    if rep_num >= win_size * tau_r:
-        top_ids = random_sampling(weighted_scores, decoded_tokens, sampling)
+def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, ignore_mask=None):
+    """Sample next token for one sequence (V,) or a batch of sequences (B, V).
+
+    decoded_tokens is a list of previous tokens for one sequence, or a tensor
+    of previous tokens (B, T) padded with IGNORE_ID for a batch. Tokens marked
+    by ignore_mask are never sampled. Both nucleus and random samples are drawn
+    and selected by tensor ops, so there is no host sync in sampling.
+    """
+    top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k, ignore_mask=ignore_mask)
+    if not torch.is_tensor(decoded_tokens):
+        decoded_tokens = torch.tensor(decoded_tokens[-win_size:], dtype=torch.long, device=weighted_scores.device)
+    rep_num = (decoded_tokens[..., -win_size:] == top_ids).sum(dim=-1, keepdim=True)
+    random_ids = random_sampling(weighted_scores, decoded_tokens, sampling, ignore_mask=ignore_mask)
+    top_ids = torch.where(rep_num >= win_size * tau_r, random_ids, top_ids)
     return top_ids
 
 
-def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
-    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)]
+def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25, ignore_mask=None):
+    prob = weighted_scores.float().softmax(dim=-1)
+    sorted_value, sorted_idx = prob.topk(top_k, dim=-1)
+    # sampling both top-p and numbers, a token is kept if the probability before it is less than top_p
+    keep = (sorted_value.cumsum(dim=-1) - sorted_value) < top_p
+    if ignore_mask is not None:
+        ignored = ignore_mask.gather(-1, sorted_idx)
+        # in case all kept tokens are ignored, fall back to top_k tokens
+        keep = keep & ~ignored
+        keep = torch.where(keep.any(dim=-1, keepdim=True), keep, ~ignored)
+    sorted_value = sorted_value * keep
+    top_ids = sorted_idx.gather(-1, sorted_value.multinomial(1, replacement=True))
     return top_ids
 
 
-def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+def random_sampling(weighted_scores, decoded_tokens, sampling, ignore_mask=None):
+    prob = weighted_scores.float().softmax(dim=-1)
+    if ignore_mask is not None:
+        prob = prob.masked_fill(ignore_mask, 0)
+    top_ids = prob.multinomial(1, replacement=True)
     return top_ids
 
 
-def fade_in_out(fade_in_mel, fade_out_mel, window):
-    device = fade_in_mel.device
-    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
-    mel_overlap_len = int(window.shape[0] / 2)
-    fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
-        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel.to(device)
+@lru_cache(maxsize=None)
+def hamming_window(window_len: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Symmetric hamming window, same as np.hamming, built once per (length, device, dtype)."""
+    return torch.from_numpy(np.hamming(window_len)).to(device=device, dtype=dtype)
+
+
+def fade_in_out(fade_in_mel: torch.Tensor, fade_out_mel: torch.Tensor, window_len: int) -> torch.Tensor:
+    """Crossfade the head of fade_in_mel with the tail of fade_out_mel on their own device.
+
+    Args:
+        fade_in_mel (torch.Tensor): (..., T), its first window_len // 2 frames fade in
+        fade_out_mel (torch.Tensor): (..., T'), its last window_len // 2 frames fade out
+        window_len (int): length of the hamming window
+
+    Returns:
+        torch.Tensor: fade_in_mel with its head crossfaded, inputs are not modified
+    """
+    window = hamming_window(window_len, fade_in_mel.device, fade_in_mel.dtype)
+    overlap_len = window_len // 2
+    fade = fade_in_mel[..., :overlap_len] * window[:overlap_len] + fade_out_mel[..., -overlap_len:] * window[overlap_len:]
+    return torch.concat([fade, fade_in_mel[..., overlap_len:]], dim=-1)
+
+
+def length_batches(keys: List[str], key2len: dict, batch_size: int, max_pad_ratio: float) -> List[List[str]]:
+    """Group keys longest first, a batch ends at batch_size keys or when padding its shortest key would exceed max_pad_ratio."""
+    batches = []
+    for key in sorted(keys, key=lambda key: key2len[key], reverse=True):
+        if len(batches) != 0 and len(batches[-1]) < batch_size and key2len[batches[-1][0]] <= key2len[key] * (1 + max_pad_ratio):
+            batches[-1].append(key)
+        else:
+            batches.append([key])
+    return batches
 
 
 def set_all_random_seed(seed):
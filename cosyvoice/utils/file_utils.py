@@ -14,6 +14,8 @@
 # limitations under the License.
 
 import json
+import os
+from functools import lru_cache
 import torchaudio
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
@@ -45,3 +47,43 @@ def load_wav(wav, target_sr):
         assert sample_rate > target_sr, 'wav sample rate {} must be greater than {}'.format(sample_rate, target_sr)
         speech = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=target_sr)(speech)
     return speech
+
+
+@lru_cache(maxsize=None)
+def get_resampler(orig_freq, new_freq):
+    # Resample builds its kernel in __init__, share one per rate pair
+    return torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+
+
+def truncate_torn_line(path):
+    """Cut a torn last line left by a crash, appending after it would glue the next record to it."""
+    with open(path, 'rb+') as f:
+        end = pos = f.seek(0, os.SEEK_END)
+        # search the last newline backwards block by block, the file can be large
+        while pos > 0:
+            start = max(pos - 2 ** 16, 0)
+            f.seek(start)
+            block = f.read(pos - start)
+            if b'\n' in block:
+                pos = start + block.rfind(b'\n') + 1
+                break
+            pos = start
+        if pos != end:
+            logging.warning('drop torn last line of {}'.format(path))
+            f.truncate(pos)
+
+
+def read_jsonl_checkpoint(path):
+    """Read the [key, value] lines an extraction tool appended to path, so a restarted run can skip them."""
+    results = {}
+    if os.path.exists(path):
+        truncate_torn_line(path)
+        with open(path, 'r', encoding='utf8') as fin:
+            for line in fin:
+                try:
+                    key, value = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning('drop broken line in {}'.format(path))
+                    continue
+                results[key] = value
+    return results
@@ -62,17 +62,18 @@ def spell_out_number(text: str, inflect_parser):
 # 2. cal sentence len according to lang
 # 3. split sentence according to puncatation
 def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False):
+    # the merge loop below asks for the length of the same text more than once, only tokenize it once
+    token_len_cache = {}
+
     def calc_utt_length(_text: str):
         if lang == "zh":
             return len(_text)
-        else:
-            return len(tokenize(_text))
+        if _text not in token_len_cache:
+            token_len_cache[_text] = len(tokenize(_text))
+        return token_len_cache[_text]
 
     def should_merge(_text: str):
-        if lang == "zh":
-            return len(_text) < merge_len
-        else:
-            return len(tokenize(_text)) < merge_len
+        return calc_utt_length(_text) < merge_len
 
     if lang == "zh":
         pounc = ['。', '？', '！', '；', '：', '、', '.', '?', '!', ';']
@@ -0,0 +1,63 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import functools
+import threading
+import time
+from collections import deque
+from contextlib import closing
+import numpy as np
+
+
+class LatencyStats:
+    """Thread safe latency recorder, keeps the total count and the last `window` values in seconds."""
+
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.values = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, value: float):
+        with self.lock:
+            self.values.append(value)
+            self.count += 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            values = np.array(self.values)
+            count = self.count
+        if len(values) == 0:
+            return {'count': count}
+        return {'count': count,
+                'mean_ms': float(values.mean() * 1000),
+                'p50_ms': float(np.percentile(values, 50) * 1000),
+                'p90_ms': float(np.percentile(values, 90) * 1000),
+                'p99_ms': float(np.percentile(values, 99) * 1000),
+                'max_ms': float(values.max() * 1000)}
+
+    def __str__(self):
+        return ' '.join('{} {:.1f}'.format(k, v) if isinstance(v, float) else '{} {}'.format(k, v) for k, v in self.summary().items())
+
+
+def track_stream_latency(func):
+    """Decorator for chunk generator methods, records time to first chunk into self.first_chunk_latency
+    and gaps between chunks into self.chunk_gap_latency. Time spent by the consumer is not counted."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start_time = time.time()
+        with closing(func(self, *args, **kwargs)) as model_output:
+            for i, output in enumerate(model_output):
+                (self.chunk_gap_latency if i != 0 else self.first_chunk_latency).add(time.time() - start_time)
+                yield output
+                start_time = time.time()
+    return wrapper
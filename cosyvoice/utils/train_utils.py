@@ -52,8 +52,16 @@ def init_distributed(args):
 
 def init_dataset_and_dataloader(args, configs, gan):
     data_pipeline = configs['data_pipeline_gan'] if gan is True else configs['data_pipeline']
-    train_dataset = Dataset(args.train_data, data_pipeline=data_pipeline, mode='train', gan=gan, shuffle=True, partition=True)
-    cv_dataset = Dataset(args.cv_data, data_pipeline=data_pipeline, mode='train', gan=gan, shuffle=False, partition=False)
+    bucket_conf = None
+    if args.bucket is True:
+        # gan train truncates every utt to the same length, bucketing does not help there
+        assert gan is False, 'bucket sampler is not for gan train'
+        assert args.feat_cache is True, 'bucket sampler needs --feat_cache, run tools/make_feat_cache.py first'
+        data_pipeline, bucket_conf = configs['data_pipeline_bucket'], configs['bucket_conf']
+    train_dataset = Dataset(args.train_data, data_pipeline=data_pipeline, mode='train', gan=gan, shuffle=True, partition=True,
+                            feat_cache=args.feat_cache, bucket_conf=bucket_conf)
+    cv_dataset = Dataset(args.cv_data, data_pipeline=data_pipeline, mode='train', gan=gan, shuffle=False, partition=False,
+                         feat_cache=args.feat_cache, bucket_conf=bucket_conf)
 
     # do not use persistent_workers=True, as whisper tokenizer opens tiktoken file each time when the for loop starts
     train_data_loader = DataLoader(train_dataset,
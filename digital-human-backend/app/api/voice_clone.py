@@ -25,9 +25,16 @@ class CloneTaskRequest(BaseModel):
     """克隆任务请求"""
     text: str
     prompt_text: Optional[str] = None
-    reference_audio_id: str
+    reference_audio_id: Optional[str] = None  # zero_shot模式使用已注册音色时可不传
     mode: str = "zero_shot"  # zero_shot, cross_lingual, vc, sft
-    speaker_id: Optional[str] = None  # SFT模式需要
+    speaker_id: Optional[str] = None  # SFT模式需要，zero_shot模式可传已注册的音色ID
+
+
+class RegisterVoiceRequest(BaseModel):
+    """注册音色请求"""
+    speaker_id: str
+    prompt_text: str
+    reference_audio_id: str
 
 
 def process_voice_clone_task(task_id: str, task_data: dict):
@@ -36,10 +43,13 @@ def process_voice_clone_task(task_id: str, task_data: dict):
         tasks[task_id]["status"] = "processing"
         tasks[task_id]["updated_at"] = datetime.now()
         
-        # 获取参考音频路径
-        reference_audio_path = settings.UPLOAD_AUDIO_DIR / task_data["reference_audio_id"]
-        if not reference_audio_path.exists():
-            raise FileNotFoundError(f"参考音频不存在: {reference_audio_path}")
+        # 获取参考音频路径，zero_shot模式使用已注册音色时不需要
+        use_registered_voice = task_data["mode"] == "zero_shot" and bool(task_data.get("speaker_id"))
+        reference_audio_path = None
+        if not use_registered_voice:
+            reference_audio_path = settings.UPLOAD_AUDIO_DIR / (task_data["reference_audio_id"] or "")
+            if not task_data["reference_audio_id"] or not reference_audio_path.exists():
+                raise FileNotFoundError(f"参考音频不存在: {reference_audio_path}")
         
         # 生成输出文件名
         output_filename = f"clone_{task_id}.wav"
@@ -55,7 +65,8 @@ def process_voice_clone_task(task_id: str, task_data: dict):
                 text=text,
                 prompt_text=prompt_text,
                 reference_audio_path=reference_audio_path,
-                output_path=output_path
+                output_path=output_path,
+                speaker_id=task_data.get("speaker_id") if use_registered_voice else None
             )
         elif mode == "cross_lingual":
             voice_clone_service.cross_lingual_clone(
@@ -110,10 +121,10 @@ async def create_clone_task(
     - sft: SFT模式（使用预训练说话人，需要speaker_id）
     """
     try:
-        # 验证参考音频是否存在
-        reference_audio_path = settings.UPLOAD_AUDIO_DIR / request.reference_audio_id
-        if not reference_audio_path.exists():
-            raise HTTPException(status_code=404, detail="参考音频文件不存在")
+        # 验证参考音频是否存在，zero_shot模式使用已注册音色时不需要
+        if not (request.mode == "zero_shot" and request.speaker_id):
+            if not request.reference_audio_id or not (settings.UPLOAD_AUDIO_DIR / request.reference_audio_id).exists():
+                raise HTTPException(status_code=404, detail="参考音频文件不存在")
         
         # 创建任务
         task_id = uuid.uuid4().hex[:16]
@@ -162,6 +173,27 @@ async def get_clone_task(task_id: str):
     )
 
 
+@router.post("/register")
+async def register_voice(request: RegisterVoiceRequest):
+    """注册音色：提取一次参考音频特征并持久化，之后zero_shot/sft模式可直接用speaker_id"""
+    reference_audio_path = settings.UPLOAD_AUDIO_DIR / request.reference_audio_id
+    if not reference_audio_path.exists():
+        raise HTTPException(status_code=404, detail="参考音频文件不存在")
+    try:
+        speaker_id = voice_clone_service.register_voice(
+            speaker_id=request.speaker_id,
+            prompt_text=request.prompt_text,
+            reference_audio_path=reference_audio_path
+        )
+        return {
+            "success": True,
+            "speaker_id": speaker_id
+        }
+    except Exception as e:
+        logger.error(f"注册音色失败: {e}")
+        raise HTTPException(status_code=500, detail=f"注册失败: {str(e)}")
+
+
 @router.get("/speakers")
 async def get_available_speakers():
     """获取可用说话人列表（SFT模式）"""
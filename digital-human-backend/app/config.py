@@ -33,6 +33,9 @@ class Settings:
     OUTPUT_LIP_SYNC_DIR: Path = OUTPUT_DIR / "lip_sync"
     OUTPUT_TRAINING_DIR: Path = OUTPUT_DIR / "training"
     
+    # 已注册音色目录（持久化的说话人特征，可按ID复用）
+    VOICE_REGISTRY_DIR: Path = BASE_DIR / "voices"
+
     # 文件大小限制 (MB)
     MAX_AUDIO_SIZE: int = 100  # 100MB
     MAX_VIDEO_SIZE: int = 500  # 500MB
@@ -68,6 +71,7 @@ class Settings:
             cls.OUTPUT_VOICE_CLONE_DIR,
             cls.OUTPUT_LIP_SYNC_DIR,
             cls.OUTPUT_TRAINING_DIR,
+            cls.VOICE_REGISTRY_DIR,
         ]
         for directory in directories:
             directory.mkdir(parents=True, exist_ok=True)
@@ -57,7 +57,8 @@ class VoiceCloneService:
                 model_path,
                 load_jit=True,
                 load_onnx=False,
-                fp16=True
+                fp16=True,
+                spk_registry_dir=str(settings.VOICE_REGISTRY_DIR)
             )
             self.model_loaded = True
             logger.info("CosyVoice模型加载成功")
@@ -65,13 +66,43 @@ class VoiceCloneService:
             logger.error(f"加载CosyVoice模型失败: {e}")
             raise
     
+    def register_voice(
+        self,
+        speaker_id: str,
+        prompt_text: str,
+        reference_audio_path: Path
+    ) -> str:
+        """
+        注册音色：只提取一次参考音频的特征并持久化，之后可按speaker_id直接使用
+
+        Args:
+            speaker_id: 音色ID，已存在时覆盖
+            prompt_text: 参考音频对应的文本
+            reference_audio_path: 参考音频路径
+
+        Returns:
+            音色ID
+        """
+        if not self.model_loaded:
+            self.load_model()
+
+        try:
+            prompt_speech_16k = load_wav(str(reference_audio_path), 16000)
+            self.cosyvoice.add_zero_shot_spk(prompt_text, prompt_speech_16k, speaker_id)
+            logger.info(f"注册音色成功: {speaker_id}")
+            return speaker_id
+        except Exception as e:
+            logger.error(f"注册音色失败: {e}")
+            raise
+
     def zero_shot_clone(
         self,
         text: str,
         prompt_text: str,
-        reference_audio_path: Path,
+        reference_audio_path: Optional[Path],
         output_path: Path,
-        stream: bool = False
+        stream: bool = False,
+        speaker_id: Optional[str] = None
     ) -> Path:
         """
         Zero-shot语音克隆
@@ -79,8 +110,9 @@ class VoiceCloneService:
         Args:
             text: 要合成的文本
             prompt_text: 提示文本
-            reference_audio_path: 参考音频路径
+            reference_audio_path: 参考音频路径，使用已注册音色时可为None
             output_path: 输出音频路径
+            speaker_id: 已注册的音色ID，指定后不再从参考音频提取特征
         
         Returns:
             输出音频路径
@@ -89,16 +121,17 @@ class VoiceCloneService:
             self.load_model()
         
         try:
-            # 加载参考音频（16kHz）
-            prompt_speech_16k = load_wav(str(reference_audio_path), 16000)
+            # 已注册音色直接复用持久化的特征，否则加载参考音频（16kHz）
+            prompt_speech_16k = load_wav(str(reference_audio_path), 16000) if not speaker_id else None
             
             # 执行推理
             logger.info(f"开始zero-shot语音克隆: {text[:50]}...")
             output_generator = self.cosyvoice.inference_zero_shot(
                 text,
-                prompt_text,
+                prompt_text or '',
                 prompt_speech_16k,
-                stream=stream
+                stream=stream,
+                zero_shot_spk_id=speaker_id or ''
             )
             
             # 保存输出
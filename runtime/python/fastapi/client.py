@@ -24,12 +24,14 @@ def main():
     if args.mode == 'sft':
         payload = {
             'tts_text': args.tts_text,
+            'response_format': args.response_format,
             'spk_id': args.spk_id
         }
         response = requests.request("GET", url, data=payload, stream=True)
     elif args.mode == 'zero_shot':
         payload = {
             'tts_text': args.tts_text,
+            'response_format': args.response_format,
             'prompt_text': args.prompt_text
         }
         files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
@@ -37,12 +39,14 @@ def main():
     elif args.mode == 'cross_lingual':
         payload = {
             'tts_text': args.tts_text,
+            'response_format': args.response_format,
         }
         files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
         response = requests.request("GET", url, data=payload, files=files, stream=True)
     else:
         payload = {
             'tts_text': args.tts_text,
+            'response_format': args.response_format,
             'spk_id': args.spk_id,
             'instruct_text': args.instruct_text
         }
@@ -50,6 +54,11 @@ def main():
     tts_audio = b''
     for r in response.iter_content(chunk_size=16000):
         tts_audio += r
+    if args.response_format != 'pcm':
+        logging.info('save response to {}'.format(args.tts_wav))
+        with open(args.tts_wav, 'wb') as f:
+            f.write(tts_audio)
+        return
     tts_speech = torch.from_numpy(np.array(np.frombuffer(tts_audio, dtype=np.int16))).unsqueeze(dim=0)
     logging.info('save response to {}'.format(args.tts_wav))
     torchaudio.save(args.tts_wav, tts_speech, target_sr)
@@ -87,6 +96,10 @@ if __name__ == "__main__":
     parser.add_argument('--tts_wav',
                         type=str,
                         default='demo.wav')
+    parser.add_argument('--response_format',
+                        default='pcm',
+                        choices=['pcm', 'wav', 'opus'],
+                        help='wav and opus responses are saved as they are, use demo.ogg for opus')
     args = parser.parse_args()
     prompt_sr, target_sr = 16000, 22050
     main()
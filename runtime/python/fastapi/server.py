@@ -13,10 +13,16 @@
 # limitations under the License.
 import os
 import sys
+import io
+import struct
 import argparse
+import asyncio
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import closing
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-from fastapi import FastAPI, UploadFile, Form, File
+from fastapi import FastAPI, UploadFile, Form, File, HTTPException
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
@@ -25,6 +31,7 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.cli.replica import ReplicaPool, core_sets
 from cosyvoice.utils.file_utils import load_wav
 
 app = FastAPI()
@@ -37,36 +44,154 @@ app.add_middleware(
     allow_headers=["*"])
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+class PcmEncoder:
+    media_type = 'audio/L16; rate=22050; channels=1'
+
+    def encode(self, tts_speech):
+        return (tts_speech.numpy() * (2 ** 15)).astype(np.int16).tobytes()
+
+    def flush(self):
+        return b''
+
+
+class WavEncoder(PcmEncoder):
+    """16 bit mono wav, total length is unknown while streaming so the riff and data sizes are set to the maximum."""
+    media_type = 'audio/wav'
+
+    def __init__(self, sample_rate=22050):
+        self.header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 0xFFFFFFFF, b'WAVE', b'fmt ', 16, 1, 1,
+                                  sample_rate, sample_rate * 2, 2, 16, b'data', 0xFFFFFFFF)
+
+    def encode(self, tts_speech):
+        header, self.header = self.header, b''
+        return header + super().encode(tts_speech)
+
+
+class OpusEncoder:
+    """Ogg opus, pyav resamples 22050 to the 48000 of opus and cuts frames, every chunk returns the pages ready so far."""
+    media_type = 'audio/ogg'
+
+    def __init__(self, sample_rate=22050):
+        import av
+        self.av = av
+        self.sample_rate = sample_rate
+        self.buffer = io.BytesIO()
+        self.container = av.open(self.buffer, mode='w', format='ogg')
+        self.stream = self.container.add_stream('libopus', rate=48000)
+        self.stream.codec_context.layout = 'mono'
+
+    def encode(self, tts_speech):
+        frame = self.av.AudioFrame.from_ndarray((tts_speech.numpy() * (2 ** 15)).astype(np.int16), format='s16', layout='mono')
+        frame.sample_rate = self.sample_rate
+        self.container.mux(self.stream.encode(frame))
+        return self.read()
+
+    def flush(self):
+        self.container.mux(self.stream.encode(None))
+        self.container.close()
+        return self.read()
+
+    def read(self):
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+RESPONSE_ENCODERS = {'pcm': PcmEncoder, 'wav': WavEncoder, 'opus': OpusEncoder}
+
+
+class ChunkBridge:
+    """Run a synchronous model_output generator in the worker pool and hand its chunks to the event loop.
+
+    At most queue_size chunks wait in the queue, the worker blocks when the client reads slower than synthesis.
+    When the client goes away the worker stops at its next chunk and closes the generator, which cancels llm decoding.
+    """
+
+    def __init__(self, loop, queue_size):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.cancelled = threading.Event()
+
+    def produce(self, inference, *inference_args):
+        if self.cancelled.is_set():
+            return
+        try:
+            with closing(inference(*inference_args, stream=True)) as model_output:
+                for i in model_output:
+                    if self.put(i['tts_speech']) is False:
+                        return
+        except Exception as e:
+            logging.exception('inference failed')
+            self.put(e)
+            return
+        self.put(None)
+
+    def put(self, item):
+        # queue.put only resolves when there is room, poll so that a cancelled request never blocks the worker
+        future = asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop)
+        while not self.cancelled.is_set():
+            try:
+                future.result(timeout=0.1)
+                return True
+            except TimeoutError:
+                continue
+        future.cancel()
+        return False
+
+    async def stream(self, encoder, inference, *inference_args):
+        self.loop.run_in_executor(executor, self.produce, inference, *inference_args)
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield encoder.encode(item)
+            yield encoder.flush()
+        finally:
+            # normal end, error or client disconnect, the worker stops at its next chunk in the latter two cases
+            self.cancelled.set()
+
+
+def stream_response(response_format, inference, *inference_args):
+    if response_format not in RESPONSE_ENCODERS:
+        raise HTTPException(status_code=400, detail='unknown response_format {}, choose from {}'.format(response_format, list(RESPONSE_ENCODERS)))
+    encoder = RESPONSE_ENCODERS[response_format]()
+    bridge = ChunkBridge(asyncio.get_running_loop(), args.queue_size)
+    return StreamingResponse(bridge.stream(encoder, inference, *inference_args), media_type=encoder.media_type)
 
 
 @app.get("/inference_sft")
-async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+async def inference_sft(tts_text: str = Form(), spk_id: str = Form(), response_format: str = Form('pcm')):
+    return stream_response(response_format, cosyvoice.inference_sft, tts_text, spk_id)
 
 
 @app.get("/inference_zero_shot")
-async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File(),
+                              response_format: str = Form('pcm')):
+    prompt_speech_16k = load_wav(io.BytesIO(await prompt_wav.read()), 16000)
+    return stream_response(response_format, cosyvoice.inference_zero_shot, tts_text, prompt_text, prompt_speech_16k)
 
 
 @app.get("/inference_cross_lingual")
-async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File(), response_format: str = Form('pcm')):
+    prompt_speech_16k = load_wav(io.BytesIO(await prompt_wav.read()), 16000)
+    return stream_response(response_format, cosyvoice.inference_cross_lingual, tts_text, prompt_speech_16k)
 
 
 @app.get("/inference_instruct")
-async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form(), response_format: str = Form('pcm')):
+    return stream_response(response_format, cosyvoice.inference_instruct, tts_text, spk_id, instruct_text)
+
+
+@app.get("/metrics")
+async def metrics():
+    if isinstance(cosyvoice, ReplicaPool):
+        return {'replica_load': [replica.load for replica in cosyvoice.replicas]}
+    return {'first_chunk_latency': cosyvoice.first_chunk_latency.summary(),
+            'chunk_gap_latency': cosyvoice.chunk_gap_latency.summary()}
 
 
 if __name__ == '__main__':
@@ -74,10 +199,33 @@ if __name__ == '__main__':
     parser.add_argument('--port',
                         type=int,
                         default=50000)
+    parser.add_argument('--max_conc',
+                        type=int,
+                        default=4,
+                        help='requests synthesized at the same time, more requests wait for a free worker')
+    parser.add_argument('--num_replicas',
+                        type=int,
+                        default=1,
+                        help='model replicas in separate processes, max_conc requests run in each')
+    parser.add_argument('--cores_per_replica',
+                        type=int,
+                        default=0,
+                        help='pin every replica to its own cores, 0 means no pinning')
+    parser.add_argument('--queue_size',
+                        type=int,
+                        default=8,
+                        help='audio chunks buffered per request before synthesis waits for the client')
     parser.add_argument('--model_dir',
                         type=str,
                         default='iic/CosyVoice-300M',
                         help='local path or modelscope repo id')
     args = parser.parse_args()
-    cosyvoice = CosyVoice(args.model_dir)
+    if args.num_replicas > 1:
+        # one model per process, requests are routed to the least loaded replica
+        cosyvoice = ReplicaPool(args.model_dir, args.num_replicas,
+                                core_sets(args.num_replicas, args.cores_per_replica) if args.cores_per_replica > 0 else None,
+                                max_conc=args.max_conc)
+    else:
+        cosyvoice = CosyVoice(args.model_dir)
+    executor = ThreadPoolExecutor(max_workers=args.max_conc * max(args.num_replicas, 1))
     uvicorn.run(app, host="0.0.0.0", port=args.port)
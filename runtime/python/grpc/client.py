@@ -60,7 +60,9 @@ def main():
             instruct_request.instruct_text = args.instruct_text
             request.instruct_request.CopyFrom(instruct_request)
 
-        response = stub.Inference(request)
+        # priority 0 is interactive and 1 is batch, unset lets the server decide by text length
+        metadata = [('priority', str(args.priority))] if args.priority is not None else None
+        response = stub.Inference(request, timeout=args.timeout, metadata=metadata)
         tts_audio = b''
         for r in response:
             tts_audio += r.tts_audio
@@ -78,6 +80,14 @@ if __name__ == "__main__":
     parser.add_argument('--port',
                         type=int,
                         default='50000')
+    parser.add_argument('--priority',
+                        type=int,
+                        default=None,
+                        help='0 for interactive, 1 for batch requests')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=None,
+                        help='deadline in seconds, the server drops the request after it')
     parser.add_argument('--mode',
                         default='sft',
                         choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
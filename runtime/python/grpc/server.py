@@ -13,7 +13,12 @@
 # limitations under the License.
 import os
 import sys
+import time
+import heapq
+import itertools
+import threading
 from concurrent import futures
+from contextlib import closing
 import argparse
 import cosyvoice_pb2
 import cosyvoice_pb2_grpc
@@ -26,47 +31,183 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.cli.replica import ReplicaPool, core_sets
+from cosyvoice.utils.metrics import LatencyStats
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 
+class AdmissionError(Exception):
+
+    def __init__(self, code, details):
+        super().__init__(details)
+        self.code = code
+        self.details = details
+
+
+class AdmissionQueue:
+    """Priority and deadline aware admission in front of the model.
+
+    At most max_active requests synthesize at the same time, the others wait ordered by
+    (priority, deadline, arrival), so interactive requests overtake queued batch jobs and
+    requests of the same priority are served earliest deadline first. A waiting request
+    leaves when its deadline passes, and when more than max_queue requests wait, the least
+    urgent one, possibly the new request itself, is shed so the client can retry elsewhere.
+    """
+
+    def __init__(self, max_active, max_queue):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.cond = threading.Condition()
+        # entries are [priority, deadline, seq, state], seq is unique so state is never compared
+        self.heap = []
+        self.active = 0
+        self.seq = itertools.count()
+        self.wait_latency = LatencyStats()
+        self.shed = 0
+        self.expired = 0
+
+    def acquire(self, priority, deadline=None):
+        """Block until admitted and return the wait time in seconds, raise AdmissionError if shed or expired."""
+        start_time = time.time()
+        entry = [priority, float('inf') if deadline is None else deadline, next(self.seq), 'waiting']
+        with self.cond:
+            heapq.heappush(self.heap, entry)
+            self.dispatch()
+            if len(self.heap) > self.max_queue:
+                worst = max(self.heap)
+                self.remove(worst, 'shed')
+                self.shed += 1
+            while entry[3] == 'waiting':
+                timeout = entry[1] - time.time()
+                if timeout <= 0:
+                    self.remove(entry, 'expired')
+                    self.expired += 1
+                    break
+                self.cond.wait(None if timeout == float('inf') else timeout)
+        if entry[3] == 'shed':
+            raise AdmissionError(grpc.StatusCode.RESOURCE_EXHAUSTED, 'server overloaded, retry later')
+        if entry[3] == 'expired':
+            raise AdmissionError(grpc.StatusCode.DEADLINE_EXCEEDED, 'deadline exceeded while queued')
+        self.wait_latency.add(time.time() - start_time)
+        return time.time() - start_time
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.dispatch()
+
+    def dispatch(self):
+        # caller holds self.cond
+        while self.active < self.max_active and len(self.heap) != 0:
+            heapq.heappop(self.heap)[3] = 'admitted'
+            self.active += 1
+        self.cond.notify_all()
+
+    def remove(self, entry, state):
+        # caller holds self.cond
+        self.heap.remove(entry)
+        heapq.heapify(self.heap)
+        entry[3] = state
+        self.cond.notify_all()
+
+    def __str__(self):
+        return 'active {} queued {} shed {} expired {} wait {}'.format(self.active, len(self.heap), self.shed, self.expired, self.wait_latency)
+
+
 class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
     def __init__(self, args):
-        self.cosyvoice = CosyVoice(args.model_dir)
+        # jit llm does not support batched decode, use eager llm when continuous batching is enabled
+        cosyvoice_kwargs = {'load_jit': args.llm_batch_size == 1, 'llm_batch_size': args.llm_batch_size, 'backend': args.backend,
+                            'intra_op_threads': args.intra_op_threads, 'inter_op_threads': args.inter_op_threads}
+        if args.num_replicas > 1:
+            # one model per process, requests are routed to the least loaded replica
+            self.cosyvoice = ReplicaPool(args.model_dir, args.num_replicas,
+                                         core_sets(args.num_replicas, args.cores_per_replica) if args.cores_per_replica > 0 else None,
+                                         max_conc=args.max_conc, **cosyvoice_kwargs)
+        else:
+            self.cosyvoice = CosyVoice(args.model_dir, **cosyvoice_kwargs)
+        self.stream = args.stream
+        self.admission = AdmissionQueue(args.max_conc * max(args.num_replicas, 1), args.max_queue)
+        self.interactive_max_chars = args.interactive_max_chars
         logging.info('grpc service initialized')
 
+    def priority(self, request, context):
+        """0 for interactive and 1 for batch requests, the client can set it with the priority metadata."""
+        metadata = dict(context.invocation_metadata())
+        if 'priority' in metadata:
+            try:
+                return int(metadata['priority'])
+            except ValueError:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'priority metadata must be an integer, got {}'.format(metadata['priority']))
+        tts_text = getattr(request, request.WhichOneof('RequestPayload')).tts_text
+        return 0 if len(tts_text) <= self.interactive_max_chars else 1
+
     def Inference(self, request, context):
+        # deadline set by the client, time_remaining is None without one
+        time_remaining = context.time_remaining()
+        deadline = None if time_remaining is None else time.time() + time_remaining
+        priority = self.priority(request, context)
+        try:
+            wait_time = self.admission.acquire(priority, deadline)
+        except AdmissionError as e:
+            logging.warning('request of priority {} rejected, {}, {}'.format(priority, e.details, self.admission))
+            context.abort(e.code, e.details)
+        context.set_trailing_metadata((('queue-wait-ms', '{:.1f}'.format(wait_time * 1000)),
+                                       ('queue-depth', str(len(self.admission.heap)))))
+        try:
+            yield from self.synthesize(request, context)
+        finally:
+            self.admission.release()
+            logging.info('admission {}'.format(self.admission))
+
+    def synthesize(self, request, context):
         if request.HasField('sft_request'):
             logging.info('get sft inference request')
-            model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id)
+            model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id, stream=self.stream)
         elif request.HasField('zero_shot_request'):
             logging.info('get zero_shot inference request')
             prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.zero_shot_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
             prompt_speech_16k = prompt_speech_16k.float() / (2**15)
             model_output = self.cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text,
                                                               request.zero_shot_request.prompt_text,
-                                                              prompt_speech_16k)
+                                                              prompt_speech_16k,
+                                                              stream=self.stream)
         elif request.HasField('cross_lingual_request'):
             logging.info('get cross_lingual inference request')
             prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.cross_lingual_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
             prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k)
+            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k, stream=self.stream)
         else:
             logging.info('get instruct inference request')
             model_output = self.cosyvoice.inference_instruct(request.instruct_request.tts_text,
                                                              request.instruct_request.spk_id,
-                                                             request.instruct_request.instruct_text)
+                                                             request.instruct_request.instruct_text,
+                                                             stream=self.stream)
 
         logging.info('send inference response')
-        for i in model_output:
-            response = cosyvoice_pb2.Response()
-            response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-            yield response
+        with closing(model_output):
+            for i in model_output:
+                # client cancelled or its deadline passed, closing model_output stops llm decoding
+                if not context.is_active():
+                    logging.info('request cancelled or deadline exceeded, stop synthesis')
+                    return
+                response = cosyvoice_pb2.Response()
+                response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
+                yield response
+        # latency stats live in the replica processes when a replica pool is used
+        if isinstance(self.cosyvoice, CosyVoice):
+            logging.info('first chunk latency {}'.format(self.cosyvoice.first_chunk_latency))
+            logging.info('chunk gap latency {}'.format(self.cosyvoice.chunk_gap_latency))
 
 
 def main():
-    grpcServer = grpc.server(futures.ThreadPoolExecutor(max_workers=args.max_conc), maximum_concurrent_rpcs=args.max_conc)
+    # queued requests hold a rpc thread while they wait for admission, so there are threads for max_queue more
+    # requests to reach AdmissionQueue and be shed by urgency. the transport limit only guards against floods
+    max_active = args.max_conc * max(args.num_replicas, 1)
+    max_workers = max_active + 2 * args.max_queue + 1
+    grpcServer = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers), maximum_concurrent_rpcs=max_workers)
     cosyvoice_pb2_grpc.add_CosyVoiceServicer_to_server(CosyVoiceServiceImpl(args), grpcServer)
     grpcServer.add_insecure_port('0.0.0.0:{}'.format(args.port))
     grpcServer.start()
@@ -82,9 +223,44 @@ if __name__ == '__main__':
     parser.add_argument('--max_conc',
                         type=int,
                         default=4)
+    parser.add_argument('--num_replicas',
+                        type=int,
+                        default=1,
+                        help='model replicas in separate processes, max_conc requests run in each')
+    parser.add_argument('--cores_per_replica',
+                        type=int,
+                        default=0,
+                        help='pin every replica to its own cores, 0 means no pinning')
+    parser.add_argument('--max_queue',
+                        type=int,
+                        default=16,
+                        help='requests waiting for admission, the least urgent one is shed beyond it')
+    parser.add_argument('--interactive_max_chars',
+                        type=int,
+                        default=50,
+                        help='requests with a shorter tts_text are interactive and served first, unless priority metadata is set')
+    parser.add_argument('--llm_batch_size',
+                        type=int,
+                        default=1,
+                        help='max sessions decoded together by llm scheduler, 1 means no continuous batching')
+    parser.add_argument('--stream',
+                        action='store_true',
+                        default=False,
+                        help='stream audio chunks back while llm is still decoding')
     parser.add_argument('--model_dir',
                         type=str,
                         default='iic/CosyVoice-300M',
                         help='local path or modelscope repo id')
+    parser.add_argument('--backend',
+                        type=str,
+                        default='torch',
+                        choices=['torch', 'onnx-cpu', 'onnx-cpu-int8'],
+                        help='onnx-cpu needs models exported by export_jit.py and export_onnx.py')
+    parser.add_argument('--intra_op_threads',
+                        type=int,
+                        default=None)
+    parser.add_argument('--inter_op_threads',
+                        type=int,
+                        default=None)
     args = parser.parse_args()
     main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import gc
+import os
+import sys
+import time
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+
+
+def run(cosyvoice, args):
+    """Synthesize every text non-streaming once, return seconds spent and seconds of speech."""
+    cost, speech_len = 0, 0
+    for text in args.text:
+        start_time = time.time()
+        for model_output in cosyvoice.inference_sft(text, args.spk_id, stream=False):
+            speech_len += model_output['tts_speech'].shape[1] / 22050
+        cost += time.time() - start_time
+    return cost, speech_len
+
+
+def main(args):
+    # export with cosyvoice/bin/export_jit.py and cosyvoice/bin/export_onnx.py first
+    print('{:<16} {:>8} {:>8} {:>10}'.format('backend', 'intra', 'inter', 'rtf'))
+    for backend in args.backends.split(','):
+        if backend == 'torch':
+            cosyvoice = CosyVoice(args.model_dir, load_jit=False, fp16=False, intra_op_threads=args.intra_op_threads)
+        else:
+            cosyvoice = CosyVoice(args.model_dir, backend=backend, intra_op_threads=args.intra_op_threads,
+                                  inter_op_threads=args.inter_op_threads)
+        # warm up, the first call pays jit profiling and onnxruntime allocation
+        run(cosyvoice, args)
+        cost, speech_len = 0, 0
+        for _ in range(args.num_runs):
+            this_cost, this_speech_len = run(cosyvoice, args)
+            cost, speech_len = cost + this_cost, speech_len + this_speech_len
+        print('{:<16} {:>8} {:>8} {:>10.4f}'.format(backend, str(args.intra_op_threads), str(args.inter_op_threads), cost / speech_len))
+        del cosyvoice
+        gc.collect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice-300M-SFT')
+    parser.add_argument('--spk_id', type=str, default='中文女')
+    parser.add_argument('--text', type=str, nargs='+',
+                        default=['收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。'])
+    parser.add_argument('--backends', type=str, default='torch,onnx-cpu,onnx-cpu-int8', help='comma separated backend list')
+    parser.add_argument('--intra_op_threads', type=int, default=None)
+    parser.add_argument('--inter_op_threads', type=int, default=None)
+    parser.add_argument('--num_runs', type=int, default=3)
+    args = parser.parse_args()
+    main(args)
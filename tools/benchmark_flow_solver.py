@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+
+
+def llm_tokens(model, model_input):
+    """Decode speech tokens once, so every solver is compared on exactly the same tokens."""
+    with model.new_session() as session:
+        model.llm_job(model_input['text'], torch.zeros(1, 0, dtype=torch.int32), torch.zeros(1, 0, dtype=torch.int32),
+                      model_input['llm_embedding'], session)
+        return torch.tensor(session.speech_token).unsqueeze(dim=0)
+
+
+def synthesize(model, token, embedding, n_timesteps, solver, seed):
+    # same seed for every solver, so they start from the same noise
+    torch.manual_seed(seed)
+    prompt_token, prompt_feat = torch.zeros(1, 0, dtype=torch.int32), torch.zeros(1, 0, 80)
+    mel, _ = model.flow.inference(token=token.to(model.device),
+                                  token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(model.device),
+                                  prompt_token=prompt_token.to(model.device),
+                                  prompt_token_len=torch.tensor([0], dtype=torch.int32).to(model.device),
+                                  prompt_feat=prompt_feat.to(model.device),
+                                  prompt_feat_len=torch.tensor([0], dtype=torch.int32).to(model.device),
+                                  embedding=embedding.to(model.device),
+                                  flow_cache=torch.zeros(1, 80, 0, 2),
+                                  n_timesteps=n_timesteps,
+                                  solver=solver)
+    speech, _ = model.hift.inference(speech_feat=mel)
+    return mel, speech
+
+
+def main(args):
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, load_onnx=args.load_onnx, fp16=False)
+    model = cosyvoice.model
+    configs = [(c.split(':')[0], int(c.split(':')[1])) for c in args.solvers.split(',')]
+    items = []
+    for text in args.text:
+        for i in cosyvoice.frontend.text_normalize(text, split=True):
+            model_input = cosyvoice.frontend.frontend_sft(i, args.spk_id)
+            items.append((llm_tokens(model, model_input), model_input['flow_embedding']))
+
+    # 10 step euler is the shipped setting and the reference for mel distance
+    baseline = [synthesize(model, token, embedding, 10, 'euler', args.seed)[0] for token, embedding in items]
+    print('{:<10} {:>6} {:>8} {:>10}'.format('solver', 'steps', 'rtf', 'mel_l1'))
+    for solver, n_timesteps in configs:
+        synthesize(model, *items[0], n_timesteps, solver, args.seed)
+        cost, speech_len, distance = 0, 0, 0
+        for _ in range(args.num_runs):
+            for (token, embedding), ref in zip(items, baseline):
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                start_time = time.time()
+                mel, speech = synthesize(model, token, embedding, n_timesteps, solver, args.seed)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                cost += time.time() - start_time
+                speech_len += speech.shape[1] / 22050
+                distance += (mel - ref).abs().mean().item()
+        print('{:<10} {:>6} {:>8.4f} {:>10.4f}'.format(solver, n_timesteps, cost / speech_len, distance / (args.num_runs * len(items))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice-300M-SFT')
+    parser.add_argument('--spk_id', type=str, default='中文女')
+    parser.add_argument('--text', type=str, nargs='+',
+                        default=['收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。'])
+    parser.add_argument('--solvers', type=str, default='euler:10,euler:6,euler:4,midpoint:3,heun:3,rk23:5',
+                        help='comma separated solver:n_timesteps list')
+    parser.add_argument('--num_runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--load_onnx', action='store_true', default=False)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import io
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+
+
+def model_bytes(module):
+    # serialized size, counts packed int8 weights of quantized linear layers correctly
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+
+def llm_tokens(model, model_input, seed):
+    torch.manual_seed(seed)
+    with model.new_session() as session:
+        model.llm_job(model_input['text'], torch.zeros(1, 0, dtype=torch.int32), torch.zeros(1, 0, dtype=torch.int32),
+                      model_input['llm_embedding'], session)
+        return torch.tensor(session.speech_token).unsqueeze(dim=0)
+
+
+@torch.inference_mode()
+def teacher_forced_argmax(llm, model_input, speech_token):
+    """Most likely next token at every position when the llm is fed speech_token, independent of sampling."""
+    text = model_input['text']
+    lm_input, _, _ = llm.prepare_inference_input(text, torch.tensor([text.shape[1]], dtype=torch.int32),
+                                                 torch.zeros(1, 0, dtype=torch.int32), torch.tensor([0], dtype=torch.int32),
+                                                 torch.zeros(1, 0, dtype=torch.int32), torch.tensor([0], dtype=torch.int32),
+                                                 model_input['llm_embedding'])
+    prefix_len = lm_input.shape[1]
+    lm_input = torch.concat([lm_input, llm.speech_embedding(speech_token)], dim=1)
+    att_mask = torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]))).to(torch.bool)
+    y_pred, _, _ = llm.llm.forward_chunk(lm_input, offset=0, required_cache_size=-1,
+                                         att_cache=torch.zeros((0, 0, 0, 0)), cnn_cache=torch.zeros((0, 0, 0, 0)), att_mask=att_mask)
+    # position prefix_len - 1 + k predicts speech token k
+    return llm.llm_decoder(y_pred[:, prefix_len - 1: prefix_len - 1 + speech_token.shape[1]]).argmax(dim=-1)
+
+
+def rtf(cosyvoice, args):
+    cost, speech_len = 0, 0
+    for _ in range(args.num_runs):
+        for text in args.text:
+            start_time = time.time()
+            for model_output in cosyvoice.inference_sft(text, args.spk_id, stream=False):
+                speech_len += model_output['tts_speech'].shape[1] / 22050
+            cost += time.time() - start_time
+    return cost / speech_len
+
+
+def measure(cosyvoice, args):
+    model = cosyvoice.model
+    return {'llm_mb': model_bytes(model.llm) / 2 ** 20, 'flow_encoder_mb': model_bytes(model.flow.encoder) / 2 ** 20,
+            'rtf': rtf(cosyvoice, args)}
+
+
+def main(args):
+    torch.set_num_threads(args.num_threads)
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, fp16=False)
+    model = cosyvoice.model
+    model_inputs = [cosyvoice.frontend.frontend_sft(i, args.spk_id)
+                    for text in args.text for i in cosyvoice.frontend.text_normalize(text, split=True)]
+
+    # fp32 reference, tokens are sampled once and used to teacher force both models
+    tokens = [llm_tokens(model, i, args.seed) for i in model_inputs]
+    reports = {'fp32': measure(cosyvoice, args)}
+    fp32_argmax = [teacher_forced_argmax(model.llm, i, t) for i, t in zip(model_inputs, tokens)]
+
+    model.load_int8()
+    reports['int8'] = measure(cosyvoice, args)
+    int8_argmax = [teacher_forced_argmax(model.llm, i, t) for i, t in zip(model_inputs, tokens)]
+    agree = sum((a == b).sum().item() for a, b in zip(fp32_argmax, int8_argmax))
+    total = sum(a.numel() for a in fp32_argmax)
+
+    print('{:<6} {:>10} {:>16} {:>8}'.format('dtype', 'llm_mb', 'flow_encoder_mb', 'rtf'))
+    for dtype, report in reports.items():
+        print('{:<6} {:>10.1f} {:>16.1f} {:>8.4f}'.format(dtype, report['llm_mb'], report['flow_encoder_mb'], report['rtf']))
+    print('token agreement rate {:.4f} ({}/{} teacher forced top-1 tokens over {} utterances)'.format(
+        agree / total, agree, total, len(model_inputs)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice-300M-SFT')
+    parser.add_argument('--spk_id', type=str, default='中文女')
+    parser.add_argument('--text', type=str, nargs='+',
+                        default=['收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福'
+                                 '让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                                 '今天天气不错，我们一起去公园散步吧。',
+                                 'CosyVoice is a multilingual large voice generation model, providing inference, training and deployment.'])
+    parser.add_argument('--num_runs', type=int, default=2)
+    parser.add_argument('--num_threads', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+from cosyvoice.utils.common import ras_sampling, IGNORE_ID
+
+
+# python loop sampler before vectorization, kept here as the baseline
+def legacy_nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
+    prob, indices = [], []
+    cum_prob = 0.0
+    sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
+    for i in range(len(sorted_idx)):
+        if cum_prob < top_p and len(prob) < top_k:
+            cum_prob += sorted_value[i]
+            prob.append(sorted_value[i])
+            indices.append(sorted_idx[i])
+        else:
+            break
+    prob = torch.tensor(prob).to(weighted_scores)
+    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
+    top_ids = indices[prob.multinomial(1, replacement=True)]
+    return top_ids
+
+
+def legacy_ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
+    top_ids = legacy_nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
+    rep_num = (torch.tensor(decoded_tokens[-win_size:]).to(weighted_scores.device) == top_ids).sum().item()
+    if rep_num >= win_size * tau_r:
+        top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True)
+    return top_ids
+
+
+def legacy_sampling_ids(weighted_scores, decoded_tokens, eos):
+    while True:
+        top_ids = legacy_ras_sampling(weighted_scores, decoded_tokens, 25)
+        if eos not in top_ids:
+            break
+    return top_ids
+
+
+def sampling_ids(weighted_scores, decoded_tokens, eos):
+    ignore_mask = torch.zeros_like(weighted_scores, dtype=torch.bool)
+    ignore_mask[..., eos] = True
+    return ras_sampling(weighted_scores, decoded_tokens, 25, ignore_mask=ignore_mask)
+
+
+def timeit(fn, num_steps, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(num_steps):
+        # every decode step ends with top_ids.item() in TransformerLM.inference, include that sync
+        fn().flatten()[0].item()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / num_steps * 1000
+
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and args.gpu >= 0 else 'cpu')
+    eos = args.vocab_size
+    logp = torch.randn(args.batch_size, args.vocab_size + 1, device=device).log_softmax(dim=-1)
+    decoded_list = torch.randint(0, args.vocab_size, (args.batch_size, args.history_len)).tolist()
+    decoded = torch.tensor(decoded_list, dtype=torch.long, device=device)
+    decoded[:, :args.history_len // 2] = IGNORE_ID
+
+    def legacy():
+        return torch.stack([legacy_sampling_ids(logp[i], decoded_list[i], eos) for i in range(args.batch_size)])
+
+    def vectorized_single():
+        return torch.stack([sampling_ids(logp[i], decoded[i], eos) for i in range(args.batch_size)])
+
+    def vectorized_batch():
+        return sampling_ids(logp, decoded, eos)
+
+    print('device {} batch_size {} vocab_size {}'.format(device, args.batch_size, args.vocab_size + 1))
+    print('legacy python loop      {:.3f} ms/step'.format(timeit(legacy, args.num_steps, device)))
+    print('vectorized per sequence {:.3f} ms/step'.format(timeit(vectorized_single, args.num_steps, device)))
+    print('vectorized batch        {:.3f} ms/step'.format(timeit(vectorized_batch, args.num_steps, device)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--vocab_size', type=int, default=4096)
+    parser.add_argument('--history_len', type=int, default=32)
+    parser.add_argument('--num_steps', type=int, default=1000)
+    parser.add_argument('--gpu', type=int, default=0, help='gpu id, -1 for cpu')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import sys
+import time
+from unittest import mock
+import numpy as np
+import torch
+import torchaudio
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import CosyVoice
+from cosyvoice.utils.file_utils import load_wav
+
+
+def vocode(hift, mel, chunk_len, seed):
+    """Vocode mel in chunks of chunk_len frames, chunk_len >= num frames is offline vocoding.
+
+    Returns the speech and the sample offsets where chunk outputs are spliced.
+    """
+    # same start phase for every run, and no source noise, so stream and offline outputs are comparable sample by sample
+    torch.manual_seed(seed)
+    chunks, cache = [], None
+    with mock.patch.object(torch, 'randn_like', torch.zeros_like):
+        for i in range(0, mel.shape[2], chunk_len):
+            speech, cache = hift.inference_stream(speech_feat=mel[:, :, i: i + chunk_len], cache=cache, finalize=i + chunk_len >= mel.shape[2])
+            chunks.append(speech)
+    splices = np.cumsum([i.shape[1] for i in chunks])[:-1]
+    return torch.concat(chunks, dim=1), [i for i in splices if 0 < i]
+
+
+def main(args):
+    """Vocode the mel of a wav in one pass and chunk by chunk, compare the two outputs around every splice.
+
+    Source noise is turned off and both runs start from the same sine phase, so chunked output should equal offline
+    output up to float error, a click at a chunk boundary shows up as a large max difference near its splice.
+    """
+    cosyvoice = CosyVoice(args.model_dir, load_jit=False, fp16=False)
+    hift, feat_extractor, device = cosyvoice.model.hift, cosyvoice.frontend.feat_extractor, cosyvoice.model.device
+    print('receptive field {} frames, context {} look ahead {} crossfade {}'.format(
+        hift.receptive_field(), hift.stream_context_len, hift.stream_lookahead_len, hift.stream_crossfade_len))
+    os.makedirs(args.result_dir, exist_ok=True)
+    print('{:<40} {:>8} {:>8} {:>8} {:>12} {:>12} {:>10}'.format('wav', 'frames', 'splices', 'rtf', 'splice_max', 'overall_max', 'mel_l1'))
+    for wav in args.wav:
+        mel = feat_extractor(load_wav(wav, 22050)).to(device)
+        offline_speech, _ = vocode(hift, mel, mel.shape[2], args.seed)
+
+        start_time = time.time()
+        stream_speech, splices = vocode(hift, mel, args.chunk_len, args.seed)
+        rtf = (time.time() - start_time) / (stream_speech.shape[1] / 22050)
+        assert stream_speech.shape == offline_speech.shape, \
+            'stream output {} differs from offline output {}'.format(stream_speech.shape, offline_speech.shape)
+
+        diff = (stream_speech - offline_speech).abs()[0]
+        splice_max = max([diff[max(i - args.splice_window, 0): i + args.splice_window].max().item() for i in splices], default=0)
+        distance = (feat_extractor(stream_speech.cpu()) - feat_extractor(offline_speech.cpu())).abs().mean().item()
+        print('{:<40} {:>8} {:>8} {:>8.4f} {:>12.6f} {:>12.6f} {:>10.4f}'.format(
+            os.path.basename(wav), mel.shape[2], len(splices), rtf, splice_max, diff.max().item(), distance))
+        name = os.path.splitext(os.path.basename(wav))[0]
+        torchaudio.save(os.path.join(args.result_dir, '{}_offline.wav'.format(name)), offline_speech.cpu(), 22050)
+        torchaudio.save(os.path.join(args.result_dir, '{}_stream.wav'.format(name)), stream_speech.cpu(), 22050)
+        assert splice_max <= args.max_splice_diff, 'chunk boundaries of {} differ from offline output by {}'.format(wav, splice_max)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice-300M-SFT')
+    parser.add_argument('--wav', type=str, nargs='+', required=True)
+    parser.add_argument('--chunk_len', type=int, default=86, help='mel frames per chunk, 86 frames is about one streaming hop')
+    parser.add_argument('--result_dir', type=str, default='exp/hift_stream', help='offline and stream wavs for listening')
+    parser.add_argument('--splice_window', type=int, default=1024, help='samples on each side of a splice to compare')
+    parser.add_argument('--max_splice_diff', type=float, default=1e-3, help='max sample difference allowed near a splice')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -13,39 +13,113 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import numpy as np
 import onnxruntime
 import torch
 import torchaudio
 import torchaudio.compliance.kaldi as kaldi
 from tqdm import tqdm
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+from cosyvoice.utils.common import length_batches
+from cosyvoice.utils.file_utils import get_resampler, read_jsonl_checkpoint
 
 
-def single_job(utt):
+def init_worker(onnx_path, num_thread):
+    # one session per process, created after fork
+    global ort_session
+    option = onnxruntime.SessionOptions()
+    option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    option.intra_op_num_threads = num_thread
+    providers = ["CPUExecutionProvider"]
+    ort_session = onnxruntime.InferenceSession(onnx_path, sess_options=option, providers=providers)
+    torch.set_num_threads(1)
+
+
+def compute_fbank(utt):
     audio, sample_rate = torchaudio.load(utt2wav[utt])
     if sample_rate != 16000:
-        audio = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)(audio)
+        audio = get_resampler(sample_rate, 16000)(audio)
     feat = kaldi.fbank(audio,
                        num_mel_bins=80,
                        dither=0,
                        sample_frequency=16000)
     feat = feat - feat.mean(dim=0, keepdim=True)
-    embedding = ort_session.run(None, {ort_session.get_inputs()[0].name: feat.unsqueeze(dim=0).cpu().numpy()})[0].flatten().tolist()
-    return utt, embedding
+    return feat
+
+
+def run_campplus(feats):
+    """Embed a list of (T, 80) fbanks as one batch, zero padding is the mean of the mean normalized fbank."""
+    batch = np.zeros((len(feats), max(feat.shape[0] for feat in feats), 80), dtype=np.float32)
+    for i, feat in enumerate(feats):
+        batch[i, :feat.shape[0]] = feat.numpy()
+    return ort_session.run(None, {ort_session.get_inputs()[0].name: batch})[0].reshape(len(feats), -1)
+
+
+def job(utts):
+    return utts, run_campplus([compute_fbank(utt) for utt in utts]).tolist()
+
+
+def probe(utts):
+    """Lowest cosine similarity between batched and one by one embeddings of utts."""
+    feats = [compute_fbank(utt) for utt in utts]
+    batched = torch.from_numpy(run_campplus(feats))
+    single = torch.from_numpy(np.concatenate([run_campplus([feat]) for feat in feats]))
+    return torch.nn.functional.cosine_similarity(batched, single, dim=1).min().item()
+
+
+def make_batches(utts, batch_size, max_pad_ratio):
+    """Group length sorted utts, a batch ends at batch_size utts or when padding the shortest would exceed max_pad_ratio."""
+    if batch_size == 1:
+        return [[utt] for utt in utts]
+    with ThreadPool(16) as pool:
+        infos = pool.map(lambda utt: torchaudio.info(utt2wav[utt]), utts)
+    utt2len = {utt: info.num_frames / info.sample_rate for utt, info in zip(utts, infos)}
+    return length_batches(utts, utt2len, batch_size, max_pad_ratio)
 
 
 def main(args):
-    all_task = [executor.submit(single_job, utt) for utt in utt2wav.keys()]
-    utt2embedding, spk2embedding = {}, {}
-    for future in tqdm(as_completed(all_task)):
-        utt, embedding = future.result()
-        utt2embedding[utt] = embedding
+    part_path = '{}/utt2embedding.jsonl'.format(args.dir)
+    # speaker means are kept as running sums, rebuilt from the checkpoint on restart
+    spk2sum, spk2count, done = {}, {}, set()
+
+    def add(utt, embedding):
         spk = utt2spk[utt]
-        if spk not in spk2embedding:
-            spk2embedding[spk] = []
-        spk2embedding[spk].append(embedding)
-    for k, v in spk2embedding.items():
-        spk2embedding[k] = torch.tensor(v).mean(dim=0).tolist()
+        if spk not in spk2sum:
+            spk2sum[spk], spk2count[spk] = torch.zeros(len(embedding), dtype=torch.float64), 0
+        spk2sum[spk] += torch.tensor(embedding, dtype=torch.float64)
+        spk2count[spk] += 1
+        done.add(utt)
+
+    for utt, embedding in read_jsonl_checkpoint(part_path).items():
+        add(utt, embedding)
+    utts = [utt for utt in utt2wav.keys() if utt not in done]
+    logging.info('{} utts done, {} utts to go'.format(len(done), len(utts)))
+
+    batches = make_batches(utts, args.batch_size, args.max_pad_ratio)
+    with multiprocessing.Pool(processes=args.num_process, initializer=init_worker, initargs=(args.onnx_path, args.num_thread)) as pool, \
+            open(part_path, 'a', encoding='utf8') as f, tqdm(total=len(utts)) as progress:
+        multi = [batch for batch in batches if len(batch) > 1]
+        if len(multi) != 0:
+            # campplus has no length input, make sure padding leaves embeddings close enough
+            cosine = pool.apply(probe, (multi[-1],))
+            logging.info('batched vs single embedding min cosine similarity {:.4f}'.format(cosine))
+            assert cosine >= args.min_cosine, 'padding changes embeddings too much, lower --max_pad_ratio or use --batch_size 1'
+        for batch_utts, embeddings in pool.imap_unordered(job, batches):
+            for utt, embedding in zip(batch_utts, embeddings):
+                f.write(json.dumps([utt, embedding]) + '\n')
+                add(utt, embedding)
+            f.flush()
+            progress.update(len(batch_utts))
+
+    spk2embedding = {spk: (spk2sum[spk] / spk2count[spk]).float().tolist() for spk in spk2sum}
+    utt2embedding = read_jsonl_checkpoint(part_path)
     torch.save(utt2embedding, "{}/utt2embedding.pt".format(args.dir))
     torch.save(spk2embedding, "{}/spk2embedding.pt".format(args.dir))
 
@@ -54,7 +128,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--dir", type=str)
     parser.add_argument("--onnx_path", type=str)
-    parser.add_argument("--num_thread", type=int, default=8)
+    parser.add_argument("--num_thread", type=int, default=1, help='onnxruntime intra op threads per process')
+    parser.add_argument("--num_process", type=int, default=8, help='processes sharing the utts, each with its own session')
+    parser.add_argument("--batch_size", type=int, default=1, help='utts per campplus call, sorted by length when > 1')
+    parser.add_argument("--max_pad_ratio", type=float, default=0.05, help='longest utt of a batch is at most this much longer than the shortest')
+    parser.add_argument("--min_cosine", type=float, default=0.99, help='minimal cosine similarity of batched vs single embeddings on a probe batch')
     args = parser.parse_args()
 
     utt2wav, utt2spk = {}, {}
@@ -67,11 +145,4 @@ if __name__ == "__main__":
             l = l.replace('\n', '').split()
             utt2spk[l[0]] = l[1]
 
-    option = onnxruntime.SessionOptions()
-    option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-    option.intra_op_num_threads = 1
-    providers = ["CPUExecutionProvider"]
-    ort_session = onnxruntime.InferenceSession(args.onnx_path, sess_options=option, providers=providers)
-    executor = ThreadPoolExecutor(max_workers=args.num_thread)
-
     main(args)
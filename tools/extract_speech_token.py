@@ -13,36 +13,113 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
+import math
+import os
+import sys
 import torch
 from tqdm import tqdm
 import onnxruntime
 import numpy as np
 import torchaudio
 import whisper
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+from cosyvoice.utils.common import length_batches
+from cosyvoice.utils.file_utils import get_resampler, read_jsonl_checkpoint
 
 
-def single_job(utt):
+def load_feat(utt):
     audio, sample_rate = torchaudio.load(utt2wav[utt])
     if sample_rate != 16000:
-        audio = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=16000)(audio)
+        audio = get_resampler(sample_rate, 16000)(audio)
     if audio.shape[1] / 16000 > 30:
         logging.warning('do not support extract speech token for audio longer than 30s')
-        speech_token = []
-    else:
-        feat = whisper.log_mel_spectrogram(audio, n_mels=128)
-        speech_token = ort_session.run(None, {ort_session.get_inputs()[0].name: feat.detach().cpu().numpy(),
-                                              ort_session.get_inputs()[1].name: np.array([feat.shape[2]], dtype=np.int32)})[0].flatten().tolist()
-    return utt, speech_token
+        return None
+    return whisper.log_mel_spectrogram(audio, n_mels=128)
+
+
+def run_tokenizer(feats):
+    """Tokenize a list of (1, 128, T) log mels as one zero padded batch, return one token list per feat."""
+    feats_len = np.array([feat.shape[2] for feat in feats], dtype=np.int32)
+    batch = np.zeros((len(feats), 128, feats_len.max()), dtype=np.float32)
+    for i, feat in enumerate(feats):
+        batch[i, :, :feat.shape[2]] = feat[0].detach().cpu().numpy()
+    speech_token = ort_session.run(None, {ort_session.get_inputs()[0].name: batch,
+                                          ort_session.get_inputs()[1].name: feats_len})[0]
+    speech_token = speech_token.reshape(len(feats), -1)
+    if len(feats) == 1:
+        return [speech_token[0].tolist()]
+    # the tokenizer downsamples mel frames by a fixed factor, tokens past an item's own length are padding
+    return [speech_token[i, :math.ceil(feats_len[i] / downsample)].tolist() for i in range(len(feats))]
+
+
+def job(utts, feats):
+    """Tokenize a batch, None feats (too long audio) get an empty token list like before."""
+    utt2speech_token = {utt: [] for utt, feat in zip(utts, feats) if feat is None}
+    valid = [(utt, feat) for utt, feat in zip(utts, feats) if feat is not None]
+    if len(valid) != 0:
+        for (utt, _), speech_token in zip(valid, run_tokenizer([feat for _, feat in valid])):
+            utt2speech_token[utt] = speech_token
+    return utt2speech_token
+
+
+def probe(utts, utt2len, batch_size):
+    """Token agreement of a padded batch with one by one runs, None if there are too few utts to batch.
+
+    The probe batch spreads from the longest to the shortest utt, so it is padded more than any real batch.
+    """
+    global downsample
+    utts = sorted([utt for utt in utts if utt2len[utt] <= 30], key=lambda utt: utt2len[utt], reverse=True)
+    num = min(batch_size, len(utts))
+    feats = [load_feat(utts[round(i * (len(utts) - 1) / max(num - 1, 1))]) for i in range(num)]
+    feats = [feat for feat in feats if feat is not None]
+    if len(feats) == 0:
+        return None
+    # measure the downsample factor of the tokenizer on the longest utt, where rounding matters least
+    downsample = round(feats[0].shape[2] / len(run_tokenizer(feats[:1])[0]))
+    if len(feats) < 2:
+        return None
+    agree, total = 0, 0
+    for feat, speech_token in zip(feats, run_tokenizer(feats)):
+        single = run_tokenizer([feat])[0]
+        agree += sum(a == b for a, b in zip(speech_token, single))
+        total += max(len(speech_token), len(single))
+    return agree / max(total, 1)
 
 
 def main(args):
-    all_task = [executor.submit(single_job, utt) for utt in utt2wav.keys()]
-    utt2speech_token = {}
-    for future in tqdm(as_completed(all_task)):
-        utt, speech_token = future.result()
-        utt2speech_token[utt] = speech_token
+    part_path = '{}/utt2speech_token.jsonl'.format(args.dir)
+    utt2speech_token = read_jsonl_checkpoint(part_path)
+    utts = [utt for utt in utt2wav.keys() if utt not in utt2speech_token]
+    logging.info('{} utts done, {} utts to go'.format(len(utt2speech_token), len(utts)))
+    if len(utts) != 0 and args.batch_size > 1:
+        infos = executor.map(lambda utt: torchaudio.info(utt2wav[utt]), utts)
+        utt2len = {utt: info.num_frames / info.sample_rate for utt, info in zip(utts, tqdm(infos, total=len(utts), desc='length'))}
+        # padded kernels may round differently, so require agreement rather than equal tokens
+        agreement = probe(utts, utt2len, args.batch_size)
+        if agreement is not None:
+            logging.info('batched vs single token agreement {:.4f}'.format(agreement))
+            assert agreement >= args.min_agreement, \
+                'batched tokens differ from unbatched ones, this tokenizer does not mask padding, use --batch_size 1'
+        # longest first and little padding, memory peaks at the start
+        batches = length_batches(utts, utt2len, args.batch_size, args.max_pad_ratio)
+    else:
+        batches = [[utt] for utt in utts]
+    with open(part_path, 'a', encoding='utf8') as f, tqdm(total=len(utts)) as progress:
+        # decode, resample and log mel run in the executor, at most prefetch batches ahead of the tokenizer
+        pending = [[executor.submit(load_feat, utt) for utt in batch] for batch in batches[:args.prefetch]]
+        for i, batch_utts in enumerate(batches):
+            feats = [future.result() for future in pending.pop(0)]
+            if i + args.prefetch < len(batches):
+                pending.append([executor.submit(load_feat, utt) for utt in batches[i + args.prefetch]])
+            for utt, speech_token in job(batch_utts, feats).items():
+                f.write(json.dumps([utt, speech_token], ensure_ascii=False) + '\n')
+                utt2speech_token[utt] = speech_token
+            f.flush()
+            progress.update(len(batch_utts))
     torch.save(utt2speech_token, '{}/utt2speech_token.pt'.format(args.dir))
 
 
@@ -51,6 +128,10 @@ if __name__ == "__main__":
     parser.add_argument("--dir", type=str)
     parser.add_argument("--onnx_path", type=str)
     parser.add_argument("--num_thread", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=1, help='utts per tokenizer call, sorted by length when > 1')
+    parser.add_argument("--prefetch", type=int, default=4, help='batches decoded ahead of the tokenizer')
+    parser.add_argument("--max_pad_ratio", type=float, default=0.05, help='longest utt of a batch is at most this much longer than the shortest')
+    parser.add_argument("--min_agreement", type=float, default=0.99, help='minimal token agreement of batched vs single runs on a probe batch')
     args = parser.parse_args()
 
     utt2wav = {}
@@ -62,8 +143,13 @@ if __name__ == "__main__":
     option = onnxruntime.SessionOptions()
     option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
     option.intra_op_num_threads = 1
-    providers = ["CUDAExecutionProvider"]
+    # fall back to cpu on hosts without onnxruntime-gpu or a gpu
+    providers = [i for i in ["CUDAExecutionProvider", "CPUExecutionProvider"] if i in onnxruntime.get_available_providers()]
+    if "CUDAExecutionProvider" not in providers:
+        logging.warning('CUDAExecutionProvider not available, extract speech token on cpu')
+        option.intra_op_num_threads = args.num_thread
     ort_session = onnxruntime.InferenceSession(args.onnx_path, sess_options=option, providers=providers)
     executor = ThreadPoolExecutor(max_workers=args.num_thread)
+    downsample = None
 
     main(args)
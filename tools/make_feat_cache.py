@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from io import BytesIO
+import pyarrow.parquet as pq
+import torch
+import torch.nn.functional as F
+import torchaudio
+from hyperpyyaml import load_hyperpyyaml
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.dataset.feat_cache import FeatCache, FeatCacheWriter
+from cosyvoice.utils.file_utils import read_lists
+
+
+def job(parquet_file):
+    """Compute speech, speech_feat and pitch_feat of every utt in a shard the same way as the data_pipeline does."""
+    start_time = time.time()
+    writer, resamplers = FeatCacheWriter(parquet_file, sample_rate), {}
+    with pq.ParquetFile(parquet_file) as pf:
+        for record_batch in pf.iter_batches(batch_size=64, columns=['utt', 'audio_data']):
+            for row in record_batch.to_pylist():
+                speech, orig_sample_rate = torchaudio.load(BytesIO(row['audio_data']))
+                speech = speech.mean(dim=0, keepdim=True)
+                # same as processor.resample, samples below min_sample_rate are dropped there anyway
+                if orig_sample_rate != sample_rate:
+                    if orig_sample_rate not in resamplers:
+                        resamplers[orig_sample_rate] = torchaudio.transforms.Resample(orig_freq=orig_sample_rate, new_freq=sample_rate)
+                    speech = resamplers[orig_sample_rate](speech)
+                max_val = speech.abs().max()
+                if max_val > 1:
+                    speech /= max_val
+                feats = {'speech': speech, 'speech_feat': feat_extractor(speech).squeeze(dim=0).transpose(0, 1)}
+                if pitch_extractor is not None:
+                    pitch_feat = pitch_extractor(speech).transpose(1, 2)
+                    feats['pitch_feat'] = F.interpolate(pitch_feat, size=feats['speech_feat'].shape[0], mode='linear')[0, 0]
+                writer.add(row['utt'], feats)
+    writer.close()
+    logging.info('{} spend time {}'.format(parquet_file, time.time() - start_time))
+
+
+def main(args):
+    parquet_list = read_lists(args.data_list)
+    if args.overwrite is False:
+        parquet_list = [i for i in parquet_list if not FeatCache.exists(i)]
+    logging.info('{} shards to cache'.format(len(parquet_list)))
+    with multiprocessing.Pool(processes=args.num_processes) as pool:
+        # a failed shard has no index, rerunning picks it up again
+        for _ in pool.imap_unordered(job, parquet_list):
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',
+                        type=str,
+                        help='train config, feat_extractor/pitch_extractor/sample_rate are read from it')
+    parser.add_argument('--data_list',
+                        type=str,
+                        help='data.list written by tools/make_parquet_list.py')
+    parser.add_argument('--num_processes',
+                        type=int,
+                        default=1,
+                        help='num processes for computing features')
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        default=False,
+                        help='recompute shards which already have a feat cache')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    with open(args.config, 'r') as f:
+        configs = load_hyperpyyaml(f, overrides={k: None for k in ['llm', 'flow', 'hift', 'hifigan']})
+    sample_rate = configs['sample_rate']
+    feat_extractor = configs['feat_extractor']
+    # pitch_feat is only used by gan train, configs without pitch_extractor skip it
+    pitch_extractor = configs.get('pitch_extractor', None)
+    torch.set_num_threads(1)
+    main(args)
@@ -21,6 +21,7 @@ import pandas as pd
 import multiprocessing
 import time
 import torch
+import torchaudio
 
 
 def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
@@ -35,6 +36,11 @@ def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
     uttembedding_list = [utt2embedding[utt] for utt in utt_list]
     spkembedding_list = [spk2embedding[utt2spk[utt]] for utt in utt_list]
     speech_token_list = [utt2speech_token[utt] for utt in utt_list]
+    # length index for the bucket sampler, in mel frames of the resampled speech, only the wav header is read
+    utt2len = {}
+    for utt in utt_list:
+        info = torchaudio.info(utt2wav[utt])
+        utt2len[utt] = int(info.num_frames * args.sample_rate / info.sample_rate) // args.hop_size
 
     # 保存到parquet,utt2parquet_file,spk2parquet_file
     df = pd.DataFrame()
@@ -51,6 +57,8 @@ def job(utt_list, parquet_file, utt2parquet_file, spk2parquet_file):
         json.dump({k: parquet_file for k in utt_list}, f, ensure_ascii=False, indent=2)
     with open(spk2parquet_file, 'w') as f:
         json.dump({k: parquet_file for k in list(set(spk_list))}, f, ensure_ascii=False, indent=2)
+    with open('{}.len.json'.format(parquet_file), 'w') as f:
+        json.dump(utt2len, f, ensure_ascii=False)
     logging.info('spend time {}'.format(time.time() - start_time))
 
 
@@ -64,6 +72,14 @@ if __name__ == "__main__":
                         type=int,
                         default=1,
                         help='num processes for make parquets')
+    parser.add_argument('--sample_rate',
+                        type=int,
+                        default=22050,
+                        help='train sample rate, used for the length index')
+    parser.add_argument('--hop_size',
+                        type=int,
+                        default=256,
+                        help='mel hop size, used for the length index')
     parser.add_argument('--src_dir',
                         type=str)
     parser.add_argument('--des_dir',